@@ -0,0 +1,103 @@
+from benchmarks.fake_services import Faults, fake_target, free_port
+from benchmarks.stats import summarize, print_result
+from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import websocket_connect
+from typing import Dict, List
+import subprocess
+import tempfile
+import argparse
+import asyncio
+import sys
+import time
+import os
+
+
+# response latency of the webthing api while websocket subscribers are connected. The monitor is started as a
+# separate process (as in production). A fast latency sample period causes a steady stream of property updates
+#   python -m benchmarks.bench_api [--subscribers 0,10,100] [--duration 10]
+
+SERVER_SCRIPT = '''
+import logging, sys
+logging.basicConfig(level=logging.WARNING)
+from internet_monitor_webthing.internet_multiple_webthing import run_server
+run_server(int(sys.argv[1]), 'benchmark', 0, 1, sys.argv[2], latency_target=sys.argv[3], latency_period=float(sys.argv[4]))
+'''
+
+
+def start_server(port: int, target_url: str, latency_target: str, latency_period: float) -> subprocess.Popen:
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=package_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    return subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT, str(port), target_url, latency_target, str(latency_period)],
+                            cwd=tempfile.mkdtemp(), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_ready(url: str, timeout_sec: float = 30):
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        try:
+            await AsyncHTTPClient().fetch(url, request_timeout=1)
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise Exception("server " + url + " is not ready")
+
+
+async def subscribe(url: str, counter: List[int], stopped: asyncio.Event):
+    connection = await websocket_connect(url)
+    try:
+        while not stopped.is_set():
+            message = await connection.read_message()
+            if message is None:
+                break
+            counter[0] += 1
+    finally:
+        connection.close()
+
+
+async def bench_subscribers(port: int, num_subscribers: int, duration_sec: float) -> Dict:
+    counter = [0]
+    stopped = asyncio.Event()
+    subscribers = [asyncio.ensure_future(subscribe("ws://127.0.0.1:" + str(port) + "/0", counter, stopped)) for i in range(num_subscribers)]
+    await asyncio.sleep(1)
+    counter[0] = 0
+    latencies = []
+    client = AsyncHTTPClient()
+    started = time.monotonic()
+    while time.monotonic() - started < duration_sec:
+        request_started = time.perf_counter()
+        await client.fetch("http://127.0.0.1:" + str(port) + "/0/properties")
+        latencies.append((time.perf_counter() - request_started) * 1000)
+    elapsed_sec = time.monotonic() - started
+    messages_per_sec = counter[0] / elapsed_sec
+    stopped.set()
+    failed = len([subscriber for subscriber in subscribers if subscriber.done() and subscriber.exception() is not None])
+    for subscriber in subscribers:
+        subscriber.cancel()
+    return {'properties_ms': summarize(latencies), 'ws_messages_per_sec': messages_per_sec, 'failed_subscribers': failed}
+
+
+async def run(args):
+    target = fake_target(Faults(args.latency))
+    port = free_port()
+    server = start_server(port, target.url + "/", "127.0.0.1:" + str(target.port), args.latency_period)
+    try:
+        await wait_until_ready("http://127.0.0.1:" + str(port) + "/0/properties")
+        for num_subscribers in [int(num) for num in args.subscribers.split(",")]:
+            print_result("api latency with " + str(num_subscribers) + " websocket subscribers", await bench_subscribers(port, num_subscribers, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+        target.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='webthing api benchmark')
+    parser.add_argument('--subscribers', type=str, default="0,10,100", help='comma separated numbers of websocket subscribers')
+    parser.add_argument('--duration', type=float, default=10, help='the duration in sec of each run')
+    parser.add_argument('--latency', type=float, default=2, help='injected latency of the fake target in ms')
+    parser.add_argument('--latency_period', type=float, default=0.1, help='the latency sample period of the monitor in sec')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from internet_monitor_webthing.ip_address_resolver import IpAddressResolver
+from internet_monitor_webthing.ip_info import IpInfo
+from benchmarks.fake_services import Faults, fake_ip_echo, use_fake_rdap
+from benchmarks.stats import summarize, print_result
+from typing import Dict, List
+import tempfile
+import argparse
+import asyncio
+import logging
+import time
+import os
+
+
+# cost of the public ip address resolution (a single source and the race of a slow and a fast source, with and
+# without cached address) and of the ip info (RDAP) lookup: cache misses, exact address hits,
+# hits of a cached prefix (a new address within a known network) and the reload of the persisted cache
+#   python -m benchmarks.bench_ip_lookup [--latency 30] [--lookups 50]
+
+
+async def bench_address_resolver(urls: List[str], num_lookups: int) -> Dict:
+    resolver = IpAddressResolver(urls)
+    uncached_ms = []
+    cached_us = []
+    for i in range(num_lookups):
+        resolver.clear_cache()
+        started = time.perf_counter()
+        await resolver.get_internet_address()
+        uncached_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        await resolver.get_internet_address()
+        cached_us.append((time.perf_counter() - started) * 1000 * 1000)
+    resolver.close()
+    return {'uncached_ms': summarize(uncached_ms), 'cached_us': summarize(cached_us)}
+
+
+def bench_ip_info(num_lookups: int) -> Dict:
+    filename = os.path.join(tempfile.mkdtemp(), "ip_info.json")
+    ip_info = IpInfo(filename)
+    miss_ms = []
+    hit_us = []
+    prefix_hit_us = []
+    for i in range(num_lookups):
+        address = "10." + str(i // 250) + "." + str(i % 250) + ".1"
+        started = time.perf_counter()
+        ip_info.get_ip_info(address)
+        miss_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        ip_info.get_ip_info(address)
+        hit_us.append((time.perf_counter() - started) * 1000 * 1000)
+        started = time.perf_counter()
+        ip_info.get_ip_info(address[:-1] + "2")
+        prefix_hit_us.append((time.perf_counter() - started) * 1000 * 1000)
+    started = time.perf_counter()
+    reloaded = IpInfo(filename)
+    load_ms = (time.perf_counter() - started) * 1000
+    return {'miss_ms': summarize(miss_ms), 'hit_us': summarize(hit_us), 'prefix_hit_us': summarize(prefix_hit_us),
+            'load_ms': load_ms, 'cached_prefixes': len(reloaded.prefixes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ip address and ip info lookup benchmark')
+    parser.add_argument('--latency', type=float, default=30, help='injected latency of the fake services in ms')
+    parser.add_argument('--jitter', type=float, default=5, help='injected jitter in ms')
+    parser.add_argument('--lookups', type=int, default=50, help='the number of lookups')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    service = fake_ip_echo(Faults(args.latency, args.jitter))
+    use_fake_rdap(service)
+    slow_service = fake_ip_echo(Faults(args.latency * 4, args.jitter))
+    print_result("ip address resolver (latency " + str(args.latency) + " ms)", asyncio.run(bench_address_resolver([service.url], args.lookups)))
+    print_result("ip address resolver race (latency " + str(args.latency * 4) + " ms and " + str(args.latency) + " ms)", asyncio.run(bench_address_resolver([slow_service.url, service.url], args.lookups)))
+    slow_service.stop()
+    print_result("ip info (latency " + str(args.latency) + " ms)", bench_ip_info(args.lookups))
+    service.stop()
+
+
+if __name__ == '__main__':
+    main()
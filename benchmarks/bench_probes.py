@@ -0,0 +1,119 @@
+from internet_monitor_webthing.connectivity_monitor import ConnectionTester, ConnectionLog
+from internet_monitor_webthing.probes import PROBE_METHODS
+from benchmarks.fake_services import Faults, fake_target, fake_ip_echo, use_fake_rdap
+from benchmarks.stats import summarize, print_result
+from typing import Dict, List
+import tempfile
+import argparse
+import asyncio
+import random
+import time
+import os
+
+
+# probe throughput of the ConnectionTester and detection latency of injected outages
+#   python -m benchmarks.bench_probes [--targets 3] [--method head] [--latency 5] [--drop_rate 0.01] [--outages 10]
+
+
+def create_tester(targets: List[str], quorum: int, method: str, ip_echo_url: str) -> ConnectionTester:
+    return ConnectionTester(ConnectionLog(os.path.join(tempfile.mkdtemp(), "log.bin")), targets, quorum, method, [ip_echo_url])
+
+
+async def probe_throughput(tester: ConnectionTester, duration_sec: float, timeout_sec: float) -> Dict:
+    num_cycles = 0
+    num_connected = 0
+    cycle_times = []
+    cpu_start = time.thread_time()
+    started = time.monotonic()
+    while time.monotonic() - started < duration_sec:
+        cycle_start = time.perf_counter()
+        if await tester.is_connected(timeout_sec):
+            num_connected += 1
+        cycle_times.append((time.perf_counter() - cycle_start) * 1000)
+        num_cycles += 1
+    elapsed_sec = time.monotonic() - started
+    return {'cycles_per_sec': num_cycles / elapsed_sec,
+            'probes_per_sec': num_cycles * len(tester.paths[0].probes) / elapsed_sec,
+            'connected_ratio': num_connected / max(1, num_cycles),
+            'cpu_ms_per_cycle': (time.thread_time() - cpu_start) * 1000 / max(1, num_cycles),
+            'cycle_ms': summarize(cycle_times)}
+
+
+async def detection_latency(tester: ConnectionTester, faults: List[Faults], period_sec: float, num_outages: int, outage_sec: float) -> Dict:
+    changes = []
+    task = asyncio.ensure_future(tester.measure_periodically(period_sec, lambda info: changes.append((time.monotonic(), info))))
+    await asyncio.sleep(2)
+
+    detect_down = []
+    detect_up = []
+    precisions = []
+    missed = 0
+    for i in range(num_outages):
+        # outages are injected at a random phase of the probe period
+        await asyncio.sleep(random.uniform(0, period_sec))
+        num_changes = len(changes)
+        down_time = time.monotonic()
+        for fault in faults:
+            fault.go_down()
+        await asyncio.sleep(outage_sec)
+        up_time = time.monotonic()
+        for fault in faults:
+            fault.go_up()
+        await asyncio.sleep(period_sec + 10)
+
+        down = [(at, info) for at, info in changes[num_changes:] if not info.is_connected]
+        up = [(at, info) for at, info in changes[num_changes:] if info.is_connected]
+        if len(down) == 0:
+            missed += 1
+            continue
+        detect_down.append(down[0][0] - down_time)
+        precisions.append(down[0][1].precision_sec)
+        if len(up) > 0:
+            detect_up.append(up[0][0] - up_time)
+    task.cancel()
+    return {'outages': num_outages,
+            'missed': missed,
+            'down_detection_sec': summarize(detect_down),
+            'up_detection_sec': summarize(detect_up),
+            'change_precision_sec': summarize(precisions)}
+
+
+async def run(args):
+    faults = [Faults(args.latency, args.jitter, args.drop_rate) for i in range(args.targets)]
+    targets = [fake_target(fault) for fault in faults]
+    ip_echo = fake_ip_echo()
+    use_fake_rdap(ip_echo)
+    urls = [target.url + "/" for target in targets]
+
+    tester = create_tester(urls, args.quorum, args.method, ip_echo.url)
+    print_result("probe throughput (" + str(args.targets) + " targets, method " + args.method + ", latency " + str(args.latency) + " ms, drop rate " + str(args.drop_rate) + ")",
+                 await probe_throughput(tester, args.duration, args.timeout))
+
+    if args.outages > 0:
+        tester = create_tester(urls, args.quorum, args.method, ip_echo.url)
+        print_result("outage detection (" + str(args.outages) + " outages of " + str(args.outage_duration) + " sec, max period " + str(args.period) + " sec)",
+                     await detection_latency(tester, faults, args.period, args.outages, args.outage_duration))
+
+    for target in targets:
+        target.stop()
+    ip_echo.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='connection tester benchmark')
+    parser.add_argument('--targets', type=int, default=3, help='the number of fake targets')
+    parser.add_argument('--quorum', type=int, default=1, help='the quorum of the connection tester')
+    parser.add_argument('--method', type=str, default='head', choices=PROBE_METHODS, help='the probe method')
+    parser.add_argument('--latency', type=float, default=5, help='injected latency in ms')
+    parser.add_argument('--jitter', type=float, default=1, help='injected jitter in ms')
+    parser.add_argument('--drop_rate', type=float, default=0, help='share of dropped requests')
+    parser.add_argument('--timeout', type=float, default=1, help='probe timeout in sec of the throughput test')
+    parser.add_argument('--duration', type=float, default=10, help='duration in sec of the throughput test')
+    parser.add_argument('--period', type=float, default=5, help='max probe period in sec of the detection test')
+    parser.add_argument('--outages', type=int, default=5, help='the number of injected outages (0 = skip detection test)')
+    parser.add_argument('--outage_duration', type=float, default=15, help='the duration of an injected outage in sec. Outages shorter than the probe period plus the confirmation timeout may remain undetected')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
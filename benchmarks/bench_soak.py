@@ -0,0 +1,78 @@
+from internet_monitor_webthing.latency_sampler import LatencySampler
+from benchmarks.bench_probes import create_tester
+from benchmarks.fake_services import Faults, fake_target, fake_ip_echo, use_fake_rdap
+from benchmarks.stats import print_result
+from typing import Dict
+import argparse
+import asyncio
+import logging
+import time
+import os
+
+
+# soak test: the connection tester and the latency sampler run for a long time against flapping, lossy targets.
+# Resource usage (rss, open file descriptors, asyncio tasks) is reported periodically to detect leaks
+#   python -m benchmarks.bench_soak [--duration 3600] [--flap_period 60] [--flap_down 20] [--drop_rate 0.02]
+
+
+def resource_usage() -> Dict:
+    with open("/proc/self/statm") as file:
+        rss_pages = int(file.read().split()[1])
+    return {'rss_mb': rss_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024),
+            'open_fds': len(os.listdir("/proc/self/fd")),
+            'tasks': len(asyncio.all_tasks())}
+
+
+async def run(args):
+    faults = [Faults(args.latency, args.jitter, args.drop_rate) for i in range(args.targets)]
+    for fault in faults:
+        fault.flap(args.flap_period, args.flap_down)
+    targets = [fake_target(fault) for fault in faults]
+    ip_echo = fake_ip_echo()
+    use_fake_rdap(ip_echo)
+
+    tester = create_tester([target.url + "/" for target in targets], 1, 'head', ip_echo.url)
+    changes = []
+    probe_task = asyncio.ensure_future(tester.measure_periodically(args.period, lambda info: changes.append(info)))
+    sampler = LatencySampler("127.0.0.1:" + str(targets[0].port), 0.2)
+    samples = [0]
+    sampler_task = asyncio.ensure_future(sampler.sample_periodically(lambda statistics: samples.__setitem__(0, samples[0] + 1)))
+
+    started = time.monotonic()
+    initial = resource_usage()
+    print_result("initial", initial)
+    while time.monotonic() - started < args.duration:
+        await asyncio.sleep(min(args.report_period, max(0, args.duration - (time.monotonic() - started))))
+        elapsed_sec = time.monotonic() - started
+        usage = resource_usage()
+        print_result("after " + str(round(elapsed_sec)) + " sec",
+                     dict(usage,
+                          injected_outages=int(elapsed_sec // args.flap_period) + 1,
+                          detected_outages=len([info for info in changes if info is not None and not info.is_connected]),
+                          latency_samples=samples[0],
+                          rss_growth_mb=usage['rss_mb'] - initial['rss_mb']))
+    probe_task.cancel()
+    sampler_task.cancel()
+    for target in targets:
+        target.stop()
+    ip_echo.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='connection monitor soak test')
+    parser.add_argument('--duration', type=float, default=60 * 60, help='the duration of the soak test in sec')
+    parser.add_argument('--report_period', type=float, default=60, help='the report period in sec')
+    parser.add_argument('--targets', type=int, default=3, help='the number of fake targets')
+    parser.add_argument('--period', type=float, default=5, help='the max probe period in sec')
+    parser.add_argument('--flap_period', type=float, default=60, help='the targets go down once per flap period')
+    parser.add_argument('--flap_down', type=float, default=20, help='the time in sec the targets are down per flap period')
+    parser.add_argument('--latency', type=float, default=5, help='injected latency in ms')
+    parser.add_argument('--jitter', type=float, default=2, help='injected jitter in ms')
+    parser.add_argument('--drop_rate', type=float, default=0.02, help='share of dropped requests')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
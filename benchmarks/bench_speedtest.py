@@ -0,0 +1,72 @@
+from internet_monitor_webthing.speedtest_monitor import SpeedtestRunner
+from internet_monitor_webthing.speed_engines import SpeedtestCliEngine, SpeedtestServerCache, HttpThroughputEngine
+from internet_monitor_webthing.throughput_server import ThroughputServer, ThroughputRequestHandler
+from benchmarks.fake_services import Faults, fake_speedtest_server, speedtest_server_cache_data
+from benchmarks.stats import summarize, print_result
+from typing import Dict
+import threading
+import resource
+import tempfile
+import argparse
+import logging
+import json
+import time
+import os
+
+
+# SpeedtestRunner against local stand-in servers: the speedtest-cli engine against a fake speedtest.net server and
+# the http engine against the throughput server of this package. Reports the run duration, the measured throughput
+# and the cpu time consumed by the worker process
+#   python -m benchmarks.bench_speedtest [--runs 3] [--streams 4] [--duration 5]
+
+
+def bench_runner(runner: SpeedtestRunner, num_runs: int) -> Dict:
+    durations = []
+    downloads = []
+    uploads = []
+    cpu_sec = []
+    num_bytes = 0
+    for i in range(num_runs):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.monotonic()
+        speed = runner.measure()
+        durations.append(time.monotonic() - started)
+        usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_sec.append((usage_after.ru_utime + usage_after.ru_stime) - (usage.ru_utime + usage.ru_stime))
+        downloads.append(speed.downloadspeed / (1000 * 1000))
+        uploads.append(speed.uploadspeed / (1000 * 1000))
+        num_bytes += speed.bytes_received + speed.bytes_sent
+    return {'run_sec': summarize(durations),
+            'download_mbit': summarize(downloads),
+            'upload_mbit': summarize(uploads),
+            'worker_cpu_sec': summarize(cpu_sec),
+            'worker_cpu_sec_per_gbyte': sum(cpu_sec) / max(1, num_bytes) * 1000 * 1000 * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='speedtest runner benchmark')
+    parser.add_argument('--runs', type=int, default=3, help='the number of runs per engine')
+    parser.add_argument('--streams', type=int, default=4, help='the number of streams of the http engine')
+    parser.add_argument('--duration', type=float, default=5, help='the measure duration of the http engine in sec')
+    parser.add_argument('--latency', type=float, default=0, help='injected latency of the fake speedtest server in ms')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    speedtest_server = fake_speedtest_server(Faults(args.latency))
+    cache_file = os.path.join(tempfile.mkdtemp(), "speedtest_servers.json")
+    with open(cache_file, "w") as file:
+        json.dump(speedtest_server_cache_data(speedtest_server), file)
+    runner = SpeedtestRunner(lambda speed: None, engine=SpeedtestCliEngine(SpeedtestServerCache(cache_file)))
+    print_result("speedtest-cli engine (fake speedtest server)", bench_runner(runner, args.runs))
+    speedtest_server.stop()
+
+    throughput_server = ThroughputServer(("127.0.0.1", 0), ThroughputRequestHandler)
+    threading.Thread(target=throughput_server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:" + str(throughput_server.server_address[1])
+    runner = SpeedtestRunner(lambda speed: None, engine=HttpThroughputEngine(url, args.streams, args.duration))
+    print_result("http engine (" + str(args.streams) + " streams, " + str(args.duration) + " sec)", bench_runner(runner, args.runs))
+    throughput_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+from internet_monitor_webthing.connectivity_monitor import ConnectionLog, ConnectionInfo
+from internet_monitor_webthing.speedtest_history import SpeedHistory
+from internet_monitor_webthing.speed_engines import Speed
+from benchmarks.stats import summarize, print_result
+from datetime import datetime, timedelta
+from typing import Dict, List
+import tempfile
+import argparse
+import logging
+import time
+import os
+
+
+# append cost of the ConnectionLog and of the SpeedHistory versus the history size as well as load and query time
+#   python -m benchmarks.bench_store [--sizes 1000,10000,100000] [--samples 1000]
+
+
+def connection_info(date: datetime, idx: int) -> ConnectionInfo:
+    connected = idx % 2 == 0
+    return ConnectionInfo(date, connected, "93.184.216." + str(idx % 250) if connected else "", {'asn': 'EXAMPLE-AS  US' if connected else ''},
+                          date - timedelta(seconds=1), date)
+
+
+def bench_connection_log(sizes: List[int], num_samples: int) -> Dict:
+    filename = os.path.join(tempfile.mkdtemp(), "log.bin")
+    log = ConnectionLog(filename)
+    start = datetime.now() - timedelta(days=365)
+    results = {}
+    idx = 0
+    for size in sizes:
+        while len(log.log) < size:
+            log.append(connection_info(start + timedelta(seconds=idx * 60), idx))
+            idx += 1
+        append_us = []
+        for i in range(num_samples):
+            info = connection_info(start + timedelta(seconds=idx * 60), idx)
+            started = time.perf_counter()
+            log.append(info)
+            append_us.append((time.perf_counter() - started) * 1000 * 1000)
+            idx += 1
+
+        started = time.perf_counter()
+        reopened = ConnectionLog(filename)
+        load_ms = (time.perf_counter() - started) * 1000
+        query_us = []
+        for i in range(num_samples):
+            day = start + timedelta(seconds=(i * 997 % max(1, idx)) * 60)
+            started = time.perf_counter()
+            reopened.range(day, day + timedelta(days=1), 100)
+            query_us.append((time.perf_counter() - started) * 1000 * 1000)
+        results[str(len(log.log)) + ' entries'] = {'append_us_p50': summarize(append_us)['p50'],
+                                                  'append_us_p99': summarize(append_us)['p99'],
+                                                  'load_ms': load_ms,
+                                                  'range_query_us_p50': summarize(query_us)['p50'],
+                                                  'file_kb': os.path.getsize(filename) / 1024}
+    return results
+
+
+def bench_speed_history(sizes: List[int], num_samples: int) -> Dict:
+    dir = tempfile.mkdtemp()
+    history = SpeedHistory(dir)
+    start = datetime.now() - timedelta(days=365)
+    speed = Speed("Fake/Local", 250 * 1000 * 1000, 40 * 1000 * 1000, 12.5, None, background_during=1000 * 1000)
+    results = {}
+    idx = 0
+    for size in sizes:
+        while len(history) < size:
+            history.append(start + timedelta(seconds=idx * 900), speed)
+            idx += 1
+        append_us = []
+        for i in range(num_samples):
+            date = start + timedelta(seconds=idx * 900)
+            started = time.perf_counter()
+            history.append(date, speed)
+            append_us.append((time.perf_counter() - started) * 1000 * 1000)
+            idx += 1
+
+        started = time.perf_counter()
+        reopened = SpeedHistory(dir)
+        load_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        reopened.rollup('day', start, datetime.now() + timedelta(days=365))
+        rollup_ms = (time.perf_counter() - started) * 1000
+        results[str(len(history)) + ' results'] = {'append_us_p50': summarize(append_us)['p50'],
+                                                  'append_us_p99': summarize(append_us)['p99'],
+                                                  'load_ms': load_ms,
+                                                  'daily_rollup_ms': rollup_ms}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='persistent store benchmark')
+    parser.add_argument('--sizes', type=str, default="1000,10000,100000", help='comma separated history sizes')
+    parser.add_argument('--samples', type=int, default=1000, help='measured operations per size')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print_result("connection log", bench_connection_log(sizes, args.samples))
+    print_result("speed history", bench_speed_history(sizes, args.samples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from typing import Dict, Optional
+import ipaddress
+import threading
+import random
+import socket
+import json
+import time
+
+
+# local stand-in services used by the benchmarks. Faults (latency, drops, outages, flapping) are injected per
+# service. A dropped or down request is not answered: the connection hangs until the client gives up or the
+# fault is over, which is what a lost packet or a dead uplink looks like to the client
+
+
+class Faults:
+
+    MAX_HANG_SEC = 30
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, drop_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.drop_rate = drop_rate
+        self.down_since = None
+        self.flap_period_sec = None
+        self.flap_down_sec = 0
+        self.flap_started = 0.0
+
+    def go_down(self):
+        self.down_since = time.monotonic()
+
+    def go_up(self):
+        self.down_since = None
+
+    def flap(self, period_sec: Optional[float], down_sec: float = 0):
+        # the service is down for <down_sec> at the beginning of each period
+        self.flap_period_sec = period_sec
+        self.flap_down_sec = down_sec
+        self.flap_started = time.monotonic()
+
+    def is_down(self) -> bool:
+        if self.down_since is not None:
+            return True
+        if self.flap_period_sec is not None:
+            return (time.monotonic() - self.flap_started) % self.flap_period_sec < self.flap_down_sec
+        return False
+
+    def delay(self):
+        if self.latency_ms > 0 or self.jitter_ms > 0:
+            time.sleep(max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def should_answer(self) -> bool:
+        # blocks while the service is down. Returns False, if the request has to be dropped
+        if self.drop_rate > 0 and random.random() < self.drop_rate:
+            time.sleep(Faults.MAX_HANG_SEC)
+            return False
+        hang_until = time.monotonic() + Faults.MAX_HANG_SEC
+        while self.is_down():
+            if time.monotonic() > hang_until:
+                return False
+            time.sleep(0.01)
+        self.delay()
+        return True
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeService:
+
+    def __init__(self, handler_class, faults: Faults = None, port: int = 0):
+        self.faults = Faults() if faults is None else faults
+        self.num_requests = 0
+        handler = type(handler_class.__name__, (handler_class,), {'service': self})
+        self.server = _Server(("127.0.0.1", port), handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:" + str(self.port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _BaseHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def answer(self, status: int, body: bytes = b"", content_type: str = 'text/plain'):
+        self.service.num_requests += 1
+        if not self.service.faults.should_answer():
+            self.close_connection = True
+            return
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+        except ConnectionError:
+            # the client has given up
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TargetHandler(_BaseHandler):
+
+    # connectivity test target. /generate_204 answers 204, everything else 200
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path.startswith('/generate_204'):
+            self.answer(204)
+        else:
+            self.answer(200, b"<html><body>ok</body></html>", 'text/html')
+
+
+def fake_target(faults: Faults = None) -> FakeService:
+    return FakeService(_TargetHandler, faults).start()
+
+
+class _IpEchoHandler(_BaseHandler):
+
+    # stand-in of whatismyip.akamai.com (GET /) and of a RDAP server (GET /ip/<address>)
+    ip_address = "93.184.216.34"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/ip/'):
+            address = path[len('/ip/'):]
+            # every address is announced within a /24 prefix
+            prefix = str(ipaddress.ip_network(address + "/24", strict=False))
+            self.answer(200, json.dumps({'handle': address, 'asn_description': 'EXAMPLE-AS, US', 'asn_cidr': prefix}).encode(), 'application/rdap+json')
+        else:
+            self.answer(200, self.ip_address.encode())
+
+
+def fake_ip_echo(faults: Faults = None) -> FakeService:
+    return FakeService(_IpEchoHandler, faults).start()
+
+
+class _SpeedtestHandler(_BaseHandler):
+
+    # stand-in of a speedtest.net server as used by speedtest-cli (latency.txt, random<size>x<size>.jpg, upload.php)
+    BLOB = b"x" * (1024 * 1024)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith('latency.txt'):
+            self.answer(200, b"test=test")
+        else:
+            self.answer(200, self.BLOB)
+
+    def do_POST(self):
+        num_bytes = int(self.headers.get('Content-Length', '0'))
+        self.rfile.read(num_bytes)
+        self.answer(200, ("size=" + str(num_bytes)).encode())
+
+
+def fake_speedtest_server(faults: Faults = None) -> FakeService:
+    return FakeService(_SpeedtestHandler, faults).start()
+
+
+def speedtest_server_cache_data(service: FakeService) -> Dict:
+    # content of a speedtest server cache file pointing to the fake speedtest server
+    config = {'client': {'ip': '93.184.216.34', 'lat': '50', 'lon': '8', 'isp': 'fake', 'rating': '0', 'ispdlavg': '0', 'ispulavg': '0', 'loggedin': '0', 'country': 'DE'},
+              'ignore_servers': [],
+              'sizes': {'upload': [32768, 65536], 'download': [350, 500]},
+              'counts': {'upload': 2, 'download': 2},
+              'threads': {'upload': 2, 'download': 2},
+              'length': {'upload': 5, 'download': 5},
+              'upload_max': 4}
+    best = {'url': service.url + '/speedtest/upload.php', 'name': 'Local', 'sponsor': 'Fake', 'id': '1', 'host': '127.0.0.1:' + str(service.port),
+            'd': 1.0, 'country': 'DE', 'cc': 'DE', 'lat': '50', 'lon': '8'}
+    return {'config': config, 'best': best, 'time': time.time()}
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeRdapIPWhois:
+
+    # replaces ipwhois.IPWhois. The ASN/RDAP lookup of ipwhois queries several internet services (DNS, whois,
+    # RDAP bootstrap). The replacement performs a single RDAP request against the fake ip echo service instead
+    rdap_url = None
+
+    def __init__(self, address: str):
+        self.address = address
+
+    def lookup_rdap(self, *args, **kwargs) -> Dict:
+        import requests
+        response = requests.get(FakeRdapIPWhois.rdap_url + "/ip/" + self.address, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+
+def use_fake_rdap(service: FakeService):
+    import ipwhois
+    FakeRdapIPWhois.rdap_url = service.url
+    ipwhois.IPWhois = FakeRdapIPWhois
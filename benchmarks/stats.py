@@ -0,0 +1,33 @@
+from typing import Dict, List
+import math
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 0:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {'count': len(values),
+            'avg': sum(values) / len(values) if len(values) > 0 else math.nan,
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': max(values) if len(values) > 0 else math.nan}
+
+
+def print_result(title: str, result: Dict):
+    print(title)
+    for name, value in result.items():
+        if isinstance(value, dict):
+            print("  " + name + ": " + ", ".join([key + "=" + _format(val) for key, val in value.items()]))
+        else:
+            print("  " + name + ": " + _format(value))
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return str(round(value, 3))
+    return str(value)
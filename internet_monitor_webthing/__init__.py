@@ -1,10 +1,19 @@
 from internet_monitor_webthing.internet_multiple_webthing import run_server
+from internet_monitor_webthing.hub_webthing import run_hub
+from internet_monitor_webthing.hub_store import HubStore
 from internet_monitor_webthing.app import App
+from internet_monitor_webthing.probes import PROBE_METHODS
+from internet_monitor_webthing.speed_engines import SPEED_ENGINES
+from internet_monitor_webthing.ip_address_resolver import IP_ADDRESS_SOURCES
+from internet_monitor_webthing.record_log import SYNC_POLICY
 from string import Template
+import os
 
 PACKAGENAME = 'internet_monitor_webthing'
 ENTRY_POINT = "netmonitor"
 DESCRIPTION = "A web connected local internet speed and connectivity monitor"
+# the hub token is passed by the environment (the environment file of a registered unit), not by the command line
+HUB_TOKEN_ENV = "NETMONITOR_HUB_TOKEN"
 
 
 UNIT_TEMPLATE = Template('''
@@ -15,7 +24,29 @@ Wants=network-online.target
 
 [Service]
 Type=simple
-ExecStart=$entrypoint --command listen --port $port --verbose $verbose --speedtest_period $speedtest_period --connecttest_period $connecttest_period --connecttest_url $connecttest_url
+EnvironmentFile=-$environment_file
+ExecStart=$entrypoint --command listen --port $port --verbose $verbose --speedtest_period $speedtest_period --speedtest_busy_threshold $speedtest_busy_threshold --speedtest_engine $speedtest_engine --speedtest_url '$speedtest_url' --speedtest_streams $speedtest_streams --speedtest_duration $speedtest_duration --connecttest_period $connecttest_period --connecttest_url $connecttest_url --connecttest_quorum $connecttest_quorum --connecttest_method $connecttest_method --latency_target $latency_target --latency_period $latency_period --ip_address_sources $ip_address_sources --wans '$wans' --hub_url '$hub_url' --site '$site' --log_sync $log_sync
+SyslogIdentifier=$packagename
+StandardOutput=syslog
+StandardError=syslog
+Restart=always
+RestartSec=3
+
+[Install]
+WantedBy=multi-user.target
+''')
+
+
+HUB_UNIT_TEMPLATE = Template('''
+[Unit]
+Description=$packagename hub
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=simple
+EnvironmentFile=-$environment_file
+ExecStart=$entrypoint --command hub --port $port --verbose $verbose --hub_stale_period $hub_stale_period --log_sync $log_sync
 SyslogIdentifier=$packagename
 StandardOutput=syslog
 StandardError=syslog
@@ -32,20 +63,45 @@ class InternetApp(App):
 
     def do_add_argument(self, parser):
         parser.add_argument('--speedtest_period', metavar='speedtest_period', required=False, type=int, default=0, help='the speedtest period in sec')
+        parser.add_argument('--speedtest_busy_threshold', metavar='speedtest_busy_threshold', required=False, type=float, default=0, help='periodic speedtests are deferred (max 1 hour) while the traffic of the monitored interface of this host exceeds this threshold in Mbit/sec (default 0 = never deferred). It covers other lan clients only if this host is the gateway')
+        parser.add_argument('--speedtest_engine', metavar='speedtest_engine', required=False, type=str, default='speedtest', choices=SPEED_ENGINES, help='the engine to perform the speedtest. Supported engines are: speedtest (speedtest.net by using speedtest-cli), http (parallel http streams against the self-hosted --speedtest_url endpoint)')
+        parser.add_argument('--speedtest_url', metavar='speedtest_url', required=False, type=str, default="", help='the url of the throughput test endpoint used by the http engine, e.g. http://192.168.0.10:8088 (see python -m internet_monitor_webthing.throughput_server)')
+        parser.add_argument('--speedtest_streams', metavar='speedtest_streams', required=False, type=int, default=4, help='the number of parallel streams used by the http engine')
+        parser.add_argument('--speedtest_duration', metavar='speedtest_duration', required=False, type=float, default=10, help='the duration in sec of the download and of the upload measurement used by the http engine')
         parser.add_argument('--connecttest_period', metavar='connecttest_period', required=False, type=int, default=0, help='the connecttest period in sec')
-        parser.add_argument('--connecttest_url', metavar='connecttest_url', required=False, type=str, default="http://google.com", help='the url to connect runnig the connect test')
+        parser.add_argument('--connecttest_url', metavar='connecttest_url', required=False, type=str, default="http://google.com", help='the url to connect runnig the connect test. Several comma separated urls (http://, https://, tcp://<host>:<port>, dns://[<nameserver>/]<name>) are probed concurrently')
+        parser.add_argument('--connecttest_quorum', metavar='connecttest_quorum', required=False, type=int, default=1, help='the number of connect test urls which have to be reachable to consider the internet as connected')
+        parser.add_argument('--connecttest_method', metavar='connecttest_method', required=False, type=str, default='head', choices=PROBE_METHODS, help='the method to probe http(s) connect test urls. Supported methods are: head (HEAD request using a keep-alive connection), get (full GET request), 204 (HEAD request expecting status 204), tcp (tcp handshake only)')
+        parser.add_argument('--latency_target', metavar='latency_target', required=False, type=str, default="1.1.1.1:443", help='the <host>:<port> to sample the latency. ICMP echo is used if permitted, otherwise the tcp connect time to the port is measured')
+        parser.add_argument('--latency_period', metavar='latency_period', required=False, type=float, default=5, help='the latency sample period in sec (0 deactivates latency sampling)')
+        parser.add_argument('--ip_address_sources', metavar='ip_address_sources', required=False, type=str, default=IP_ADDRESS_SOURCES, help='comma separated sources to resolve the public ip address, queried concurrently: upnp:// (the router), local:// (the default route interface, if connected without NAT), dns://<nameserver>/<name> (e.g. dns://208.67.222.222/myip.opendns.com) and http(s):// echo services')
+        parser.add_argument('--wans', metavar='wans', required=False, type=str, default="", help='comma separated <name>=<interface> of the wan connections to monitor, e.g. dsl=eth0,lte=wwan0. Each wan is exposed as a thing of its own and probed via its interface. If empty, the connection of the default route is monitored')
+        parser.add_argument('--hub_url', metavar='hub_url', required=False, type=str, default="", help='the url of the hub to push the connectivity and speed histories to, e.g. http://192.168.0.5:8434 (see --command hub)')
+        parser.add_argument('--site', metavar='site', required=False, type=str, default="", help='the name of this site reported to the hub (default: the host name)')
+        parser.add_argument('--hub_token', metavar='hub_token', required=False, type=str, default=os.environ.get(HUB_TOKEN_ENV, ""), help='the token the agents have to provide to push to the hub (empty = no token required). Defaults to the ' + HUB_TOKEN_ENV + ' environment variable. Registered units read it from their environment file')
+        parser.add_argument('--hub_stale_period', metavar='hub_stale_period', required=False, type=int, default=HubStore.STALE_SEC, help='the hub considers a site as unreachable, if its agent has not pushed for this period in sec')
+        parser.add_argument('--log_sync', metavar='log_sync', required=False, type=str, default=SYNC_POLICY, help='when the appended history records are synced to the disk: record (each record), shutdown (on shutdown only) or <milliseconds> (the records appended within this period are synced together)')
 
     def do_additional_listen_example_params(self):
         return "--speedtest_period 900 --connecttest_period 5 --connecttest_url http://google.com"
 
     def do_process_command(self, command:str, port: int, verbose: bool, args) -> bool:
-        if command == 'listen' and (args.speedtest_period > 0 or args.connecttest_period > 0):
-            run_server(port, self.description, args.speedtest_period, args.connecttest_period, args.connecttest_url)
+        environment = {HUB_TOKEN_ENV: args.hub_token}
+        if command == 'hub':
+            run_hub(port, self.description, args.hub_token, args.hub_stale_period, args.log_sync)
+            return True
+        elif command == 'listen' and (args.speedtest_period > 0 or args.connecttest_period > 0):
+            run_server(port, self.description, args.speedtest_period, args.connecttest_period, args.connecttest_url, args.connecttest_quorum, args.connecttest_method, args.latency_target, args.latency_period, args.speedtest_busy_threshold, args.speedtest_engine, args.speedtest_url, args.speedtest_streams, args.speedtest_duration, args.ip_address_sources, args.wans, args.hub_url, args.site, args.hub_token, args.log_sync)
             return True
         elif args.command == 'register' and (args.speedtest_period > 0 or args.connecttest_period > 0):
             print("register " + self.packagename + " on port " + str(args.port) + " with speedtest_period " + str(args.speedtest_period) + "sec and connecttest_period " + str(args.connecttest_period) + "sec")
-            unit = UNIT_TEMPLATE.substitute(packagename=self.packagename, entrypoint=self.entrypoint, port=port, verbose=verbose, speedtest_period=args.speedtest_period, connecttest_period=args.connecttest_period, connecttest_url=args.connecttest_url)
-            self.unit.register(port, unit)
+            unit = UNIT_TEMPLATE.substitute(packagename=self.packagename, entrypoint=self.entrypoint, port=port, verbose=verbose, speedtest_period=args.speedtest_period, speedtest_busy_threshold=args.speedtest_busy_threshold, speedtest_engine=args.speedtest_engine, speedtest_url=args.speedtest_url, speedtest_streams=args.speedtest_streams, speedtest_duration=args.speedtest_duration, connecttest_period=args.connecttest_period, connecttest_url=args.connecttest_url, connecttest_quorum=args.connecttest_quorum, connecttest_method=args.connecttest_method, latency_target=args.latency_target, latency_period=args.latency_period, ip_address_sources=args.ip_address_sources, wans=args.wans, hub_url=args.hub_url, site=args.site, log_sync=args.log_sync, environment_file=self.unit.environment_filename(port))
+            self.unit.register(port, unit, environment)
+            return True
+        elif args.command == 'register_hub':
+            print("register " + self.packagename + " hub on port " + str(args.port))
+            unit = HUB_UNIT_TEMPLATE.substitute(packagename=self.packagename, entrypoint=self.entrypoint, port=port, verbose=verbose, hub_stale_period=args.hub_stale_period, log_sync=args.log_sync, environment_file=self.unit.environment_filename(port))
+            self.unit.register(port, unit, environment)
             return True
         else:
             return False
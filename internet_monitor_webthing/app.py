@@ -1,6 +1,8 @@
 from os import system, remove
 from os import listdir
 from abc import ABC
+from typing import Dict
+import os
 import pathlib
 import logging
 import subprocess
@@ -46,7 +48,7 @@ class App(ABC):
 
     def handle_command(self):
         parser = argparse.ArgumentParser(description=self.description)
-        parser.add_argument('--command', metavar='command', required=False, type=str, help='the command. Supported commands are: listen (run the webthing service), register (register and starts the webthing service as a systemd unit, deregister (deregisters the systemd unit), log (prints the log)')
+        parser.add_argument('--command', metavar='command', required=False, type=str, help='the command. Supported commands are: listen (run the webthing service), register (register and starts the webthing service as a systemd unit, deregister (deregisters the systemd unit), log (prints the log), hub (run the hub aggregating the histories of the monitors), register_hub (register and starts the hub as a systemd unit)')
         parser.add_argument('--port', metavar='port', required=False, type=int, help='the port of the webthing serivce')
         parser.add_argument('--verbose', metavar='verbose', required=False, type=bool, default=False, help='activates verbose output')
         self.do_add_argument(parser)
@@ -98,9 +100,16 @@ class Unit:
         print("Warning: " + service + " is not running")
         system("sudo journalctl -n 20 -u " + service)
 
-    def register(self, port: int, unit: str):
+    def register(self, port: int, unit: str, environment: Dict[str, str] = None):
+        # secrets are passed by the environment file (readable by root only) instead of the world-readable unit file
         service = self.servicename(port)
         unit_file_fullname = str(pathlib.Path("/", "etc", "systemd", "system", service))
+        if environment is not None:
+            fd = os.open(self.environment_filename(port), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as file:
+                for name, value in environment.items():
+                    file.write(name + '="' + value.replace('\\', '\\\\').replace('"', '\\"') + '"\n')
         with open(unit_file_fullname, "w") as file:
             file.write(unit)
         system("sudo systemctl daemon-reload")
@@ -114,10 +123,11 @@ class Unit:
         system("sudo systemctl stop " + service)
         system("sudo systemctl disable " + service)
         system("sudo systemctl daemon-reload")
-        try:
-            remove(unit_file_fullname)
-        except Exception as e:
-            pass
+        for filename in [unit_file_fullname, self.environment_filename(port)]:
+            try:
+                remove(filename)
+            except Exception as e:
+                pass
 
     def printlog(self, port:int):
         print("sudo journalctl -n 1000 -u " + self.servicename(port))
@@ -128,6 +138,9 @@ class Unit:
     def servicename(self, port: int):
         return self.packagename + "_" + str(port) + ".service"
 
+    def environment_filename(self, port: int):
+        return str(pathlib.Path("/", "etc", "default", self.packagename + "_" + str(port)))
+
     def list_installed(self):
         services = []
         try:
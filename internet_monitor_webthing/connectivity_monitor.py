@@ -1,61 +1,359 @@
 from datetime import datetime
-from dataclasses import dataclass
-from typing import List, Dict, Optional
-import ipwhois
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Iterator, Tuple
+from internet_monitor_webthing.record_log import RecordLog, SYNC_POLICY, SYNC_SHUTDOWN, fsync_dir
+from internet_monitor_webthing.probes import create_probe
+from internet_monitor_webthing.probe_scheduler import AdaptiveProbeScheduler, StaggeredStart
+from internet_monitor_webthing.metrics import REGISTRY, STORE_WRITE_SECONDS
+from internet_monitor_webthing.profiling import span, record_span
+from internet_monitor_webthing.ip_info import IpInfo
+from internet_monitor_webthing.outage_analytics import OutageAnalytics
+from internet_monitor_webthing.ip_address_resolver import IpAddressResolver, local_address
+from internet_monitor_webthing.interface_binding import InterfaceBinding
+from tornado.ioloop import IOLoop
 import logging
 import time
-import requests
-import threading
+import asyncio
+import socket
+import math
 import os
 import pickle
+import json
+import zlib
+import struct
+
+PROBE_LATENCY_SECONDS = REGISTRY.histogram('netmonitor_probe_latency_seconds', 'Latency of successful connection test probes', ['target'])
+PROBE_FAILURES = REGISTRY.counter('netmonitor_probe_failures_total', 'Failed connection test probes', ['target'])
+PROBE_CYCLE_SECONDS = REGISTRY.histogram('netmonitor_probe_cycle_duration_seconds', 'Duration of a connection test cycle including the ip address resolution')
+
+
+@dataclass()
+class PathInfo:
+    # the state of an ip version (ipv4 or ipv6)
+    is_connected: bool
+    ip_address: str = ""
+    ip_info: Dict[str, str] = field(default_factory=lambda: dict(IpInfo.EMPTY_INFO))
+    latency_ms: Optional[float] = None
+
 
 @dataclass()
 class ConnectionInfo:
+    # the internet is connected, if any ip version is connected. The ip address and the ip info are the ones of
+    # the connected ip version (ipv4 preferred). The paths are None, if the ip version is not monitored
     date: datetime
     is_connected: bool
     ip_address: str
     ip_info: Dict[str, str]
+    # the state change happened after the previous state has been observed the last time and before the new
+    # state has been observed the first time
+    change_after: Optional[datetime] = None
+    change_before: Optional[datetime] = None
+    ipv4: Optional[PathInfo] = None
+    ipv6: Optional[PathInfo] = None
+    # the previous state has not been observed until the change (e.g. the monitor has not been running). The change
+    # may have happened at any time between change_after and change_before
+    unobserved: bool = False
+
+    @staticmethod
+    def of_paths(date: datetime, ipv4: Optional[PathInfo], ipv6: Optional[PathInfo]):
+        for path in [ipv4, ipv6]:
+            if path is not None and path.is_connected:
+                return ConnectionInfo(date, True, path.ip_address, path.ip_info, ipv4=ipv4, ipv6=ipv6)
+        return ConnectionInfo(date, False, "", dict(IpInfo.EMPTY_INFO), ipv4=ipv4, ipv6=ipv6)
+
+    @property
+    def paths(self) -> Dict[int, PathInfo]:
+        # the monitored ip versions
+        return {version: path for version, path in [(4, self.ipv4), (6, self.ipv6)] if path is not None}
+
+    def is_changed(self, other) -> bool:
+        # the connectivity state or the ip address of the internet connection or of an ip version has changed
+        def state(path: Optional[PathInfo]):
+            return None if path is None else (path.is_connected, path.ip_address)
+        return self.is_connected != other.is_connected or \
+               self.ip_address != other.ip_address or \
+               state(self.ipv4) != state(other.ipv4) or \
+               state(self.ipv6) != state(other.ipv6)
+
+    @property
+    def estimated_date(self) -> datetime:
+        # interpolated date of the state change. An unobserved change is dated when it has been observed. The midpoint
+        # would split a gap of unknown state (such as days of downtime of the monitor) between both states
+        if self.change_after is None or self.change_before is None:
+            return self.date
+        elif self.unobserved:
+            return self.change_before
+        else:
+            return self.change_after + (self.change_before - self.change_after) / 2
+
+    @property
+    def precision_sec(self) -> float:
+        if self.change_after is None or self.change_before is None:
+            return 0
+        elif self.unobserved:
+            return (self.change_before - self.change_after).total_seconds()
+        else:
+            return (self.change_before - self.change_after).total_seconds() / 2
 
     def __str__(self):
         return self.date.strftime("%Y-%m-%d %H:%M:%S") + " " + str(self.is_connected)
 
 
+@dataclass
+class ProbeStatistics:
+    latencies: Dict[str, Optional[float]]
+    num_bytes: int          # payload bytes transferred by the previous probe cycle
+    total_bytes: int
+    cpu_ms: float           # cpu time consumed by the previous probe cycle
+
+
 class ConnectionLog:
 
-    def __init__(self, filename:str = None):
+    # record layout: timestamp, connected flag, ip address, asn (, change after timestamp, change before timestamp)
+    # (, ipv4 state, ipv4 latency, ipv6 state, ipv6 latency, ipv6 address, ipv6 asn) (, flags). The ipv4 address and
+    # asn are the ip address and asn of the record, if ipv4 is connected. Path states: -1 not monitored,
+    # 0 disconnected, 1 connected. Latencies: NaN, if unknown
+    RECORDS = {1: struct.Struct('<d?46s64s'),
+               2: struct.Struct('<d?46s64sdd'),
+               3: struct.Struct('<d?46s64sddbfbf46s64s'),
+               4: struct.Struct('<d?46s64sddbfbf46s64sB')}
+    RECORD_VERSION = 4
+    FLAG_UNOBSERVED = 1
+    RECORD = RECORDS[RECORD_VERSION]
+    TIMESTAMP = struct.Struct('<d')
+    # the analytics are checkpointed each CHECKPOINT_ENTRIES appends and on close
+    CHECKPOINT_ENTRIES = 1000
+
+    def __init__(self, filename:str = None, max_entries: int = None, sync: str = SYNC_POLICY):
         if filename is None:
             dir = os.path.join("var", "lib", "netmonitor")
             os.makedirs(dir, exist_ok=True)
-            self.filename = os.path.join(dir, "log.p")
+            self.filename = os.path.join(dir, "log.bin")
         else:
             self.filename = filename
+        self.max_entries = max_entries
+
+        # the legacy file is renamed once it has been migrated. A failed migration is retried on the next start
+        legacy_filename = os.path.splitext(self.filename)[0] + ".p"
+        if os.path.exists(legacy_filename):
+            self.__migrate(legacy_filename)
+        self.log = RecordLog(self.filename, ConnectionLog.RECORD.size, ConnectionLog.RECORD_VERSION, sync)
+        if self.log.version != ConnectionLog.RECORD_VERSION:
+            self.__upgrade()
+        # the date of the last change of the history (Last-Modified of the history resource)
+        self.modified = datetime.fromtimestamp(os.path.getmtime(self.filename)) if os.path.exists(self.filename) else datetime.now()
+        # the analytics are restored from the checkpoint and the entries appended after it are replayed. Without a
+        # (valid) checkpoint the whole history is replayed. Afterwards, they are updated on each append
+        self.checkpoint_filename = os.path.splitext(self.filename)[0] + ".analytics.json"
+        self.analytics, num_analyzed = self.__load_checkpoint()
+        for record in self.log.records(num_analyzed):
+            self.__analyze(self.__decode(record))
+        self.checkpointed = num_analyzed
+        if len(self.log) - num_analyzed >= ConnectionLog.CHECKPOINT_ENTRIES:
+            self.checkpoint()
+        logging.info("log file " + self.filename + " opened. " + str(len(self.log)) + " entries found")
+
+    def __analyze(self, connection_info: ConnectionInfo):
+        self.analytics.add(connection_info.estimated_date, connection_info.is_connected, connection_info.ip_info.get('asn', ''))
+
+    def __load_checkpoint(self) -> Tuple[OutageAnalytics, int]:
+        # returns the analytics and the number of entries they cover. The checkpoint is valid, if the log still
+        # contains the last covered entry at the same index (the log may have been truncated, compacted or replaced)
+        try:
+            with open(self.checkpoint_filename, "r") as file:
+                checkpoint = json.load(file)
+            num_entries = int(checkpoint['entries'])
+            if num_entries > len(self.log) or (num_entries > 0 and zlib.crc32(self.log.get(num_entries - 1)) != checkpoint['last_crc']):
+                logging.info("analytics checkpoint " + self.checkpoint_filename + " does not match the log. Replaying the history")
+            else:
+                return OutageAnalytics.of_state(checkpoint['analytics']), num_entries
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred loading analytics checkpoint " + self.checkpoint_filename + " " + str(e) + ". Replaying the history")
+        return OutageAnalytics(), 0
+
+    def checkpoint(self):
+        # the checkpoint is a cache of the analytics. It is not synced: a lost or outdated checkpoint is detected on
+        # open and the history is replayed
+        try:
+            num_entries = len(self.log)
+            checkpoint = {'entries': num_entries,
+                          'last_crc': zlib.crc32(self.log.get(num_entries - 1)) if num_entries > 0 else 0,
+                          'analytics': self.analytics.state()}
+            tempfile = self.checkpoint_filename + ".tmp"
+            with open(tempfile, "w") as file:
+                json.dump(checkpoint, file)
+            os.replace(tempfile, self.checkpoint_filename)
+            self.checkpointed = num_entries
+        except Exception as e:
+            logging.error("error occurred storing analytics checkpoint " + self.checkpoint_filename + " " + str(e))
 
+    def __migrate(self, legacy_filename: str):
+        # the entries are written to a temp log which replaces the log file, if all entries have been migrated.
+        # Entries of a log file written after a failed migration are newer than the legacy ones and are appended
+        tempfile = self.filename + ".migrating"
         try:
-            with open(self.filename, "rb") as file:
-                self.entries = pickle.load(file)
-                logging.info("log file " + self.filename + " read. " + str(len(self.entries)) +  " entries found")
+            with open(legacy_filename, "rb") as file:
+                legacy_entries = pickle.load(file)
+            if os.path.exists(tempfile):
+                os.remove(tempfile)
+            log = RecordLog(tempfile, ConnectionLog.RECORD.size, ConnectionLog.RECORD_VERSION, SYNC_SHUTDOWN)
+            for entry in legacy_entries:
+                if entry.ipv4 is None and entry.ipv6 is None:
+                    entry.ipv4 = self.__legacy_path(entry)
+                log.append(self.__encode(entry))
+            if os.path.exists(self.filename):
+                current = RecordLog(self.filename, ConnectionLog.RECORD.size, ConnectionLog.RECORD_VERSION, SYNC_SHUTDOWN)
+                for record in current.records():
+                    log.append(self.__encode(self.__decode(record, current.version)))
+                current.close()
+            log.close()
+            os.replace(tempfile, self.filename)
+            fsync_dir(self.filename)
+            os.rename(legacy_filename, legacy_filename + ".migrated")
+            logging.info("legacy log file " + legacy_filename + " migrated. " + str(len(legacy_entries)) + " entries imported")
         except Exception as e:
-            self.entries = list()
+            logging.error("error occurred migrating legacy log file " + legacy_filename + " " + str(e))
+            if os.path.exists(tempfile):
+                os.remove(tempfile)
+
+    @staticmethod
+    def __legacy_path(connection_info: ConnectionInfo) -> PathInfo:
+        # legacy entries (pickled ones and record versions 1 and 2) cover ipv4 only
+        return PathInfo(connection_info.is_connected, connection_info.ip_address, connection_info.ip_info)
+
+    def __upgrade(self):
+        version = self.log.version
+        entries = [self.__decode(record, version) for record in self.log.records()]
+        self.log.rewrite([self.__encode(entry) for entry in entries], ConnectionLog.RECORD.size, ConnectionLog.RECORD_VERSION)
+        logging.info("log file " + self.filename + " upgraded from record version " + str(version) + " to " + str(ConnectionLog.RECORD_VERSION))
+
+    @staticmethod
+    def __encode(connection_info: ConnectionInfo) -> bytes:
+        ipv4 = connection_info.ipv4
+        ipv6 = connection_info.ipv6
+        return ConnectionLog.RECORD.pack(connection_info.date.timestamp(),
+                                         connection_info.is_connected,
+                                         connection_info.ip_address.encode('utf-8'),
+                                         connection_info.ip_info.get('asn', '').encode('utf-8'),
+                                         0 if connection_info.change_after is None else connection_info.change_after.timestamp(),
+                                         0 if connection_info.change_before is None else connection_info.change_before.timestamp(),
+                                         -1 if ipv4 is None else int(ipv4.is_connected),
+                                         math.nan if ipv4 is None or ipv4.latency_ms is None else ipv4.latency_ms,
+                                         -1 if ipv6 is None else int(ipv6.is_connected),
+                                         math.nan if ipv6 is None or ipv6.latency_ms is None else ipv6.latency_ms,
+                                         b'' if ipv6 is None else ipv6.ip_address.encode('utf-8'),
+                                         b'' if ipv6 is None else ipv6.ip_info.get('asn', '').encode('utf-8'),
+                                         ConnectionLog.FLAG_UNOBSERVED if connection_info.unobserved else 0)
+
+    @staticmethod
+    def __decode(record: bytes, version: int = RECORD_VERSION) -> ConnectionInfo:
+        fields = ConnectionLog.RECORDS[version].unpack(record)
+        timestamp, is_connected, ip_address, asn = fields[:4]
+        info = ConnectionInfo(datetime.fromtimestamp(timestamp),
+                              is_connected,
+                              ip_address.rstrip(b'\0').decode('utf-8', errors='ignore'),
+                              {'asn': asn.rstrip(b'\0').decode('utf-8', errors='ignore')})
+        if version >= 2 and fields[4] > 0:
+            info.change_after = datetime.fromtimestamp(fields[4])
+            info.change_before = datetime.fromtimestamp(fields[5])
+        if version >= 3:
+            ipv4_state, ipv4_latency, ipv6_state, ipv6_latency, ipv6_address, ipv6_asn = fields[6:12]
+            if ipv4_state >= 0:
+                info.ipv4 = PathInfo(ipv4_state == 1, info.ip_address if ipv4_state == 1 else "", info.ip_info if ipv4_state == 1 else dict(IpInfo.EMPTY_INFO),
+                                     None if math.isnan(ipv4_latency) else round(ipv4_latency, 1))
+            if ipv6_state >= 0:
+                info.ipv6 = PathInfo(ipv6_state == 1, ipv6_address.rstrip(b'\0').decode('utf-8', errors='ignore'), {'asn': ipv6_asn.rstrip(b'\0').decode('utf-8', errors='ignore')},
+                                     None if math.isnan(ipv6_latency) else round(ipv6_latency, 1))
+        else:
+            info.ipv4 = ConnectionLog.__legacy_path(info)
+        if version >= 4:
+            info.unobserved = fields[12] & ConnectionLog.FLAG_UNOBSERVED != 0
+        return info
 
+    def __len__(self):
+        return len(self.log)
 
     def append(self, connection_info : ConnectionInfo):
-        if len(self.entries) > 200:
-            del self.entries[0]
-        self.entries.append(connection_info)
-        self.__store()
-
-    def __store(self):
         try:
-            with open(self.filename, "wb") as file:
-                pickle.dump(self.entries, file)
+            newest = self.newest()
+            if newest is not None and connection_info.date < newest.date:
+                # entries have to be ordered by time to support range queries (system clock has been set back?)
+                logging.warning("entry date " + connection_info.date.isoformat() + " is older than newest entry date " + newest.date.isoformat() + ". Using newest entry date")
+                connection_info.date = newest.date
+            started = time.perf_counter()
+            with span('connectivity', 'store'):
+                self.log.append(self.__encode(connection_info))
+            STORE_WRITE_SECONDS.labels('connection_log').observe(time.perf_counter() - started)
+            self.modified = datetime.now()
+            self.__analyze(connection_info)
+            if self.max_entries is not None and len(self.log) > self.max_entries * 1.25:
+                self.compact()
+            elif len(self.log) - self.checkpointed >= ConnectionLog.CHECKPOINT_ENTRIES:
+                self.checkpoint()
         except Exception as e:
             logging.error(e)
 
+    def sync(self):
+        self.log.sync()
+
+    def close(self):
+        if len(self.log) != self.checkpointed:
+            self.checkpoint()
+        self.log.close()
+
+    def compact(self):
+        # drop the oldest entries by rewriting the newest ones only
+        num_dropped = max(0, len(self.log) - self.max_entries)
+        self.log.rewrite(self.log.records(num_dropped), ConnectionLog.RECORD.size, ConnectionLog.RECORD_VERSION)
+        self.modified = datetime.now()
+        # the analytics cover the dropped entries. The index of the checkpoint is shifted
+        self.checkpoint()
+        logging.info("log file " + self.filename + " compacted. " + str(num_dropped) + " entries dropped")
+
+    def entries(self) -> Iterator[ConnectionInfo]:
+        for record in self.log.records():
+            yield self.__decode(record)
+
+    def __timestamp(self, idx: int) -> float:
+        return ConnectionLog.TIMESTAMP.unpack_from(self.log.get(idx))[0]
+
+    def __bisect(self, timestamp: float) -> int:
+        # returns the index of the first entry which is not older than the given timestamp
+        low = 0
+        high = len(self.log)
+        while low < high:
+            mid = (low + high) // 2
+            if self.__timestamp(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def range(self, start: datetime, end: datetime, limit: int = None) -> List[ConnectionInfo]:
+        start_idx = self.__bisect(start.timestamp())
+        end_idx = self.__bisect(end.timestamp() + 0.000001)
+        if limit is not None:
+            end_idx = min(end_idx, start_idx + limit)
+        return [self.__decode(record) for record in self.log.records(start_idx, end_idx)]
+
     def newest(self) -> Optional[ConnectionInfo]:
-        if len(self.entries) > 0:
-            return self.entries[-1]
+        record = self.log.last()
+        if record is None:
+            return None
         else:
+            return self.__decode(record)
+
+    def oldest(self) -> Optional[ConnectionInfo]:
+        if len(self.log) == 0:
             return None
+        else:
+            return self.__decode(self.log.get(0))
+
+    def slice(self, start_idx: int, end_idx: int = None) -> List[ConnectionInfo]:
+        # the entries addressed by index (e.g. to replay the entries which have not been pushed to the hub yet)
+        return [self.__decode(record) for record in self.log.records(start_idx, end_idx)]
 
     def print_duration(self, duration: int):
         if duration > (60 * 60):
@@ -69,144 +367,235 @@ class ConnectionLog:
         report = list()
 
         previous_entry = None
-        for entry in self.entries:
+        for entry in self.entries():
             try:
                 status = "connected" if entry.is_connected else "disconnected"
                 detail = ""
                 if previous_entry is not None:
-                    elapsed_sec = int((entry.date - previous_entry.date).total_seconds())
+                    elapsed_sec = (entry.estimated_date - previous_entry.estimated_date).total_seconds()
                     if entry.is_connected and not previous_entry.is_connected:
-                        detail = "reconnected after " + self.print_duration(elapsed_sec)
+                        detail = "reconnected after " + self.print_duration(elapsed_sec) + " (+/- " + "{0:.1f}".format(entry.precision_sec + previous_entry.precision_sec) + " sec)"
                     elif len(entry.ip_address) > 0 and len(previous_entry.ip_address) > 0 and entry.ip_address != previous_entry.ip_address:
                         detail = "ip address updated"
                 report.append(entry.date.strftime("%Y-%m-%d %H:%M:%S") + ", " + status + ", " + entry.ip_address + ", " + entry.ip_info['asn'] + ", " + detail)
                 previous_entry = entry
             except Exception as e:
-                print(e)
+                logging.warning("error occurred reporting entry " + str(entry) + " " + str(e))
         return report
 
 
-class IpAddressResolver:
+class ConnectionPath:
 
-    def __init__(self):
-        self.cache_ip_address = ""
-        self.cache_reset_time = datetime.now()
-        self.entry_cached_time = datetime.fromtimestamp(555)
+    # the probes and the public ip address resolution of an ip version (and of an interface, if bound)
+    def __init__(self, family: int, test_uris: List[str], probe_method: str, quorum: int, ip_address_sources: List[str] = None, binding: Optional[InterfaceBinding] = None):
+        self.family = family
+        self.version = 6 if family == socket.AF_INET6 else 4
+        self.binding = binding
+        self.probes = [probe for probe in [create_probe(test_uri, probe_method, family, binding) for test_uri in test_uris] if probe is not None]
+        self.quorum = max(1, min(quorum, len(self.probes)))
+        self.address_resolver = IpAddressResolver(ip_address_sources, family, binding=binding)
+        self.cycle_failures = 0
 
-    def clear_cache(self):
-        self.cache_reset_time = datetime.now()
-        self.entry_cached_time = datetime.fromtimestamp(555)
+    def is_available(self) -> bool:
+        # ipv6 is monitored only, if the host has an ipv6 default route (or the bound interface has an ipv6 address).
+        # ipv4 of a bound interface without address is measured as disconnected
+        return len(self.probes) > 0 and (self.family == socket.AF_INET or local_address(self.family, self.binding) != "")
 
-    def get_max_cache_time_sec(self):
-        duration_since_last_reset = (datetime.now() - self.cache_reset_time).seconds + 1
-        if duration_since_last_reset < 5 * 60:
-            return 10
-        elif duration_since_last_reset < 15 * 60:
-            return 30
-        elif duration_since_last_reset < 60 * 60:
-            return 60
-        else:
-            return 500  # ~8 min
-
-    def get_internet_address(self) -> str:
-        uri = 'http://whatismyip.akamai.com/'
-        try:
-            now = datetime.now()
-            cache_entry_age = now - self.entry_cached_time
-            if cache_entry_age.seconds > self.get_max_cache_time_sec():
-                for i in range(0, 3):
-                    try:
-                        response = requests.get('http://whatismyip.akamai.com/', timeout=60)
-                        if (response.status_code >= 200) and (response.status_code < 300):
-                            self.cache_ip_address = response.text[:20]
-                            self.entry_cached_time = now
-                            logging.info('ip address resolved ' + self.cache_ip_address)
-                            break
-                    except Exception as e:
-                        logging.info('error occurred calling  ' + uri + ' ' + str(e))
-                        time.sleep(2)
-            return self.cache_ip_address
-        except Exception as e:
-            logging.info('error fetching ip address ' + str(e))
-            return ""
-
-
-class IpInfo:
-
-    EMPTY_INFO = { 'asn': '' }
-
-    def __init__(self):
-        self.cache= dict()
-        self.cached_invalidation_time = datetime.fromtimestamp(555)
-
-    def get_ip_info(self, ip: str) -> Dict[str, str]:
-        try:
-            if (datetime.now() - self.cached_invalidation_time).seconds > (5 * 24 * 60 * 60):
-                self.cache = dict()
-                self.cached_invalidation_time = datetime.now()
-                logging.info('ip info cache invalidated')
-            if ip not in self.cache.keys():
-                obj = ipwhois.IPWhois(ip)
-                rdap = obj.lookup_rdap()
-                asn = str(rdap['asn_description']).replace(",", " ")
-                self.cache[ip] = { 'asn': asn }
-                logging.info('ip info fetched ' + ip + ":" + str(self.cache[ip]))
-            return self.cache.get(ip, IpInfo.EMPTY_INFO)
-        except Exception as e:
-            return IpInfo.EMPTY_INFO
+    def stage(self, name: str) -> str:
+        return name if self.version == 4 else name + "_ipv6"
 
 
 class ConnectionTester:
 
-    def __init__(self, connection_log : ConnectionLog):
-        self.connection_log = connection_log
-        self.address_resolver = IpAddressResolver()
-        self.ip_info = IpInfo()
-
-    def listen(self, listener, measure_period_sec, test_uri: str = "http://google.com"):
-        threading.Thread(target=self.measure_periodically, args=(measure_period_sec, test_uri, listener), daemon=True).start()
+    # the max time a probe cycle waits for an uncached ip info. A slower lookup continues in the background
+    # and its result is reported to the ip info listener
+    IP_INFO_WAIT_SEC = 3
 
-    def measure(self, test_uri) -> ConnectionInfo:
+    # the binding restricts the tester to an interface (multi-WAN). The testers of several interfaces share the
+    # staggered start of the probe cycles and the ip info cache
+    def __init__(self, connection_log : ConnectionLog, test_uris: List[str] = None, quorum: int = 1, probe_method: str = 'head', ip_address_sources: List[str] = None,
+                 binding: Optional[InterfaceBinding] = None, stagger: Optional[StaggeredStart] = None, ip_info: Optional[IpInfo] = None):
+        self.connection_log = connection_log
+        test_uris = ["http://google.com"] if test_uris is None else test_uris
+        # ipv4 and ipv6 are probed separately
+        self.paths = [ConnectionPath(socket.AF_INET, test_uris, probe_method, quorum, ip_address_sources, binding),
+                      ConnectionPath(socket.AF_INET6, test_uris, probe_method, quorum, ip_address_sources, binding)]
+        self.stagger = stagger
+        self.probe_paths = {probe.name: path for path in self.paths for probe in path.probes}
+        self.latencies = {probe.name: None for path in self.paths for probe in path.probes}
+        self.cycle_bytes = 0
+        self.total_bytes = 0
+        self.ip_info = IpInfo() if ip_info is None else ip_info
+        self.ip_info_lookups = dict()   # ip address -> pending lookup
+        self.ip_info_listener = None
+        self.task = None
+
+    def listen(self, listener, measure_period_sec, probe_listener = None, ip_info_listener = None):
+        # the probe loop runs as coroutine on the (tornado) io loop. No dedicated thread is required
+        self.ip_info_listener = ip_info_listener
+        IOLoop.current().add_callback(self.__start, listener, measure_period_sec, probe_listener)
+
+    def __start(self, listener, measure_period_sec, probe_listener):
+        self.task = asyncio.ensure_future(self.measure_periodically(measure_period_sec, listener, probe_listener))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for path in self.paths:
+            path.address_resolver.close()
+
+    def clear_address_cache(self):
+        for path in self.paths:
+            path.address_resolver.clear_cache()
+
+    async def measure(self, timeout: float = 5, confirm_timeout: Optional[float] = 10) -> ConnectionInfo:
+        # the ip versions are measured concurrently (happy eyeballs like). Monitoring ipv6 does not increase the detection time
+        paths = [path for path in self.paths if path.is_available()]
+        path_infos = await asyncio.gather(*[self.__measure_path(path, timeout, confirm_timeout) for path in paths])
+        infos = {path.version: path_info for path, path_info in zip(paths, path_infos)}
+        return ConnectionInfo.of_paths(datetime.now(), infos.get(4), infos.get(6))
+
+    async def __measure_path(self, path: ConnectionPath, timeout: float, confirm_timeout: Optional[float]) -> PathInfo:
         # first trial
-        connected = self.is_connected(test_uri, 5)
-        if not connected:
-            self.address_resolver.clear_cache()
+        with span('connectivity', path.stage('probe')):
+            connected = await self.is_connected(timeout, path)
+        if not connected and confirm_timeout is not None:
+            path.address_resolver.clear_cache()
             # second trial
-            logging.info("first connect call failed. try second one")
-            connected = self.is_connected(test_uri, 10)
+            logging.info("first connect trial (ipv" + str(path.version) + ") failed. try second one")
+            with span('connectivity', path.stage('probe_confirm')):
+                connected = await self.is_connected(confirm_timeout, path)
         if connected:
-            ip_address = self.address_resolver.get_internet_address()
-            ip_info = self.ip_info.get_ip_info(ip_address)
-            return ConnectionInfo(datetime.now(), True, ip_address, ip_info)
+            with span('connectivity', path.stage('ip_address')):
+                ip_address = await path.address_resolver.get_internet_address(timeout)
+            with span('connectivity', path.stage('ip_info')):
+                ip_info = await self.__get_ip_info(ip_address)
+            latencies = [self.latencies[probe.name] for probe in path.probes if self.latencies.get(probe.name) is not None]
+            return PathInfo(True, ip_address, ip_info, min(latencies) if len(latencies) > 0 else None)
         else:
-            self.address_resolver.clear_cache()
-            return ConnectionInfo(datetime.now(), False, "", IpInfo.EMPTY_INFO)
-
-    def is_connected(self, test_uri, timeout: int) -> bool:
+            path.address_resolver.clear_cache()
+            return PathInfo(False)
+
+    async def __get_ip_info(self, ip_address: str) -> Dict[str, str]:
+        if ip_address == "":
+            return dict(IpInfo.EMPTY_INFO)
+        info, is_fresh = self.ip_info.get_cached(ip_address)
+        if info is not None:
+            if not is_fresh:
+                # stale infos are used while being refreshed in the background
+                self.__lookup_ip_info(ip_address)
+            return info
         try:
-            requests.get(test_uri, timeout=timeout) # test call
-            return True
-        except Exception as e:
-            logging.error("connect call " + test_uri + " failed", e)
-            return False
-
-    def measure_periodically(self, measure_period_sec: int, test_uri: str, listener):
+            return await asyncio.wait_for(asyncio.shield(self.__lookup_ip_info(ip_address)), ConnectionTester.IP_INFO_WAIT_SEC)
+        except asyncio.TimeoutError:
+            logging.info("ip info lookup of " + ip_address + " takes more than " + str(ConnectionTester.IP_INFO_WAIT_SEC) + " sec. continue in background")
+            return dict(IpInfo.EMPTY_INFO)
+
+    def __lookup_ip_info(self, ip_address: str) -> asyncio.Future:
+        # concurrent lookups of the same address share a single request
+        lookup = self.ip_info_lookups.get(ip_address, None)
+        if lookup is None:
+            lookup = asyncio.get_event_loop().run_in_executor(None, self.ip_info.lookup, ip_address)
+            lookup.add_done_callback(lambda future: self.__on_ip_info_looked_up(ip_address, future))
+            self.ip_info_lookups[ip_address] = lookup
+        return lookup
+
+    def __on_ip_info_looked_up(self, ip_address: str, future: asyncio.Future):
+        self.ip_info_lookups.pop(ip_address, None)
+        if not future.cancelled() and future.exception() is None and self.ip_info_listener is not None:
+            try:
+                self.ip_info_listener(ip_address, future.result())
+            except Exception as e:
+                logging.error("error occurred notifying ip info listener " + str(e))
+
+    async def is_connected(self, timeout: float, path: ConnectionPath = None) -> bool:
+        # all targets of the ip version (default: ipv4) are probed concurrently. The decision is made as soon as the
+        # quorum is reached (or can not be reached anymore). Slower probes keep running to update their latency
+        path = self.paths[0] if path is None else path
+        tasks = [asyncio.ensure_future(probe.check(timeout)) for probe in path.probes]
+        for task in tasks:
+            task.add_done_callback(self.__on_probe_done)
+        num_connected = 0
+        num_failed = 0
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            if result.is_connected:
+                num_connected += 1
+            else:
+                num_failed += 1
+            if num_connected >= path.quorum:
+                return True
+            elif num_failed > len(tasks) - path.quorum:
+                return False
+        return False
+
+    def __on_probe_done(self, task):
+        if not task.cancelled():
+            result = task.result()
+            self.latencies[result.target] = result.latency_ms
+            self.cycle_bytes += result.num_bytes
+            self.total_bytes += result.num_bytes
+            if result.is_connected:
+                PROBE_LATENCY_SECONDS.labels(result.target).observe(result.latency_ms / 1000)
+            else:
+                self.probe_paths[result.target].cycle_failures += 1
+                PROBE_FAILURES.labels(result.target).inc()
+
+    async def measure_periodically(self, measure_period_sec: int, listener, probe_listener = None):
         initial_log_entry = self.connection_log.newest()
-        logging.info("current state: " + str(self.connection_log.newest()))
+        logging.info("current state: " + str(initial_log_entry))
         listener(initial_log_entry)
 
-        while True:
-            sleep_time_sec = measure_period_sec
-            previous_info = self.connection_log.newest()
-            try:
-                if previous_info is None or not previous_info.is_connected:
-                    self.address_resolver.clear_cache()
-                info = self.measure(test_uri)
-                if previous_info is None or (info.is_connected != previous_info.is_connected) or (info.ip_address != previous_info.ip_address):
-                    self.connection_log.append(info)
-                    listener(info)
-                if not info.is_connected:
-                    sleep_time_sec = 1.5
-            except Exception as e:
-                logging.error(e)
-            time.sleep(sleep_time_sec)
+        scheduler = AdaptiveProbeScheduler(measure_period_sec)
+        last_observed = None    # the last time the current state has been observed
+        try:
+            while True:
+                sleep_time_sec = measure_period_sec
+                previous_info = self.connection_log.newest()
+                try:
+                    if previous_info is None or not previous_info.is_connected:
+                        self.clear_address_cache()
+                    if self.stagger is not None:
+                        await self.stagger.wait()
+                    # cpu time is measured on the io loop thread. It is an upper bound as it includes other
+                    # tasks executed on the loop concurrently
+                    cpu_start = time.thread_time()
+                    self.cycle_bytes = 0
+                    for path in self.paths:
+                        path.cycle_failures = 0
+                    observed = datetime.now()
+                    cycle_start = time.perf_counter()
+                    if previous_info is None or previous_info.is_connected:
+                        info = await self.measure(scheduler.timeout(), scheduler.confirm_timeout())
+                    else:
+                        # while disconnected a short timeout (without second trial) is used to detect the reconnect as early as possible
+                        info = await self.measure(AdaptiveProbeScheduler.MIN_TIMEOUT_SEC, None)
+                    cpu_ms = round((time.thread_time() - cpu_start) * 1000, 2)
+                    PROBE_CYCLE_SECONDS.observe(time.perf_counter() - cycle_start)
+                    record_span('connectivity', 'cycle', time.perf_counter() - cycle_start)
+                    if previous_info is None or info.is_changed(previous_info):
+                        if last_observed is None:
+                            # the previous state has not been observed by this process. It is unknown how long the
+                            # previous process has observed it. The change is dated when it has been observed
+                            info.change_after = observed if previous_info is None else min(previous_info.date, observed)
+                            info.unobserved = previous_info is not None
+                        else:
+                            info.change_after = last_observed
+                        info.change_before = observed
+                        self.connection_log.append(info)
+                        listener(info)
+                    last_observed = observed
+                    if probe_listener is not None:
+                        probe_listener(ProbeStatistics(dict(self.latencies), self.cycle_bytes, self.total_bytes, cpu_ms))
+                    # failed probes of a disconnected ip version (e.g. broken ipv6) do not indicate a degradation
+                    connected_paths = {version: path_info for version, path_info in info.paths.items() if path_info.is_connected}
+                    num_failures = sum([path.cycle_failures for path in self.paths if path.version in connected_paths.keys()])
+                    latencies = [path_info.latency_ms for path_info in connected_paths.values() if path_info.latency_ms is not None]
+                    sleep_time_sec = scheduler.next_period(info.is_connected, num_failures, min(latencies) if len(latencies) > 0 else None)
+                except Exception as e:
+                    logging.error(e)
+                await asyncio.sleep(sleep_time_sec)
+        except asyncio.CancelledError:
+            logging.info("connection test stopped")
+            raise
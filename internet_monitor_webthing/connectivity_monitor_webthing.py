@@ -1,22 +1,93 @@
-from webthing import Property, Thing, Value
-from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, ConnectionLog, ConnectionTester
+from webthing import Property, Value, Action
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
+from typing import Dict
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, ConnectionLog, ConnectionTester, ProbeStatistics
+from internet_monitor_webthing.probes import PROBE_METHODS
+from internet_monitor_webthing.ip_address_resolver import IP_ADDRESS_SOURCES
+from internet_monitor_webthing.latency_sampler import LatencySampler, LatencyStatistics
+from internet_monitor_webthing.interface_binding import InterfaceBinding, wan_dir
+from internet_monitor_webthing.probe_scheduler import StaggeredStart
+from internet_monitor_webthing.ip_info import IpInfo
+from internet_monitor_webthing.record_log import SYNC_POLICY
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.profiling import PROFILER
 import tornado.ioloop
+import uuid
+import os
 
 
-class InternetConnectivityMonitorWebthing(Thing):
+# the wan label is empty for the default route monitor (an empty label is equivalent to no label in Prometheus)
+CONNECTED = REGISTRY.gauge('netmonitor_connected', 'Internet connectivity state (1 = connected)', ['wan'])
+OUTAGES = REGISTRY.counter('netmonitor_outages_total', 'Detected internet outages', ['wan'])
+OUTAGE_SECONDS = REGISTRY.counter('netmonitor_outage_seconds_total', 'Cumulated duration of the finished internet outages', ['wan'])
+LAST_OUTAGE_SECONDS = REGISTRY.gauge('netmonitor_last_outage_seconds', 'Duration of the last finished internet outage', ['wan'])
+IP_ADDRESS_CHANGES = REGISTRY.counter('netmonitor_ip_address_changes_total', 'Changes of the public ip address', ['wan'])
+PROBE_TRAFFIC_BYTES = REGISTRY.gauge('netmonitor_probe_traffic_bytes', 'Payload bytes transferred by the connection tests since start', ['wan'])
+LATENCY_SECONDS = REGISTRY.gauge('netmonitor_latency_seconds', 'Rolling latency quantiles of the latency sampler', ['wan', 'quantile'])
+JITTER_SECONDS = REGISTRY.gauge('netmonitor_jitter_seconds', 'Rolling jitter of the latency sampler', ['wan'])
+PATH_CONNECTED = REGISTRY.gauge('netmonitor_path_connected', 'Internet connectivity state per ip version (1 = connected)', ['wan', 'ip_version'])
+PROBE_CYCLE_CPU_SECONDS = REGISTRY.gauge('netmonitor_probe_cycle_cpu_seconds', 'Cpu time consumed by the last connection test cycle', ['wan'])
+UPTIME_RATIO = REGISTRY.gauge('netmonitor_uptime_ratio', 'Uptime of the current day, week and month', ['wan', 'period'])
+MTBF_SECONDS = REGISTRY.gauge('netmonitor_mtbf_seconds', 'Mean time between failures (connected time per outage)', ['wan'])
+PACKET_LOSS_RATIO = REGISTRY.gauge('netmonitor_packet_loss_ratio', 'Rolling packet loss ratio of the latency sampler', ['wan'])
+
+
+class NullableValue(Value):
+
+    # webthing ignores None updates. Properties documented as null (e.g. of a path which is not monitored anymore)
+    # have to be reset to null instead of keeping their stale value
+    def notify_of_external_update(self, value):
+        if value != self.last_value:
+            self.last_value = value
+            self.emit('update', value)
+
+
+class Profile(Action):
+
+    # samples the stacks of this process for the given duration. The report is provided by the debug resource
+
+    def __init__(self, thing, input_):
+        Action.__init__(self, uuid.uuid4().hex, thing, 'profile', input_=input_)
+
+    def start(self):
+        # returns immediately. The action remains pending until the profiler is done
+        self.status = 'pending'
+        self.thing.action_notify(self)
+        self.perform_action()
+
+    def perform_action(self):
+        duration = self.input.get('duration', 30) if isinstance(self.input, dict) else 30
+        if PROFILER.start(duration, lambda: self.thing.ioloop.add_callback(self.__profiled)):
+            self.thing.profiling.notify_of_external_update(True)
+        else:
+            # a profiler run is in progress already
+            self.finish()
+
+    def __profiled(self):
+        self.thing.profiling.notify_of_external_update(False)
+        self.finish()
+
+
+class InternetConnectivityMonitorWebthing(CoalescingThing):
 
     # regarding capabilities refer https://iot.mozilla.org/schemas
     # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
 
-    def __init__(self, description: str, connecttest_period: int, connecttest_url: str):
-        Thing.__init__(
+    # if a wan (name) and its interface are given, the connectivity of this interface is monitored instead of the
+    # one of the default route. The monitors of several wans share the staggered starts and the ip info cache
+    def __init__(self, description: str, connecttest_period: int, connecttest_url: str, connecttest_quorum: int = 1, connecttest_method: str = 'head', latency_target: str = "1.1.1.1:443", latency_period: float = 5, ip_address_sources: str = IP_ADDRESS_SOURCES,
+                 wan: str = None, interface: str = None, probe_stagger: StaggeredStart = None, latency_stagger: StaggeredStart = None, ip_info: IpInfo = None,
+                 log_sync: str = SYNC_POLICY):
+        CoalescingThing.__init__(
             self,
-            'urn:dev:ops:connectivitymonitor-1',
-            'Internet Connectivity Monitor',
+            'urn:dev:ops:connectivitymonitor-1' + ("" if wan is None else "-" + wan),
+            'Internet Connectivity Monitor' + ("" if wan is None else " (" + wan + ")"),
             ['MultiLevelSensor'],
             description
         )
-        self.connection_log = ConnectionLog()
+        self.wan = "" if wan is None else wan
+        self.connection_log = ConnectionLog(None if wan is None else os.path.join(wan_dir(wan), "log.bin"), sync=log_sync)
+        self.previous_info = None
         self.connecttest_period = connecttest_period
 
         self.internet_connected = Value(False)
@@ -69,6 +140,9 @@ class InternetConnectivityMonitorWebthing(Thing):
                          'readOnly': True,
                      }))
 
+        # ipv4 and ipv6 are monitored separately. The properties of ipv6 are null, if the host has no ipv6 route
+        self.path_values = {4: self.__add_path_properties(4), 6: self.__add_path_properties(6)}
+
         self.test_url = Value(connecttest_url)
         self.add_property(
             Property(self,
@@ -77,7 +151,238 @@ class InternetConnectivityMonitorWebthing(Thing):
                      metadata={
                          'title': 'Internet connection test url',
                          "type": "string",
-                         'description': 'The url to connect',
+                         'description': 'The comma separated urls to connect (http://, https://, tcp://<host>:<port> or dns://[<nameserver>/]<name>)',
+                         'readOnly': True,
+                     }))
+
+        self.quorum = Value(connecttest_quorum)
+        self.add_property(
+            Property(self,
+                     'connection_test_quorum',
+                     self.quorum,
+                     metadata={
+                         'title': 'Internet connection test quorum',
+                         'type': 'integer',
+                         'description': 'The number of test urls which have to be reachable to consider the internet as connected',
+                         'readOnly': True,
+                     }))
+
+        self.method = Value(connecttest_method)
+        self.add_property(
+            Property(self,
+                     'connection_test_method',
+                     self.method,
+                     metadata={
+                         'title': 'Internet connection test method',
+                         'type': 'string',
+                         'enum': PROBE_METHODS,
+                         'description': 'The method to probe http(s) urls (head: HEAD request using a keep-alive connection, get: full GET request, 204: HEAD request expecting status 204, tcp: tcp handshake only)',
+                         'readOnly': True,
+                     }))
+
+        self.traffic = Value(0)
+        self.add_telemetry_property(
+            Property(self,
+                     'connection_test_traffic',
+                     self.traffic,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet connection test traffic',
+                         'type': 'integer',
+                         'description': 'The payload bytes transferred by the last connection test',
+                         'unit': 'byte',
+                         'readOnly': True,
+                     }))
+
+        self.total_traffic = Value(0)
+        self.add_telemetry_property(
+            Property(self,
+                     'connection_test_total_traffic',
+                     self.total_traffic,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet connection test total traffic',
+                         'type': 'integer',
+                         'description': 'The payload bytes transferred by all connection tests since start',
+                         'unit': 'byte',
+                         'readOnly': True,
+                     }))
+
+        self.cpu = Value(0)
+        self.add_telemetry_property(
+            Property(self,
+                     'connection_test_cpu',
+                     self.cpu,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet connection test cpu time',
+                         'type': 'number',
+                         'description': 'The cpu time consumed by the last connection test',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+
+        self.latency = Value(dict())
+        self.add_telemetry_property(
+            Property(self,
+                     'connection_test_latency',
+                     self.latency,
+                     metadata={
+                         'title': 'Internet connection test latency',
+                         'type': 'object',
+                         'description': 'The latency in milliseconds of the last connection test per test url (null, if not reachable)',
+                         'readOnly': True,
+                     }))
+
+        self.latency_p50 = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'latency_p50',
+                     self.latency_p50,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet latency (median)',
+                         'type': 'number',
+                         'description': 'The median latency of the recent latency samples (null, if all recent samples are lost)',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+
+        self.latency_p95 = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'latency_p95',
+                     self.latency_p95,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet latency (95th percentile)',
+                         'type': 'number',
+                         'description': 'The 95th percentile latency of the recent latency samples (null, if all recent samples are lost)',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+
+        self.latency_p99 = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'latency_p99',
+                     self.latency_p99,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet latency (99th percentile)',
+                         'type': 'number',
+                         'description': 'The 99th percentile latency of the recent latency samples (null, if all recent samples are lost)',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+
+        self.jitter = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'jitter',
+                     self.jitter,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet jitter',
+                         'type': 'number',
+                         'description': 'The mean deviation of consecutive latency samples (null, if there are no consecutive samples)',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+
+        self.packet_loss = Value(0)
+        self.add_telemetry_property(
+            Property(self,
+                     'packet_loss',
+                     self.packet_loss,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet packet loss',
+                         'type': 'number',
+                         'description': 'The share of lost latency samples',
+                         'unit': 'percent',
+                         'readOnly': True,
+                     }))
+
+        self.uptime_day = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'uptime_day',
+                     self.uptime_day,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet uptime (today)',
+                         'type': 'number',
+                         'description': 'The share of the time the internet has been connected today (null, if nothing has been observed today)',
+                         'unit': 'percent',
+                         'readOnly': True,
+                     }))
+
+        self.uptime_week = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'uptime_week',
+                     self.uptime_week,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet uptime (this week)',
+                         'type': 'number',
+                         'description': 'The share of the time the internet has been connected this week (null, if nothing has been observed this week)',
+                         'unit': 'percent',
+                         'readOnly': True,
+                     }))
+
+        self.uptime_month = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'uptime_month',
+                     self.uptime_month,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet uptime (this month)',
+                         'type': 'number',
+                         'description': 'The share of the time the internet has been connected this month (null, if nothing has been observed this month)',
+                         'unit': 'percent',
+                         'readOnly': True,
+                     }))
+
+        self.outages = NullableValue(None)
+        self.add_property(
+            Property(self,
+                     'outages',
+                     self.outages,
+                     metadata={
+                         'title': 'Internet outages',
+                         'type': 'integer',
+                         'description': 'The number of internet outages since the history has been started',
+                         'readOnly': True,
+                     }))
+
+        self.mtbf = NullableValue(None)
+        self.add_telemetry_property(
+            Property(self,
+                     'mtbf',
+                     self.mtbf,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Mean time between failures',
+                         'type': 'number',
+                         'description': 'The mean connected time between two internet outages (null, if no outage has been detected)',
+                         'unit': 'second',
+                         'readOnly': True,
+                     }))
+
+        self.mttr = NullableValue(None)
+        self.add_property(
+            Property(self,
+                     'mttr',
+                     self.mttr,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Mean time to repair',
+                         'type': 'number',
+                         'description': 'The mean duration of the internet outages (null, if no outage has been finished)',
+                         'unit': 'second',
                          'readOnly': True,
                      }))
 
@@ -95,16 +400,166 @@ class InternetConnectivityMonitorWebthing(Thing):
                          'readOnly': True,
                      }))
 
+        self.profiling = Value(False)
+        self.add_property(
+            Property(self,
+                     'profiling',
+                     self.profiling,
+                     metadata={
+                         'title': 'Profiling',
+                         'type': 'boolean',
+                         'description': 'True, if the sampling profiler is running (see profile action). The stage timings and the profiler report are provided by the /debug resource',
+                         'readOnly': True,
+                     }))
+
         self.ioloop = tornado.ioloop.IOLoop.current()
-        self.tester = ConnectionTester(self.connection_log)
-        self.tester.listen(self.__connection_state_updated, self.testperiod.get(), self.test_url.get())
+        self.add_available_action(
+            'profile',
+            {
+                'title': 'Profile',
+                'description': 'Runs the sampling profiler for the given duration',
+                'input': {
+                    'type': 'object',
+                    'properties': {
+                        'duration': {
+                            'type': 'number',
+                            'minimum': 1,
+                            'maximum': 300,
+                            'unit': 'second',
+                        },
+                    },
+                },
+            },
+            Profile)
+
+        test_urls = [url.strip() for url in connecttest_url.split(",") if len(url.strip()) > 0]
+        binding = None if interface is None else InterfaceBinding(interface)
+        self.tester = ConnectionTester(self.connection_log, test_urls, connecttest_quorum, connecttest_method, ip_address_sources.split(","), binding, probe_stagger, ip_info)
+        self.tester.listen(self.__connection_state_updated, self.testperiod.get(), self.__probed, self.__ip_info_looked_up)
+        if latency_period > 0:
+            self.latency_sampler = LatencySampler(latency_target, latency_period, binding=binding, stagger=latency_stagger)
+            self.latency_sampler.listen(self.__latency_sampled)
+
+    def __add_path_properties(self, version: int) -> Dict[str, Value]:
+        values = {'connected': NullableValue(None), 'ip_address': Value(""), 'asn': Value(""), 'latency': NullableValue(None)}
+        self.add_property(
+            Property(self,
+                     'ipv' + str(version) + '_connected',
+                     values['connected'],
+                     metadata={
+                         '@type': 'BooleanProperty',
+                         'title': 'Internet is connected via IPv' + str(version),
+                         'type': 'boolean',
+                         'description': 'Whether the internet is connected via IPv' + str(version) + ' (null, if IPv' + str(version) + ' is not monitored)',
+                         'readOnly': True,
+                     }))
+        self.add_property(
+            Property(self,
+                     'ipv' + str(version) + '_address',
+                     values['ip_address'],
+                     metadata={
+                         'title': 'Public IPv' + str(version) + ' address',
+                         'type': 'string',
+                         'description': 'The public IPv' + str(version) + ' address used for internet connection',
+                         'readOnly': True,
+                     }))
+        self.add_property(
+            Property(self,
+                     'ipv' + str(version) + '_asn',
+                     values['asn'],
+                     metadata={
+                         'title': 'Internet service provider (IPv' + str(version) + ')',
+                         'type': 'string',
+                         'description': 'The name of the internet service provider providing the public IPv' + str(version) + ' address',
+                         'readOnly': True,
+                     }))
+        self.add_property(
+            Property(self,
+                     'ipv' + str(version) + '_latency',
+                     values['latency'],
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Internet connection test latency (IPv' + str(version) + ')',
+                         'type': 'number',
+                         'description': 'The min latency of the connection test urls reached via IPv' + str(version) + ' when the state has changed (null, if IPv' + str(version) + ' is not connected or not monitored)',
+                         'unit': 'milliseconds',
+                         'readOnly': True,
+                     }))
+        return values
+
+    def __latency_sampled(self, statistics: LatencyStatistics):
+        LATENCY_SECONDS.labels(self.wan, '0.5').set(None if statistics.p50 is None else statistics.p50 / 1000)
+        LATENCY_SECONDS.labels(self.wan, '0.95').set(None if statistics.p95 is None else statistics.p95 / 1000)
+        LATENCY_SECONDS.labels(self.wan, '0.99').set(None if statistics.p99 is None else statistics.p99 / 1000)
+        JITTER_SECONDS.labels(self.wan).set(None if statistics.jitter is None else statistics.jitter / 1000)
+        PACKET_LOSS_RATIO.labels(self.wan).set(statistics.loss / 100)
+        self.latency_p50.notify_of_external_update(statistics.p50)
+        self.latency_p95.notify_of_external_update(statistics.p95)
+        self.latency_p99.notify_of_external_update(statistics.p99)
+        self.jitter.notify_of_external_update(statistics.jitter)
+        self.packet_loss.notify_of_external_update(statistics.loss)
 
     def __connection_state_updated(self, connection_info: ConnectionInfo):
+        # the tester runs on the io loop. The props can be updated directly
         if connection_info is not None:
-            self.ioloop.add_callback(self.__update_connected_props, connection_info)
+            self.__update_metrics(connection_info)
+            self.__update_connected_props(connection_info)
+
+    def __update_metrics(self, connection_info: ConnectionInfo):
+        CONNECTED.labels(self.wan).set(1 if connection_info.is_connected else 0)
+        previous = self.previous_info
+        self.previous_info = connection_info
+        if previous is None:
+            return
+        if previous.is_connected and not connection_info.is_connected:
+            OUTAGES.labels(self.wan).inc()
+        elif not previous.is_connected and connection_info.is_connected:
+            outage_sec = max(0, (connection_info.estimated_date - previous.estimated_date).total_seconds())
+            OUTAGE_SECONDS.labels(self.wan).inc(outage_sec)
+            LAST_OUTAGE_SECONDS.labels(self.wan).set(outage_sec)
+        elif connection_info.is_connected and connection_info.ip_address != previous.ip_address:
+            IP_ADDRESS_CHANGES.labels(self.wan).inc()
+
+    def __probed(self, statistics: ProbeStatistics):
+        self.latency.notify_of_external_update(statistics.latencies)
+        self.traffic.notify_of_external_update(statistics.num_bytes)
+        self.total_traffic.notify_of_external_update(statistics.total_bytes)
+        PROBE_TRAFFIC_BYTES.labels(self.wan).set(statistics.total_bytes)
+        self.cpu.notify_of_external_update(statistics.cpu_ms)
+        PROBE_CYCLE_CPU_SECONDS.labels(self.wan).set(statistics.cpu_ms / 1000)
+        self.__update_analytics_props()
+
+    def __update_analytics_props(self):
+        # the figures are read from the running aggregates. This does not depend on the size of the history
+        analytics = self.connection_log.analytics
+        for period, value in [('day', self.uptime_day), ('week', self.uptime_week), ('month', self.uptime_month)]:
+            uptime = analytics.uptime(period)
+            value.notify_of_external_update(uptime)
+            UPTIME_RATIO.labels(self.wan, period).set(None if uptime is None else uptime / 100)
+        self.outages.notify_of_external_update(analytics.outages)
+        mtbf = analytics.mtbf_sec()
+        self.mtbf.notify_of_external_update(mtbf)
+        MTBF_SECONDS.labels(self.wan).set(mtbf)
+        self.mttr.notify_of_external_update(analytics.mttr_sec())
+
+    def __ip_info_looked_up(self, ip_address: str, ip_info: Dict[str, str]):
+        # lookups may complete after the probe cycle (slow or refreshed lookups)
+        if ip_address == self.ip_address.get():
+            self.asn.notify_of_external_update(ip_info['asn'][:40])
+        for values in self.path_values.values():
+            if ip_address == values['ip_address'].get():
+                values['asn'].notify_of_external_update(ip_info['asn'][:40])
 
     def __update_connected_props(self, connection_info: ConnectionInfo):
         self.internet_connected.notify_of_external_update(connection_info.is_connected)
         self.event_date.notify_of_external_update(connection_info.date.isoformat())
         self.ip_address.notify_of_external_update(connection_info.ip_address)
         self.asn.notify_of_external_update(connection_info.ip_info['asn'][:40])
+        paths = connection_info.paths
+        for version, values in self.path_values.items():
+            path_info = paths.get(version, None)
+            values['connected'].notify_of_external_update(None if path_info is None else path_info.is_connected)
+            values['ip_address'].notify_of_external_update("" if path_info is None else path_info.ip_address)
+            values['asn'].notify_of_external_update("" if path_info is None else path_info.ip_info.get('asn', '')[:40])
+            values['latency'].notify_of_external_update(None if path_info is None else path_info.latency_ms)
+            PATH_CONNECTED.labels(self.wan, str(version)).set(None if path_info is None else (1 if path_info.is_connected else 0))
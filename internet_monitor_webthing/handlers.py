@@ -0,0 +1,295 @@
+from datetime import datetime
+from typing import Dict, Optional
+from internet_monitor_webthing.connectivity_monitor import ConnectionLog, PathInfo
+from internet_monitor_webthing.speedtest_history import SpeedHistory
+from internet_monitor_webthing.metrics import MetricsRegistry
+from internet_monitor_webthing.outage_analytics import OutageAnalytics
+from internet_monitor_webthing.profiling import SamplingProfiler, stage_timings
+from internet_monitor_webthing.hub_store import HubStore, SiteStore
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
+import tornado.httputil
+import tornado.web
+import email.utils
+import hmac
+import zlib
+import json
+
+
+def parse_time(text: str, default: datetime) -> datetime:
+    if text is None or len(text.strip()) == 0:
+        return default
+    try:
+        epoch = float(text)
+    except ValueError:
+        return datetime.fromisoformat(text)            # ISO 8601
+    try:
+        return datetime.fromtimestamp(epoch)           # epoch seconds
+    except (ValueError, OverflowError, OSError) as e:
+        # such as inf, nan or an epoch beyond the year 9999. Answered with 400 like any other invalid time
+        raise ValueError("invalid epoch " + text + " (" + str(e) + ")")
+
+
+class BaseHandler(tornado.web.RequestHandler):
+
+    def set_default_headers(self, *args, **kwargs):
+        self.set_header('Access-Control-Allow-Origin', '*')
+        self.set_header('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, If-None-Match, If-Modified-Since')
+        self.set_header('Access-Control-Allow-Methods', 'GET, HEAD')
+        self.set_header('Access-Control-Expose-Headers', 'ETag, Last-Modified')
+
+    def options(self, *args, **kwargs):
+        self.set_status(204)
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(data))
+
+    def not_modified(self, etag: str, modified: datetime = None) -> bool:
+        # sets the validators and answers with 304, if the client's copy is still valid. This is checked before the
+        # response is built. If-Modified-Since is considered only, if no If-None-Match is given (RFC 7232)
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('ETag', etag)
+        if modified is not None:
+            self.set_header('Last-Modified', tornado.httputil.format_timestamp(modified.timestamp()))
+        if self.request.headers.get('If-None-Match') is not None:
+            valid = self.check_etag_header()
+        else:
+            valid = modified is not None and self.__not_modified_since(modified)
+        if valid:
+            self.set_status(304)
+        return valid
+
+    def __not_modified_since(self, modified: datetime) -> bool:
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since is None:
+            return False
+        try:
+            # Last-Modified has a resolution of seconds
+            return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= int(modified.timestamp())
+        except (TypeError, ValueError):
+            return False
+
+
+def history_etag(size: int, modified: datetime) -> str:
+    return '"' + str(size) + '-' + str(int(modified.timestamp() * 1000000)) + '"'
+
+
+def report_etag(analytics: OutageAnalytics, now: datetime) -> str:
+    accumulated = 0 if analytics.accumulated is None else int(analytics.accumulated.timestamp() * 1000000)
+    return 'W/"' + str(analytics.outages) + '-' + str(accumulated) + '-' + now.strftime('%Y%m%d%H%M') + '"'
+
+
+class PropertiesHandler(BaseHandler):
+
+    # replaces the properties resource of webthing. Pollers get 304 as long as no property has been changed. Otherwise,
+    # the cached serialized properties are written
+    def initialize(self, thing: CoalescingThing):
+        self.thing = thing
+
+    def get(self):
+        if not self.not_modified(self.thing.properties_etag()):
+            self.set_header('Content-Type', 'application/json')
+            self.write(self.thing.properties_json())
+
+
+class ConnectivityHistoryHandler(BaseHandler):
+
+    MAX_ENTRIES = 10000
+
+    def initialize(self, connection_log: ConnectionLog):
+        self.connection_log = connection_log
+
+    def get(self):
+        try:
+            start = parse_time(self.get_query_argument('from', None), datetime.fromtimestamp(0))
+            end = parse_time(self.get_query_argument('to', None), datetime.now())
+            limit = min(int(self.get_query_argument('limit', str(self.MAX_ENTRIES))), self.MAX_ENTRIES)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        if self.not_modified(history_etag(len(self.connection_log), self.connection_log.modified), self.connection_log.modified):
+            return
+
+        self.write_json([{'time': entry.date.isoformat(),
+                          'connected': entry.is_connected,
+                          'ip_address': entry.ip_address,
+                          'asn': entry.ip_info.get('asn', ''),
+                          'change_after': None if entry.change_after is None else entry.change_after.isoformat(),
+                          'change_before': None if entry.change_before is None else entry.change_before.isoformat(),
+                          'unobserved': entry.unobserved,
+                          'ipv4': self.__path(entry.ipv4),
+                          'ipv6': self.__path(entry.ipv6)}
+                         for entry in self.connection_log.range(start, end, limit)])
+
+    @staticmethod
+    def __path(path_info: Optional[PathInfo]) -> Optional[Dict]:
+        if path_info is None:
+            return None
+        return {'connected': path_info.is_connected,
+                'ip_address': path_info.ip_address,
+                'asn': path_info.ip_info.get('asn', ''),
+                'latency': path_info.latency_ms}
+
+
+class OutageReportHandler(BaseHandler):
+
+    # the running aggregates are read. The history is not scanned
+    def initialize(self, analytics: OutageAnalytics):
+        self.analytics = analytics
+
+    def get(self):
+        # the report includes the open interval since the last entry (such as the uptime of the current day), which grows
+        # with the time. For this reason, there is no Last-Modified date. The report is validated by a weak ETag which
+        # changes with each added entry and each minute
+        now = datetime.now()
+        if not self.not_modified(report_etag(self.analytics, now)):
+            self.write_json(self.analytics.report(now))
+
+
+class SpeedHistoryHandler(BaseHandler):
+
+    MAX_ENTRIES = 10000
+
+    def initialize(self, speed_history: SpeedHistory):
+        self.speed_history = speed_history
+
+    def get(self):
+        try:
+            resolution = self.get_query_argument('resolution', 'hour')
+            if resolution != 'raw' and resolution not in SpeedHistory.RESOLUTIONS.keys():
+                raise ValueError("unsupported resolution " + resolution + " (supported: raw, " + ", ".join(SpeedHistory.RESOLUTIONS.keys()) + ")")
+            start = parse_time(self.get_query_argument('from', None), datetime.fromtimestamp(0))
+            end = parse_time(self.get_query_argument('to', None), datetime.now())
+            limit = min(int(self.get_query_argument('limit', str(self.MAX_ENTRIES))), self.MAX_ENTRIES)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        if self.not_modified(history_etag(len(self.speed_history), self.speed_history.modified), self.speed_history.modified):
+            return
+
+        if resolution == 'raw':
+            self.write_json(self.speed_history.rows(start, end, limit))
+        else:
+            self.write_json(self.speed_history.rollup(resolution, start, end))
+
+
+class MetricsHandler(BaseHandler):
+
+    # Prometheus text format by default. OpenMetrics, if requested by the Accept header
+
+    def initialize(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def get(self):
+        openmetrics = 'application/openmetrics-text' in self.request.headers.get('Accept', '')
+        self.set_header('Content-Type', MetricsRegistry.OPENMETRICS_CONTENT_TYPE if openmetrics else MetricsRegistry.PROMETHEUS_CONTENT_TYPE)
+        self.write(self.registry.render(openmetrics))
+
+
+class DebugHandler(BaseHandler):
+
+    # stage timings of the monitor loops and the report of the last (or running) profiler run
+
+    def initialize(self, profiler: SamplingProfiler):
+        self.profiler = profiler
+
+    def get(self):
+        try:
+            limit = int(self.get_query_argument('limit', '20'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.write_json({'stages': stage_timings(),
+                         'profiler': self.profiler.report(limit)})
+
+
+class HubIngestHandler(BaseHandler):
+
+    # accepts the (gzip compressed) batches pushed by the agents. If a token is configured, the agents have to
+    # provide it as bearer token
+    MAX_BATCH_SIZE = 32 * 1024 * 1024    # decompressed
+
+    def initialize(self, hub_store: HubStore, token: str = None):
+        self.hub_store = hub_store
+        self.token = token
+
+    async def post(self):
+        if self.token is not None and len(self.token) > 0:
+            if not hmac.compare_digest(self.request.headers.get('Authorization', '').encode('utf-8'), ('Bearer ' + self.token).encode('utf-8')):
+                raise tornado.web.HTTPError(401, "invalid token")
+        body = self.request.body
+        if self.request.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, self.MAX_BATCH_SIZE)
+            except zlib.error as e:
+                raise tornado.web.HTTPError(400, str(e))
+            if len(decompressor.unconsumed_tail) > 0:
+                raise tornado.web.HTTPError(413, "batch exceeds " + str(self.MAX_BATCH_SIZE) + " bytes")
+        try:
+            self.write_json(await self.hub_store.ingest(json.loads(body)))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+
+class HubSitesHandler(BaseHandler):
+
+    # the current state of the sites. ?status=down returns the disconnected and the unreachable ones only
+    def initialize(self, hub_store: HubStore):
+        self.hub_store = hub_store
+
+    def get(self):
+        self.write_json(self.hub_store.summaries(self.get_query_argument('status', None)))
+
+
+def find_site(hub_store: HubStore, site: str, wan: str) -> SiteStore:
+    store = hub_store.find(site, wan)
+    if store is None:
+        raise tornado.web.HTTPError(404, "unknown site " + site + "/" + wan)
+    return store
+
+
+class HubConnectivityHistoryHandler(ConnectivityHistoryHandler):
+
+    def initialize(self, hub_store: HubStore):
+        self.hub_store = hub_store
+
+    def get(self, site: str, wan: str):
+        self.connection_log = find_site(self.hub_store, site, wan).connection_log
+        super().get()
+
+
+class HubOutageReportHandler(OutageReportHandler):
+
+    def initialize(self, hub_store: HubStore):
+        self.hub_store = hub_store
+
+    def get(self, site: str, wan: str):
+        self.analytics = find_site(self.hub_store, site, wan).connection_log.analytics
+        super().get()
+
+
+class HubSpeedHistoryHandler(SpeedHistoryHandler):
+
+    def initialize(self, hub_store: HubStore):
+        self.hub_store = hub_store
+
+    def get(self, site: str, wan: str):
+        self.speed_history = find_site(self.hub_store, site, wan).speed_history
+        super().get()
+
+
+class HubRollupHandler(BaseHandler):
+
+    # fleet-wide rollups: ?period=day|week|month (uptime) or ?resolution=hour|day|month (speed)
+    def initialize(self, hub_store: HubStore):
+        self.hub_store = hub_store
+
+    def get(self):
+        try:
+            resolution = self.get_query_argument('resolution', None)
+            if resolution is None:
+                self.write_json(self.hub_store.uptime_rollup(self.get_query_argument('period', 'day')))
+            else:
+                start = parse_time(self.get_query_argument('from', None), datetime.fromtimestamp(0))
+                end = parse_time(self.get_query_argument('to', None), datetime.now())
+                self.write_json(self.hub_store.speed_rollup(resolution, start, end))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
@@ -0,0 +1,137 @@
+from typing import Dict, Optional
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from internet_monitor_webthing.connectivity_monitor import ConnectionLog
+from internet_monitor_webthing.speedtest_history import SpeedHistory
+from internet_monitor_webthing.hub_store import encode_connection, encode_speed
+from internet_monitor_webthing.metrics import REGISTRY
+import asyncio
+import logging
+import json
+import gzip
+import time
+
+
+HUB_PUSHES = REGISTRY.counter('netmonitor_hub_pushes_total', 'Pushes to the hub', ['status'])
+HUB_BACKLOG_RECORDS = REGISTRY.gauge('netmonitor_hub_backlog_records', 'Records which have not been acknowledged by the hub yet')
+
+
+class HubAgent:
+
+    # pushes the connectivity and speed records to the hub. The records are read from the local histories, so
+    # nothing is buffered twice: while the hub is unreachable the records remain in the histories and are replayed
+    # once it is reachable again. The hub acknowledges the stored records and the agent continues from there.
+    # Pushes without new records are heartbeats which let the hub detect unreachable sites
+    CHECK_PERIOD_SEC = 1
+    HEARTBEAT_PERIOD_SEC = 30
+    MAX_BATCH_SIZE = 500
+    MIN_BACKOFF_SEC = 5
+    MAX_BACKOFF_SEC = 5 * 60
+    TIMEOUT_SEC = 30
+
+    def __init__(self, hub_url: str, site: str, token: str = None):
+        self.url = hub_url.rstrip('/') + "/ingest"
+        self.site = site
+        self.token = token
+        self.wans = {}        # wan -> {stream -> history}
+        self.cursors = {}     # (wan, stream) -> (log id, index of the next entry to push)
+        self.task = None
+
+    def add_wan(self, wan: str, connection_log: ConnectionLog = None, speed_history: SpeedHistory = None):
+        histories = self.wans.setdefault(wan, {})
+        if connection_log is not None:
+            histories['connection'] = connection_log
+        if speed_history is not None:
+            histories['speed'] = speed_history
+
+    def start(self):
+        IOLoop.current().add_callback(self.__start)
+
+    def __start(self):
+        self.task = asyncio.ensure_future(self.push_periodically())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @staticmethod
+    def __log_id(stream: str, history) -> float:
+        if stream == 'connection':
+            oldest = history.oldest()
+            return 0 if oldest is None else oldest.date.timestamp()
+        else:
+            oldest = history.raw_rows(0, 1)
+            return 0 if len(oldest) == 0 else oldest[0]['time']
+
+    def backlog(self) -> Optional[int]:
+        # None, if the acknowledged position is not known yet
+        backlog = 0
+        for wan, histories in self.wans.items():
+            for stream, history in histories.items():
+                cursor = self.cursors.get((wan, stream))
+                if cursor is None:
+                    return None
+                backlog += max(0, len(history) - cursor[1])
+        return backlog
+
+    async def push_periodically(self):
+        last_push = 0
+        backoff_sec = 0
+        try:
+            while True:
+                backlog = self.backlog()
+                HUB_BACKLOG_RECORDS.set(backlog)
+                if backlog != 0 or time.monotonic() - last_push >= HubAgent.HEARTBEAT_PERIOD_SEC:
+                    try:
+                        await self.push()
+                        HUB_PUSHES.labels('succeeded').inc()
+                        last_push = time.monotonic()
+                        backoff_sec = 0
+                        continue
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        HUB_PUSHES.labels('failed').inc()
+                        backoff_sec = min(HubAgent.MAX_BACKOFF_SEC, max(HubAgent.MIN_BACKOFF_SEC, backoff_sec * 2))
+                        logging.info("error occurred pushing to hub " + self.url + " " + str(e) + ". retry in " + str(backoff_sec) + " sec")
+                        await asyncio.sleep(backoff_sec)
+                        continue
+                await asyncio.sleep(HubAgent.CHECK_PERIOD_SEC)
+        except asyncio.CancelledError:
+            logging.info("hub agent stopped")
+            raise
+
+    async def push(self):
+        # pushes a batch of the not acknowledged records (at most MAX_BATCH_SIZE per stream)
+        batch = {'site': self.site, 'wans': []}
+        log_ids = {}
+        for wan, histories in self.wans.items():
+            wan_batch = {'wan': wan}
+            for stream, history in histories.items():
+                log_id = self.__log_id(stream, history)
+                log_ids[(wan, stream)] = log_id
+                cursor = self.cursors.get((wan, stream))
+                if cursor is None or cursor[0] != log_id:
+                    # the acknowledged position is requested first
+                    wan_batch[stream] = {'log_id': log_id, 'start': None, 'entries': []}
+                else:
+                    start = min(cursor[1], len(history))
+                    end = start + HubAgent.MAX_BATCH_SIZE
+                    if stream == 'connection':
+                        entries = [encode_connection(info) for info in history.slice(start, end)]
+                    else:
+                        entries = [encode_speed(row) for row in history.raw_rows(start, end)]
+                    wan_batch[stream] = {'log_id': log_id, 'start': start, 'entries': entries}
+            batch['wans'].append(wan_batch)
+
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        if self.token is not None and len(self.token) > 0:
+            headers['Authorization'] = 'Bearer ' + self.token
+        response = await AsyncHTTPClient().fetch(self.url, method='POST', headers=headers, body=gzip.compress(json.dumps(batch).encode('utf-8')),
+                                                 connect_timeout=HubAgent.TIMEOUT_SEC, request_timeout=HubAgent.TIMEOUT_SEC)
+        acknowledged: Dict = json.loads(response.body)['wans']
+        for wan, streams in acknowledged.items():
+            for stream, next_idx in streams.items():
+                if (wan, stream) in log_ids.keys():
+                    self.cursors[(wan, stream)] = (log_ids[(wan, stream)], int(next_idx))
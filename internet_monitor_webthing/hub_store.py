@@ -0,0 +1,317 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, ConnectionLog, PathInfo
+from internet_monitor_webthing.speedtest_history import SpeedHistory, Rollup, rounded
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.record_log import SYNC_POLICY
+from tornado.ioloop import IOLoop
+import asyncio
+import logging
+import math
+import json
+import time
+import re
+import os
+
+
+HUB_INGESTED_RECORDS = REGISTRY.counter('netmonitor_hub_ingested_records_total', 'Records ingested by the hub', ['stream'])
+HUB_DUPLICATE_RECORDS = REGISTRY.counter('netmonitor_hub_duplicate_records_total', 'Records pushed again (e.g. after a lost acknowledge) and skipped by the hub', ['stream'])
+
+# the wan of an agent monitoring the default route has no name
+DEFAULT_WAN = "default"
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+# push protocol: agents push their records as gzip compressed json batches
+#   {"site": <site>, "wans": [{"wan": <wan>, "connection": <stream>, "speed": <stream>}, ...]}
+#   stream: {"log_id": <id of the local history>, "start": <index of the first entry or null>, "entries": [...]}
+# The hub responds the index of the next expected entry per stream {"wans": {<wan>: {"connection": <index>, "speed": <index>}}}.
+# The log id is the time of the oldest local entry. It changes, if the local history is recreated or compacted
+
+
+def encode_connection(info: ConnectionInfo) -> Dict:
+    def path(path_info: Optional[PathInfo]) -> Optional[Dict]:
+        if path_info is None:
+            return None
+        return {'connected': path_info.is_connected, 'ip_address': path_info.ip_address, 'asn': path_info.ip_info.get('asn', ''), 'latency': path_info.latency_ms}
+    return {'time': info.date.timestamp(),
+            'connected': info.is_connected,
+            'ip_address': info.ip_address,
+            'asn': info.ip_info.get('asn', ''),
+            'change_after': None if info.change_after is None else info.change_after.timestamp(),
+            'change_before': None if info.change_before is None else info.change_before.timestamp(),
+            'unobserved': info.unobserved,
+            'ipv4': path(info.ipv4),
+            'ipv6': path(info.ipv6)}
+
+
+def decode_connection(data: Dict) -> ConnectionInfo:
+    def path(path_data: Optional[Dict]) -> Optional[PathInfo]:
+        if path_data is None:
+            return None
+        return PathInfo(bool(path_data['connected']), str(path_data.get('ip_address', '')), {'asn': str(path_data.get('asn', ''))}, path_data.get('latency'))
+    info = ConnectionInfo(datetime.fromtimestamp(float(data['time'])), bool(data['connected']), str(data.get('ip_address', '')), {'asn': str(data.get('asn', ''))})
+    if data.get('change_after') is not None and data.get('change_before') is not None:
+        info.change_after = datetime.fromtimestamp(float(data['change_after']))
+        info.change_before = datetime.fromtimestamp(float(data['change_before']))
+    info.unobserved = bool(data.get('unobserved', False))
+    info.ipv4 = path(data.get('ipv4'))
+    info.ipv6 = path(data.get('ipv6'))
+    return info
+
+
+def encode_speed(row: Dict[str, float]) -> Dict:
+    return {name: None if math.isnan(value) else value for name, value in row.items()}
+
+
+def decode_speed(data: Dict) -> Dict[str, float]:
+    return {name: math.nan if data.get(name) is None else float(data[name]) for name in SpeedHistory.COLUMNS}
+
+
+class SiteStore:
+
+    # the connectivity history, the speed history and the ingestion state of a wan of a site. The ingestion state
+    # is the log id and the index of the next expected entry per stream
+    STREAMS = ['connection', 'speed']
+
+    def __init__(self, dir: str, site: str, wan: str, sync: str = SYNC_POLICY):
+        os.makedirs(dir, exist_ok=True)
+        self.site = site
+        self.wan = wan
+        self.connection_log = ConnectionLog(os.path.join(dir, "log.bin"), sync=sync)
+        self.speed_history = SpeedHistory(os.path.join(dir, "speedhistory"))
+        self.state_filename = os.path.join(dir, "ingest.json")
+        self.streams = {stream: {'log_id': 0, 'next': 0} for stream in SiteStore.STREAMS}
+        self.last_seen = None
+        self.dirty = False          # the ingest state has been updated, but not stored yet
+        try:
+            with open(self.state_filename, "r") as file:
+                data = json.load(file)
+                self.streams.update(data['streams'])
+                self.last_seen = data.get('last_seen')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred loading ingest state " + self.state_filename + " " + str(e))
+
+    def ingest(self, stream: str, log_id: float, start: Optional[int], entries: List[Dict]) -> int:
+        # returns the index of the next expected entry. Entries which have been ingested already are skipped. The
+        # entries are acknowledged once persist() has been called
+        state = self.streams[stream]
+        replayed = False
+        if log_id != state['log_id']:
+            if start != 0 or len(entries) == 0:
+                # the agent history has been recreated or compacted. It has to be replayed from the beginning
+                return 0
+            state = {'log_id': log_id, 'next': 0}
+            self.streams[stream] = state
+            replayed = True
+        if start is None or start > state['next']:
+            return state['next']
+        skipped = state['next'] - start
+        if skipped > 0:
+            HUB_DUPLICATE_RECORDS.labels(stream).inc(min(skipped, len(entries)))
+        num_ingested = 0
+        for entry in entries[skipped:]:
+            if self.__append(stream, entry, replayed):
+                num_ingested += 1
+        HUB_INGESTED_RECORDS.labels(stream).inc(num_ingested)
+        if len(entries) > skipped:
+            state['next'] = start + len(entries)
+            self.dirty = True
+        return state['next']
+
+    def persist(self):
+        # blocking. Syncs the ingested entries (one sync per batch, group commit) before the ingest state which
+        # acknowledges them is stored
+        if self.dirty:
+            self.dirty = False
+            self.connection_log.sync()
+            self.__store()
+
+    def __append(self, stream: str, entry: Dict, replayed: bool) -> bool:
+        # entries have to be appended in chronological order. Replayed entries may overlap with the stored ones
+        if stream == 'connection':
+            info = decode_connection(entry)
+            newest = self.connection_log.newest()
+            if newest is not None and (info.date < newest.date or (replayed and info.date == newest.date)):
+                return False
+            self.connection_log.append(info)
+        else:
+            row = decode_speed(entry)
+            newest = self.speed_history.raw_rows(len(self.speed_history) - 1)
+            if len(newest) > 0 and (row['time'] < newest[0]['time'] or (replayed and row['time'] == newest[0]['time'])):
+                return False
+            self.speed_history.append_row(row)
+        return True
+
+    def __store(self):
+        try:
+            tempfile = self.state_filename + ".tmp"
+            with open(tempfile, "w") as file:
+                json.dump({'streams': self.streams, 'last_seen': self.last_seen}, file)
+            os.replace(tempfile, self.state_filename)
+        except Exception as e:
+            logging.error("error occurred storing ingest state " + str(e))
+
+    def status(self, stale_sec: float) -> str:
+        # an agent which has not pushed for a while is unreachable (its site may be offline)
+        if self.last_seen is None or time.time() - self.last_seen > stale_sec:
+            return 'unreachable'
+        analytics = self.connection_log.analytics
+        if analytics.is_connected is None:
+            return 'unknown'
+        return 'connected' if analytics.is_connected else 'disconnected'
+
+    def summary(self, stale_sec: float) -> Dict:
+        analytics = self.connection_log.analytics
+        newest = self.connection_log.newest()
+        speed = self.speed_history.raw_rows(len(self.speed_history) - 1)
+        return {'site': self.site,
+                'wan': self.wan,
+                'status': self.status(stale_sec),
+                'connected': analytics.is_connected,
+                'state_since': None if analytics.changed is None else analytics.changed.isoformat(),
+                'last_seen': None if self.last_seen is None else datetime.fromtimestamp(self.last_seen).isoformat(),
+                'ip_address': "" if newest is None else newest.ip_address,
+                'asn': "" if newest is None else newest.ip_info.get('asn', ''),
+                'uptime_day': analytics.uptime('day'),
+                'outages': analytics.outages,
+                'speed': None if len(speed) == 0 else {'time': datetime.fromtimestamp(speed[0]['time']).isoformat(),
+                                                       'download': rounded(speed[0]['download']),
+                                                       'upload': rounded(speed[0]['upload']),
+                                                       'ping': rounded(speed[0]['ping'])}}
+
+
+class HubStore:
+
+    # the stores of all agents (site and wan) indexed in memory. The queries are answered from the running aggregates
+    # of the stores (outage analytics, speed rollups). So they take O(number of sites) instead of scanning the histories
+    STALE_SEC = 2 * 60
+
+    def __init__(self, dir: str = None, stale_sec: float = STALE_SEC, sync: str = SYNC_POLICY):
+        self.dir = os.path.join("var", "lib", "netmonitor", "hub") if dir is None else dir
+        os.makedirs(self.dir, exist_ok=True)
+        self.stale_sec = stale_sec
+        self.sync = sync
+        self.sites = OrderedDict()    # (site, wan) -> site store
+        self.site_locks = dict()      # site -> lock serializing the batches of the site
+        self.listeners = []
+        for site in sorted(os.listdir(self.dir)):
+            if os.path.isdir(os.path.join(self.dir, site)):
+                for wan in sorted(os.listdir(os.path.join(self.dir, site))):
+                    if NAME_PATTERN.match(site) and NAME_PATTERN.match(wan):
+                        self.site(site, wan)
+        logging.info("hub store " + self.dir + " loaded. " + str(len(self.sites)) + " sites found")
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def site(self, site: str, wan: str) -> SiteStore:
+        wan = DEFAULT_WAN if len(wan) == 0 else wan
+        if NAME_PATTERN.match(site) is None or NAME_PATTERN.match(wan) is None:
+            raise ValueError("invalid site " + site + " or wan " + wan + " (letters, digits, - and _ only)")
+        store = self.sites.get((site, wan))
+        if store is None:
+            store = SiteStore(os.path.join(self.dir, site, wan), site, wan, self.sync)
+            self.sites[(site, wan)] = store
+        return store
+
+    def close(self):
+        for store in self.sites.values():
+            store.connection_log.close()
+
+    def find(self, site: str, wan: str) -> Optional[SiteStore]:
+        return self.sites.get((site, wan))
+
+    async def ingest(self, batch: Dict) -> Dict:
+        # raises a ValueError, if the batch is invalid. The entries are appended on the io loop (the stores are read
+        # by the io loop as well). The blocking sync runs on an executor thread, so the io loop keeps serving other
+        # agents and queries meanwhile. The batches of a site are serialized until they have been acknowledged
+        try:
+            site = str(batch['site'])
+            wan_batches = list(batch['wans'])
+        except (KeyError, TypeError) as e:
+            raise ValueError("invalid batch " + str(e))
+        lock = self.site_locks.setdefault(site, asyncio.Lock())
+        async with lock:
+            response = {}
+            stores = []
+            try:
+                for wan_batch in wan_batches:
+                    store = self.site(site, str(wan_batch.get('wan', '')))
+                    store.last_seen = time.time()
+                    stores.append(store)
+                    response[str(wan_batch.get('wan', ''))] = {stream: store.ingest(stream,
+                                                                                    float(wan_batch[stream]['log_id']),
+                                                                                    None if wan_batch[stream].get('start') is None else int(wan_batch[stream]['start']),
+                                                                                    list(wan_batch[stream].get('entries', [])))
+                                                               for stream in SiteStore.STREAMS if wan_batch.get(stream) is not None}
+            except (KeyError, TypeError) as e:
+                raise ValueError("invalid batch " + str(e))
+            finally:
+                # the entries of a partially invalid batch which have been ingested are persisted as well
+                await IOLoop.current().run_in_executor(None, self.__persist, stores)
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                logging.error("error occurred notifying hub listener " + str(e))
+        return {'wans': response}
+
+    @staticmethod
+    def __persist(stores: List[SiteStore]):
+        for store in stores:
+            store.persist()
+
+    def statuses(self) -> Dict[Tuple[str, str], str]:
+        return {key: store.status(self.stale_sec) for key, store in self.sites.items()}
+
+    def summaries(self, status: str = None) -> List[Dict]:
+        # status: connected, disconnected, unreachable, unknown or down (disconnected or unreachable)
+        summaries = [store.summary(self.stale_sec) for store in self.sites.values()]
+        if status == 'down':
+            return [summary for summary in summaries if summary['status'] in ['disconnected', 'unreachable']]
+        elif status is not None:
+            return [summary for summary in summaries if summary['status'] == status]
+        else:
+            return summaries
+
+    def uptime_rollup(self, period: str) -> List[Dict]:
+        # the fleet-wide uptime per day, week or month including the site with the lowest uptime
+        if period not in ['day', 'week', 'month']:
+            raise ValueError("unsupported period " + period + " (supported: day, week, month)")
+        now = datetime.now()
+        fleet = {}
+        for store in self.sites.values():
+            for key, totals in store.connection_log.analytics.period_totals(period, now).items():
+                aggregates = fleet.setdefault(key, {'sites': 0, 'connected_sec': 0, 'disconnected_sec': 0, 'outages': 0, 'worst': None})
+                aggregates['sites'] += 1
+                aggregates['connected_sec'] += totals['connected_sec']
+                aggregates['disconnected_sec'] += totals['disconnected_sec']
+                aggregates['outages'] += totals['outages']
+                uptime = self.__percent(totals['connected_sec'], totals['disconnected_sec'])
+                if uptime is not None and (aggregates['worst'] is None or uptime < aggregates['worst']['uptime']):
+                    aggregates['worst'] = {'site': store.site, 'wan': store.wan, 'uptime': uptime}
+        return [{'period': key,
+                 'sites': aggregates['sites'],
+                 'uptime': self.__percent(aggregates['connected_sec'], aggregates['disconnected_sec']),
+                 'outages': aggregates['outages'],
+                 'outage_sec': round(aggregates['disconnected_sec'], 1),
+                 'worst': aggregates['worst']}
+                for key, aggregates in sorted(fleet.items())]
+
+    @staticmethod
+    def __percent(connected_sec: float, disconnected_sec: float) -> Optional[float]:
+        if connected_sec + disconnected_sec <= 0:
+            return None
+        return round(100 * connected_sec / (connected_sec + disconnected_sec), 3)
+
+    def speed_rollup(self, resolution: str, start: datetime, end: datetime) -> List[Dict]:
+        # the rollups of the sites are merged per hour, day or month
+        fleet = {}
+        for store in self.sites.values():
+            for rollup in store.speed_history.rollups_of(resolution, start, end):
+                fleet.setdefault(rollup.start, Rollup(rollup.start)).merge(rollup)
+        return [fleet[start].to_dict() for start in sorted(fleet.keys())]
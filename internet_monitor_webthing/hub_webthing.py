@@ -0,0 +1,125 @@
+from webthing import (Property, SingleThing, Value, WebThingServer)
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
+from internet_monitor_webthing.hub_store import HubStore
+from internet_monitor_webthing.handlers import PropertiesHandler, HubIngestHandler, HubSitesHandler, HubConnectivityHistoryHandler, HubOutageReportHandler, HubSpeedHistoryHandler, HubRollupHandler, MetricsHandler, DebugHandler
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.profiling import PROFILER
+from internet_monitor_webthing.record_log import SYNC_POLICY
+from internet_monitor_webthing.internet_multiple_webthing import stop_on_signal
+import tornado.ioloop
+import logging
+import signal
+
+
+HUB_SITES = REGISTRY.gauge('netmonitor_hub_sites', 'Sites (wans) known by the hub per status', ['status'])
+
+
+class InternetMonitorHubWebthing(CoalescingThing):
+
+    # aggregates the pushes of many netmonitor agents (sites). The state of the sites is re-evaluated on each
+    # push and periodically (an agent which stops pushing becomes unreachable)
+    UPDATE_PERIOD_SEC = 10
+
+    def __init__(self, description: str, hub_store: HubStore):
+        CoalescingThing.__init__(
+            self,
+            'urn:dev:ops:netmonitorhub-1',
+            'Internet Monitor Hub',
+            ['MultiLevelSensor'],
+            description
+        )
+        self.hub_store = hub_store
+
+        self.sites = Value(0)
+        self.add_property(
+            Property(self,
+                     'sites',
+                     self.sites,
+                     metadata={
+                         'title': 'Sites',
+                         'type': 'integer',
+                         'description': 'The number of monitored sites (wans) known by the hub',
+                         'readOnly': True,
+                     }))
+
+        self.sites_connected = Value(0)
+        self.add_property(
+            Property(self,
+                     'sites_connected',
+                     self.sites_connected,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Connected sites',
+                         'type': 'integer',
+                         'description': 'The number of sites (wans) which are connected',
+                         'readOnly': True,
+                     }))
+
+        self.sites_down = Value(0)
+        self.add_property(
+            Property(self,
+                     'sites_down',
+                     self.sites_down,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Sites down',
+                         'type': 'integer',
+                         'description': 'The number of sites (wans) which are disconnected or whose agent is unreachable',
+                         'readOnly': True,
+                     }))
+
+        self.down_sites = Value("")
+        self.add_property(
+            Property(self,
+                     'down_sites',
+                     self.down_sites,
+                     metadata={
+                         'title': 'Sites down',
+                         'type': 'string',
+                         'description': 'The comma separated <site>/<wan> which are disconnected or whose agent is unreachable',
+                         'readOnly': True,
+                     }))
+
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.hub_store.add_listener(self.__update)
+        tornado.ioloop.PeriodicCallback(self.__update, InternetMonitorHubWebthing.UPDATE_PERIOD_SEC * 1000).start()
+        self.__update()
+
+    def __update(self):
+        statuses = self.hub_store.statuses()
+        down = sorted([site + "/" + wan for (site, wan), status in statuses.items() if status in ['disconnected', 'unreachable']])
+        for status in ['connected', 'disconnected', 'unreachable', 'unknown']:
+            HUB_SITES.labels(status).set(len([site_status for site_status in statuses.values() if site_status == status]))
+        self.sites.notify_of_external_update(len(statuses))
+        self.sites_connected.notify_of_external_update(len([status for status in statuses.values() if status == 'connected']))
+        self.sites_down.notify_of_external_update(len(down))
+        self.down_sites.notify_of_external_update(", ".join(down))
+
+
+def hub_routes(hub: InternetMonitorHubWebthing, hub_store: HubStore, token: str = None):
+    site = r'/sites/([A-Za-z0-9_-]+)/([A-Za-z0-9_-]+)'
+    return [[r'/properties/?', PropertiesHandler, dict(thing=hub)],
+            [r'/ingest/?', HubIngestHandler, dict(hub_store=hub_store, token=token)],
+            [r'/sites/?', HubSitesHandler, dict(hub_store=hub_store)],
+            [site + r'/history/?', HubConnectivityHistoryHandler, dict(hub_store=hub_store)],
+            [site + r'/report/?', HubOutageReportHandler, dict(hub_store=hub_store)],
+            [site + r'/speed/?', HubSpeedHistoryHandler, dict(hub_store=hub_store)],
+            [r'/rollup/?', HubRollupHandler, dict(hub_store=hub_store)],
+            [r'/metrics/?', MetricsHandler, dict(registry=REGISTRY)],
+            [r'/debug/?', DebugHandler, dict(profiler=PROFILER)]]
+
+
+def run_hub(port: int, description: str, token: str = None, stale_sec: float = HubStore.STALE_SEC, log_sync: str = SYNC_POLICY):
+    hub_store = HubStore(stale_sec=stale_sec, sync=log_sync)
+    hub = InternetMonitorHubWebthing(description, hub_store)
+    print("running " + hub.get_title() + " on port " + str(port))
+    server = WebThingServer(SingleThing(hub), port=port, additional_routes=hub_routes(hub, hub_store, token), disable_host_validation=True)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    try:
+        logging.info('starting the server')
+        server.start()
+    except KeyboardInterrupt:
+        logging.info('stopping the server')
+        server.stop()
+        hub_store.close()
+        logging.info('done')
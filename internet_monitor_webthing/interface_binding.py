@@ -0,0 +1,110 @@
+from typing import Dict, Optional
+import asyncio
+import logging
+import socket
+import struct
+import fcntl
+import os
+
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+SIOCGIFADDR = 0x8915
+
+
+def interface_address(interface: str, family: int = socket.AF_INET) -> str:
+    # the (global) address of a network interface. An empty string is returned, if the interface does not exist
+    # or has no address of this ip version
+    if family == socket.AF_INET6:
+        try:
+            with open("/proc/net/if_inet6") as file:
+                for line in file:
+                    # <address> <ifindex> <prefix length> <scope> <flags> <interface>
+                    fields = line.split()
+                    if len(fields) >= 6 and fields[5] == interface and fields[3] == "00":
+                        return socket.inet_ntop(socket.AF_INET6, bytes.fromhex(fields[0]))
+        except OSError:
+            pass
+        return ""
+    else:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                request = struct.pack('256s', interface[:15].encode('utf-8'))
+                return socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+            except OSError:
+                return ""
+
+
+class InterfaceBinding:
+
+    # binds the sockets of the probes to a network interface (multi-WAN). SO_BINDTODEVICE routes the traffic via the
+    # interface regardless of the routing table, but requires CAP_NET_RAW. Otherwise, the sockets are bound to the
+    # address of the interface only. In this case source based (policy) routing is required to leave via the interface
+    def __init__(self, interface: str):
+        self.interface = interface
+        self.device_binding = True
+
+    def address(self, family: int = socket.AF_INET) -> str:
+        return interface_address(self.interface, family)
+
+    def bind(self, sock: socket.socket, family: int = socket.AF_INET):
+        if self.device_binding:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.interface.encode('utf-8'))
+                return
+            except PermissionError:
+                logging.info("binding to device " + self.interface + " is not permitted (CAP_NET_RAW). Binding to the interface address instead. Source based routing is required")
+                self.device_binding = False
+        address = self.address(family)
+        if address == "":
+            raise ConnectionError("interface " + self.interface + " has no ipv" + ("6" if family == socket.AF_INET6 else "4") + " address")
+        sock.bind((address, 0))
+
+    async def open_connection(self, host: str, port: int, ssl=None, family: int = socket.AF_UNSPEC):
+        # same as asyncio.open_connection() using a bound socket
+        loop = asyncio.get_event_loop()
+        infos = await loop.getaddrinfo(host, port, family=family, type=socket.SOCK_STREAM)
+        error = ConnectionError("can not resolve " + host)
+        for info_family, info_type, info_proto, _, address in infos:
+            sock = socket.socket(info_family, info_type, info_proto)
+            try:
+                sock.setblocking(False)
+                self.bind(sock, info_family)
+                await loop.sock_connect(sock, address)
+                return await asyncio.open_connection(sock=sock, ssl=ssl, server_hostname=host if ssl else None)
+            except OSError as e:
+                sock.close()
+                error = e
+            except BaseException:
+                sock.close()
+                raise
+        raise error
+
+    def __str__(self):
+        return self.interface
+
+
+async def open_connection(host: str, port: int, ssl=None, family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None):
+    if binding is None:
+        return await asyncio.open_connection(host, port, ssl=ssl, family=family)
+    else:
+        return await binding.open_connection(host, port, ssl=ssl, family=family)
+
+
+def parse_wans(wans: str) -> Dict[str, str]:
+    # format: <name>=<interface>,... such as dsl=eth0,lte=wwan0. The interface name is used, if the name is omitted
+    result = {}
+    for wan in [wan.strip() for wan in wans.split(",") if len(wan.strip()) > 0]:
+        name, _, interface = wan.rpartition("=")
+        interface = interface.strip()
+        name = interface if len(name.strip()) == 0 else name.strip()
+        if not name.replace("_", "").replace("-", "").isalnum():
+            raise ValueError("invalid wan name " + name + " (letters, digits, - and _ only)")
+        result[name] = interface
+    return result
+
+
+def wan_dir(wan: str) -> str:
+    # the data directory of a wan. The data of the default route monitor is stored in the parent directory
+    dir = os.path.join("var", "lib", "netmonitor", wan)
+    os.makedirs(dir, exist_ok=True)
+    return dir
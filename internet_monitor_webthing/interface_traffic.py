@@ -0,0 +1,53 @@
+from typing import Optional, Tuple
+import logging
+import time
+
+
+class InterfaceTraffic:
+
+    # reads the byte counters of the network interface from /proc/net/dev (linux only). If no interface is
+    # given, the interface of the default route is used
+    def __init__(self, interface: str = None):
+        self.interface = interface if interface is not None else self.default_route_interface()
+        logging.info("monitoring traffic of interface " + str(self.interface))
+
+    @staticmethod
+    def default_route_interface() -> Optional[str]:
+        try:
+            with open("/proc/net/route") as file:
+                for line in file.readlines()[1:]:
+                    fields = line.split()
+                    if len(fields) > 1 and fields[1] == '00000000':
+                        return fields[0]
+        except Exception as e:
+            logging.warning("error occurred reading default route " + str(e))
+        return None
+
+    def counters(self) -> Optional[Tuple[int, int]]:
+        # returns the received and transmitted bytes. If no interface is known, the counters of all
+        # interfaces (except of loopback) are summed up
+        try:
+            received = 0
+            transmitted = 0
+            with open("/proc/net/dev") as file:
+                for line in file.readlines()[2:]:
+                    name, data = line.split(":", 1)
+                    name = name.strip()
+                    if name == self.interface or (self.interface is None and name != 'lo'):
+                        fields = data.split()
+                        received += int(fields[0])
+                        transmitted += int(fields[8])
+            return received, transmitted
+        except Exception as e:
+            logging.warning("error occurred reading interface counters " + str(e))
+            return None
+
+    def measure(self, duration_sec: float = 2) -> Optional[float]:
+        # returns the traffic (received and transmitted) in bit/sec
+        start = self.counters()
+        started = time.monotonic()
+        time.sleep(duration_sec)
+        end = self.counters()
+        if start is None or end is None:
+            return None
+        return (sum(end) - sum(start)) * 8 / (time.monotonic() - started)
@@ -2,28 +2,86 @@ from typing import List
 from webthing.utils import get_addresses
 from internet_monitor_webthing.connectivity_monitor_webthing import InternetConnectivityMonitorWebthing
 from internet_monitor_webthing.speedtest_monitor_webthing import InternetSpeedMonitorWebthing
+from internet_monitor_webthing.ip_address_resolver import IP_ADDRESS_SOURCES
+from internet_monitor_webthing.interface_binding import parse_wans
+from internet_monitor_webthing.probe_scheduler import StaggeredStart
+from internet_monitor_webthing.ip_info import IpInfo
+from internet_monitor_webthing.record_log import SYNC_POLICY
+from internet_monitor_webthing.hub_agent import HubAgent
+from internet_monitor_webthing.handlers import PropertiesHandler, ConnectivityHistoryHandler, OutageReportHandler, SpeedHistoryHandler, MetricsHandler, DebugHandler
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.profiling import PROFILER
 from webthing import (MultipleThings, WebThingServer)
+import threading
+import signal
+import socket
 import logging
 
 
 
+def stop_on_signal(signum, frame):
+    # the service is stopped by SIGTERM (systemd). The server is stopped the same way as by ctrl-c, so the logs are synced
+    raise KeyboardInterrupt()
 
-def run_server(port: int, description: str, speedtest_period: int, connecttest_period: int, connecttest_url: str):
+
+def additional_routes(services: List) -> List:
+    routes = [[r'/metrics/?', MetricsHandler, dict(registry=REGISTRY)],
+              [r'/debug/?', DebugHandler, dict(profiler=PROFILER)]]
+    for idx, service in enumerate(services):
+        routes.append([r'/' + str(idx) + r'/properties/?', PropertiesHandler, dict(thing=service)])
+        if isinstance(service, InternetConnectivityMonitorWebthing):
+            routes.append([r'/' + str(idx) + r'/history/?', ConnectivityHistoryHandler, dict(connection_log=service.connection_log)])
+            routes.append([r'/' + str(idx) + r'/report/?', OutageReportHandler, dict(analytics=service.connection_log.analytics)])
+        elif isinstance(service, InternetSpeedMonitorWebthing):
+            routes.append([r'/' + str(idx) + r'/history/?', SpeedHistoryHandler, dict(speed_history=service.speed_history)])
+    return routes
+
+
+def run_server(port: int, description: str, speedtest_period: int, connecttest_period: int, connecttest_url: str, connecttest_quorum: int = 1, connecttest_method: str = 'head', latency_target: str = "1.1.1.1:443", latency_period: float = 5, speedtest_busy_threshold: float = 0, speedtest_engine: str = 'speedtest', speedtest_url: str = None, speedtest_streams: int = 4, speedtest_duration: float = 10, ip_address_sources: str = IP_ADDRESS_SOURCES, wans: str = "", hub_url: str = "", site: str = "", hub_token: str = "", log_sync: str = SYNC_POLICY):
     services = []
-    if speedtest_period > 0:
-        services.append(InternetSpeedMonitorWebthing(description, speedtest_period))
-    if connecttest_period > 0:
-        services.append(InternetConnectivityMonitorWebthing(description, connecttest_period, connecttest_url))
+    wan_interfaces = parse_wans(wans)
+    if len(wan_interfaces) == 0:
+        # the default route is monitored
+        if speedtest_period > 0:
+            services.append(InternetSpeedMonitorWebthing(description, speedtest_period, speedtest_busy_threshold, speedtest_engine, speedtest_url, speedtest_streams, speedtest_duration))
+        if connecttest_period > 0:
+            services.append(InternetConnectivityMonitorWebthing(description, connecttest_period, connecttest_url, connecttest_quorum, connecttest_method, latency_target, latency_period, ip_address_sources, log_sync=log_sync))
+    else:
+        # one speed and one connectivity monitor per wan (interface). The probe cycles and the latency samples of
+        # the wans are staggered, the speedtests are executed one after another
+        exclusive = threading.Lock()
+        probe_stagger = StaggeredStart(0.25)
+        latency_stagger = StaggeredStart(max(0.01, latency_period / (2 * len(wan_interfaces))))
+        ip_info = IpInfo()
+        for wan, interface in wan_interfaces.items():
+            if speedtest_period > 0:
+                services.append(InternetSpeedMonitorWebthing(description, speedtest_period, speedtest_busy_threshold, speedtest_engine, speedtest_url, speedtest_streams, speedtest_duration, wan, interface, exclusive))
+            if connecttest_period > 0:
+                services.append(InternetConnectivityMonitorWebthing(description, connecttest_period, connecttest_url, connecttest_quorum, connecttest_method, latency_target, latency_period, ip_address_sources, wan, interface, probe_stagger, latency_stagger, ip_info, log_sync))
+
+    if len(services) > 0 and len(hub_url.strip()) > 0:
+        # the histories are pushed to the hub (fleet mode)
+        agent = HubAgent(hub_url.strip(), site if len(site.strip()) > 0 else socket.gethostname().split(".")[0], hub_token)
+        for service in services:
+            if isinstance(service, InternetConnectivityMonitorWebthing):
+                agent.add_wan(service.wan, connection_log=service.connection_log)
+            else:
+                agent.add_wan(service.wan, speed_history=service.speed_history)
+        agent.start()
 
     if len(services) > 0:
         print("running Internet " + ", ".join([service.get_title() for service in services]) + " on port " + str(port))
-        server = WebThingServer(MultipleThings(services, "Internet Monitor"), port=port, disable_host_validation=True)
+        server = WebThingServer(MultipleThings(services, "Internet Monitor"), port=port, additional_routes=additional_routes(services), disable_host_validation=True)
+        signal.signal(signal.SIGTERM, stop_on_signal)
         try:
             logging.info('starting the server')
             server.start()
         except KeyboardInterrupt:
             logging.info('stopping the server')
             server.stop()
+            for service in services:
+                if isinstance(service, InternetConnectivityMonitorWebthing):
+                    service.connection_log.close()
             logging.info('done')
     else:
         print("no service activated")
\ No newline at end of file
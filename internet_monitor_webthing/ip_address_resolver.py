@@ -0,0 +1,402 @@
+from abc import ABC, abstractmethod
+from typing import List, Optional
+from urllib.parse import urlparse, urljoin
+from xml.etree import ElementTree
+from tornado.httpclient import AsyncHTTPClient
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.interface_binding import InterfaceBinding, open_connection
+import dns.asyncresolver
+import ipaddress
+import asyncio
+import logging
+import socket
+import struct
+import time
+
+
+IP_ADDRESS_RESOLUTIONS = REGISTRY.counter('netmonitor_ip_address_resolutions_total', 'Public ip address resolutions by the source providing the address', ['source'])
+IP_ADDRESS_SOURCE_FAILURES = REGISTRY.counter('netmonitor_ip_address_source_failures_total', 'Failed public ip address queries', ['source'])
+
+
+def parse_address(text: str) -> str:
+    # raises a ValueError, if the text is not an ip address
+    return str(ipaddress.ip_address(text.strip()))
+
+
+def public_address(text: str) -> str:
+    # local sources may report private or carrier-grade NAT addresses which are not the public one
+    address = ipaddress.ip_address(text.strip())
+    if not address.is_global:
+        raise ValueError(str(address) + " is not a public address")
+    return str(address)
+
+
+class IpAddressSource(ABC):
+
+    def __init__(self, target: str, family: int = socket.AF_INET, is_local: bool = False, binding: Optional[InterfaceBinding] = None):
+        self.target = target
+        # the ip version (AF_INET or AF_INET6) of the resolved address
+        self.family = family
+        # local sources query the host or the lan only. They are cheap enough to be polled
+        self.is_local = is_local
+        # if bound, the address of the interface (wan) is resolved instead of the one of the default route
+        self.binding = binding
+
+    async def resolve(self, timeout: float) -> str:
+        try:
+            return await asyncio.wait_for(self.do_resolve(timeout), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug("ip address source " + self.target + " failed " + str(e))
+            IP_ADDRESS_SOURCE_FAILURES.labels(self.target).inc()
+            raise e
+
+    @abstractmethod
+    async def do_resolve(self, timeout: float) -> str:
+        # returns the public ip address or raises an error
+        pass
+
+
+class HttpEchoSource(IpAddressSource):
+
+    # echo services such as http://whatismyip.akamai.com/ returning the address of the client as plain text. The
+    # connection is restricted to the ip version of the source, so the echoed address is the one of this version
+    MAX_RESPONSE_SIZE = 64 * 1024
+
+    def __init__(self, target: str, family: int = socket.AF_INET, binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, family, binding=binding)
+        uri = urlparse(target)
+        self.host = uri.hostname
+        self.ssl = uri.scheme.lower() == 'https'
+        self.port = uri.port if uri.port is not None else (443 if self.ssl else 80)
+        path = uri.path if len(uri.path) > 0 else "/"
+        if len(uri.query) > 0:
+            path = path + "?" + uri.query
+        self.request = ("GET " + path + " HTTP/1.0\r\n" +
+                        "Host: " + uri.netloc + "\r\n" +
+                        "User-Agent: netmonitor\r\n\r\n").encode('ascii')
+
+    async def do_resolve(self, timeout: float) -> str:
+        reader, writer = await open_connection(self.host, self.port, ssl=self.ssl, family=self.family, binding=self.binding)
+        try:
+            writer.write(self.request)
+            await writer.drain()
+            # the server closes the connection after the response (HTTP/1.0)
+            response = await reader.read(HttpEchoSource.MAX_RESPONSE_SIZE)
+            while not reader.at_eof() and len(response) < HttpEchoSource.MAX_RESPONSE_SIZE:
+                response += await reader.read(HttpEchoSource.MAX_RESPONSE_SIZE - len(response))
+        finally:
+            writer.close()
+        header, _, body = response.partition(b'\r\n\r\n')
+        status = int(header.split(b' ', 2)[1])
+        if status < 200 or status >= 300:
+            raise ConnectionError("got status " + str(status))
+        return parse_address(body[:64].decode('ascii', errors='ignore'))
+
+
+class DnsSource(IpAddressSource):
+
+    # target format: dns://<nameserver>/<name> such as dns://208.67.222.222/myip.opendns.com. The name server
+    # answers the query of the special name with the address of the client. A single udp round trip is required.
+    # The ip version of the name server address determines the resolved version (A or AAAA record)
+    def __init__(self, target: str, binding: Optional[InterfaceBinding] = None):
+        uri = urlparse(target)
+        super().__init__(target, socket.AF_INET6 if ipaddress.ip_address(uri.hostname).version == 6 else socket.AF_INET, binding=binding)
+        self.resolver = dns.asyncresolver.Resolver(configure=False)
+        self.resolver.nameservers = [uri.hostname]
+        self.name = uri.path.strip("/")
+        self.record_type = 'AAAA' if self.family == socket.AF_INET6 else 'A'
+
+    async def do_resolve(self, timeout: float) -> str:
+        source = None
+        if self.binding is not None:
+            source = self.binding.address(self.family)
+            if source == "":
+                raise ConnectionError("interface " + str(self.binding) + " has no address to query " + self.resolver.nameservers[0])
+        answer = await self.resolver.resolve(self.name, self.record_type, lifetime=timeout, source=source)
+        return parse_address(answer[0].to_text())
+
+
+class InterfaceSource(IpAddressSource):
+
+    # target format: local:// The address of the default route interface is the public one, if the host is
+    # connected directly (no NAT, which is the common case for ipv6). No packet is sent to determine the source
+    # address of the default route. If bound, the address of the interface is used
+    def __init__(self, target: str = "local://", family: int = socket.AF_INET, binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, family, is_local=True, binding=binding)
+
+    async def do_resolve(self, timeout: float) -> str:
+        return public_address(local_address(self.family, self.binding))
+
+
+def default_route_address(family: int = socket.AF_INET) -> str:
+    # the source address the os selects to reach the internet. Connecting an udp socket does not send any packet.
+    # An empty string is returned, if there is no route of this ip version
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(("2606:4700:4700::1111" if family == socket.AF_INET6 else "1.1.1.1", 53))
+            return sock.getsockname()[0]
+        except OSError:
+            return ""
+
+
+def local_address(family: int = socket.AF_INET, binding: Optional[InterfaceBinding] = None) -> str:
+    # the source address of the default route or of the bound interface
+    return default_route_address(family) if binding is None else binding.address(family)
+
+
+class UpnpSource(IpAddressSource):
+
+    # target format: upnp:// The external (ipv4) address is queried from the internet gateway device (router) of the lan.
+    # If bound, the gateway is searched on the lan of the interface
+    SSDP_ADDRESS = ("239.255.255.250", 1900)
+    SEARCH_TARGET = "urn:schemas-upnp-org:device:InternetGatewayDevice:1"
+    SERVICE_TYPES = ["urn:schemas-upnp-org:service:WANIPConnection:2",
+                     "urn:schemas-upnp-org:service:WANIPConnection:1",
+                     "urn:schemas-upnp-org:service:WANPPPConnection:1"]
+    REDISCOVER_PERIOD_SEC = 10 * 60   # if no gateway has been found
+
+    def __init__(self, target: str = "upnp://", binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, socket.AF_INET, is_local=True, binding=binding)
+        self.control_url = None
+        self.service_type = None
+        self.last_discovery = 0
+
+    async def do_resolve(self, timeout: float) -> str:
+        if self.control_url is None:
+            if time.monotonic() - self.last_discovery < UpnpSource.REDISCOVER_PERIOD_SEC:
+                raise ConnectionError("no upnp gateway found")
+            self.last_discovery = time.monotonic()
+            await self.__discover(timeout)
+        try:
+            return public_address(await self.__external_address(timeout))
+        except (ConnectionError, OSError) as e:
+            self.control_url = None
+            self.last_discovery = 0
+            raise e
+
+    async def __discover(self, timeout: float):
+        location = await self.__search(timeout)
+        response = await AsyncHTTPClient().fetch(location, connect_timeout=timeout, request_timeout=timeout, network_interface=self.__network_interface())
+        description = ElementTree.fromstring(response.body)
+        services = {}
+        for service in description.iter():
+            if service.tag.endswith('}service'):
+                fields = {child.tag.split('}')[-1]: (child.text or "").strip() for child in service}
+                services[fields.get('serviceType')] = fields.get('controlURL')
+        for service_type in UpnpSource.SERVICE_TYPES:
+            if services.get(service_type) is not None:
+                self.service_type = service_type
+                self.control_url = urljoin(location, services[service_type])
+                logging.info("upnp gateway found " + self.control_url + " (" + service_type + ")")
+                return
+        raise ConnectionError("upnp gateway " + location + " does not provide a wan connection service")
+
+    async def __search(self, timeout: float) -> str:
+        loop = asyncio.get_event_loop()
+        location = loop.create_future()
+
+        class SsdpProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                for line in data.decode('ascii', errors='ignore').split("\r\n"):
+                    if line.lower().startswith("location:") and not location.done():
+                        location.set_result(line.split(":", 1)[1].strip())
+
+        request = ("M-SEARCH * HTTP/1.1\r\n" +
+                   "HOST: 239.255.255.250:1900\r\n" +
+                   "MAN: \"ssdp:discover\"\r\n" +
+                   "MX: 2\r\n" +
+                   "ST: " + UpnpSource.SEARCH_TARGET + "\r\n\r\n").encode('ascii')
+        if self.binding is None:
+            transport, protocol = await loop.create_datagram_endpoint(SsdpProtocol, family=socket.AF_INET)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.binding.bind(sock, socket.AF_INET)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.__network_interface()))
+                sock.setblocking(False)
+            except BaseException:
+                sock.close()
+                raise
+            transport, protocol = await loop.create_datagram_endpoint(SsdpProtocol, sock=sock)
+        try:
+            transport.sendto(request, UpnpSource.SSDP_ADDRESS)
+            return await asyncio.wait_for(location, timeout)
+        finally:
+            transport.close()
+
+    async def __external_address(self, timeout: float) -> str:
+        body = ('<?xml version="1.0"?>' +
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">' +
+                '<s:Body><u:GetExternalIPAddress xmlns:u="' + self.service_type + '"/></s:Body></s:Envelope>')
+        response = await AsyncHTTPClient().fetch(self.control_url, method='POST', body=body,
+                                                 headers={'Content-Type': 'text/xml; charset="utf-8"',
+                                                          'SOAPAction': '"' + self.service_type + '#GetExternalIPAddress"'},
+                                                 connect_timeout=timeout, request_timeout=timeout, network_interface=self.__network_interface())
+        for element in ElementTree.fromstring(response.body).iter():
+            if element.tag.split('}')[-1] == 'NewExternalIPAddress':
+                return element.text or ""
+        raise ValueError("upnp response does not include the external address")
+
+    def __network_interface(self) -> Optional[str]:
+        if self.binding is None:
+            return None
+        address = self.binding.address(socket.AF_INET)
+        if address == "":
+            raise ConnectionError("interface " + str(self.binding) + " has no ipv4 address")
+        return address
+
+
+class AddressChangeMonitor:
+
+    # listens to the address and route changes of the kernel (linux rtnetlink). No polling is required
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTM_TYPES = {16: 'new link', 17: 'deleted link', 20: 'new address', 21: 'deleted address', 24: 'new route', 25: 'deleted route'}
+    HEADER = struct.Struct('=LHHLL')
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.sock = None
+
+    def start(self) -> bool:
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.sock.bind((0, AddressChangeMonitor.RTMGRP_LINK | AddressChangeMonitor.RTMGRP_IPV4_IFADDR | AddressChangeMonitor.RTMGRP_IPV4_ROUTE))
+            self.sock.setblocking(False)
+            asyncio.get_event_loop().add_reader(self.sock.fileno(), self.__on_readable)
+            return True
+        except Exception as e:
+            logging.info("address changes can not be monitored (" + str(e) + "). fall back to polling")
+            self.close()
+            return False
+
+    def __on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+            offset = 0
+            events = set()
+            while offset + AddressChangeMonitor.HEADER.size <= len(data):
+                length, msg_type, flags, seq, pid = AddressChangeMonitor.HEADER.unpack_from(data, offset)
+                if msg_type in AddressChangeMonitor.RTM_TYPES.keys():
+                    events.add(AddressChangeMonitor.RTM_TYPES[msg_type])
+                offset += max((length + 3) & ~3, AddressChangeMonitor.HEADER.size)
+            if len(events) > 0:
+                self.listener(", ".join(sorted(events)))
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred reading address changes " + str(e))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                asyncio.get_event_loop().remove_reader(self.sock.fileno())
+            except Exception:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+IP_ADDRESS_SOURCES = "upnp://,local://,dns://208.67.222.222/myip.opendns.com,dns://[2620:119:35::35]/myip.opendns.com,http://whatismyip.akamai.com/"
+
+
+def create_source(target: str, family: int = socket.AF_INET, binding: Optional[InterfaceBinding] = None) -> IpAddressSource:
+    # the family applies to http(s) and local sources. The family of the other ones is given by the source
+    scheme = urlparse(target).scheme.lower()
+    if scheme in ['http', 'https']:
+        return HttpEchoSource(target, family, binding)
+    elif scheme == 'dns':
+        return DnsSource(target, binding)
+    elif scheme == 'local':
+        return InterfaceSource(target, family, binding)
+    elif scheme == 'upnp':
+        return UpnpSource(target, binding)
+    else:
+        raise ValueError("unsupported ip address source " + target + " (supported: http://, https://, dns://<nameserver>/<name>, local://, upnp://)")
+
+
+class IpAddressResolver:
+
+    # the public ip address of an ip version is resolved by racing all sources of this version concurrently. The first valid answer wins.
+    # The resolved address is kept until a change is indicated: the connection has been lost (clear_cache),
+    # the kernel reports an address or route change, the source address of the default route changes or a
+    # local source (router, interface) reports a different address. Remote sources are not queried per probe
+    LOCAL_POLL_PERIOD_SEC = 30
+    RETRY_PERIOD_SEC = 30     # if no source has resolved the address
+    MAX_AGE_SEC = 60 * 60
+
+    def __init__(self, sources: List[str] = None, family: int = socket.AF_INET, max_age_sec: int = MAX_AGE_SEC, binding: Optional[InterfaceBinding] = None):
+        self.family = family
+        self.binding = binding
+        self.sources = [create_source(source.strip(), family, binding) for source in (IP_ADDRESS_SOURCES.split(",") if sources is None else sources) if len(source.strip()) > 0]
+        self.sources = [source for source in self.sources if source.family == family]
+        self.max_age_sec = max_age_sec
+        self.cache_ip_address = ""
+        self.cached_time = 0
+        self.route_address = None
+        self.last_local_poll = 0
+        self.next_retry = 0
+        self.monitor = None
+
+    def clear_cache(self, reason: str = None):
+        if reason is not None and self.cached_time > 0:
+            logging.info("ip address cache invalidated (" + reason + ")")
+        self.cached_time = 0
+        self.next_retry = 0
+
+    async def get_internet_address(self, timeout: float = 5) -> str:
+        if self.monitor is None and self.family == socket.AF_INET:
+            # ipv6 addresses and routes are refreshed periodically by router advertisements. Changes of the
+            # ipv6 address are detected by the default route source address check and the local sources
+            self.monitor = AddressChangeMonitor(self.clear_cache)
+            self.monitor.start()
+        route_address = local_address(self.family, self.binding)
+        if route_address != self.route_address:
+            self.clear_cache(("default route" if self.binding is None else str(self.binding)) + " source address " + str(self.route_address) + " -> " + route_address)
+            self.route_address = route_address
+        if self.cached_time > 0 and time.monotonic() - self.cached_time < self.max_age_sec:
+            await self.__poll_local_sources(timeout)
+        is_stale = self.cached_time == 0 or time.monotonic() - self.cached_time >= self.max_age_sec
+        if is_stale and time.monotonic() >= self.next_retry:
+            address, source = await self.__race(self.sources, timeout)
+            if address is not None:
+                if address != self.cache_ip_address:
+                    logging.info("ip address resolved " + address + " (" + source.target + ")")
+                IP_ADDRESS_RESOLUTIONS.labels(source.target).inc()
+                self.cache_ip_address = address
+                self.cached_time = time.monotonic()
+                self.last_local_poll = self.cached_time
+            else:
+                logging.info("ip address could not be resolved by any source. retry in " + str(IpAddressResolver.RETRY_PERIOD_SEC) + " sec")
+                self.next_retry = time.monotonic() + IpAddressResolver.RETRY_PERIOD_SEC
+        return self.cache_ip_address
+
+    async def __poll_local_sources(self, timeout: float):
+        local_sources = [source for source in self.sources if source.is_local]
+        if len(local_sources) > 0 and time.monotonic() - self.last_local_poll >= IpAddressResolver.LOCAL_POLL_PERIOD_SEC:
+            self.last_local_poll = time.monotonic()
+            address, source = await self.__race(local_sources, timeout)
+            if address is not None and address != self.cache_ip_address:
+                self.clear_cache(source.target + " reports " + address)
+
+    @staticmethod
+    async def __race(sources: List[IpAddressSource], timeout: float):
+        tasks = {asyncio.ensure_future(source.resolve(timeout)): source for source in sources}
+        pending = set(tasks.keys())
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), tasks[task]
+            return None, None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def close(self):
+        if self.monitor is not None:
+            self.monitor.close()
@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+import ipaddress
+import threading
+import ipwhois
+import logging
+import json
+import time
+import os
+
+
+class IpInfo:
+
+    # the ip infos (RDAP/ASN) are cached on disk. Each entry expires individually. Besides the addresses, the
+    # announced prefixes of the ASNs are cached. A new address of a known prefix is resolved without any lookup.
+    # If the max number of entries is exceeded, the least recently used ones are evicted
+    EMPTY_INFO = {'asn': ''}
+    FAILED_LOOKUP_TTL_SEC = 10 * 60
+
+    def __init__(self, filename: str = None, ttl_sec: int = 7 * 24 * 60 * 60, max_entries: int = 1000):
+        if filename is None:
+            dir = os.path.join("var", "lib", "netmonitor")
+            os.makedirs(dir, exist_ok=True)
+            self.filename = os.path.join(dir, "ip_info.json")
+        else:
+            self.filename = filename
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.store_lock = threading.Lock()     # the lookups run on several executor threads. They share the temp file
+        self.addresses = OrderedDict()     # address -> {'asn': ..., 'expires': ...}
+        self.prefixes = OrderedDict()      # cidr -> {'asn': ..., 'expires': ...}
+        self.prefix_index = {}             # (ip version, prefix length) -> {network address as int -> cidr}
+        try:
+            with open(self.filename, "r") as file:
+                data = json.load(file)
+                self.addresses.update(data['addresses'])
+                for cidr, entry in data['prefixes'].items():
+                    self.__add_prefix(cidr, entry)
+                logging.info("ip info cache " + self.filename + " loaded. " + str(len(self.addresses)) + " addresses, " + str(len(self.prefixes)) + " prefixes")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred loading ip info cache " + self.filename + " " + str(e))
+
+    def __add_prefix(self, cidr: str, entry: Dict):
+        network = ipaddress.ip_network(cidr, strict=False)
+        self.prefixes[str(network)] = entry
+        self.prefixes.move_to_end(str(network))
+        self.prefix_index.setdefault((network.version, network.prefixlen), {})[int(network.network_address)] = str(network)
+
+    def __remove_prefix(self, cidr: str):
+        network = ipaddress.ip_network(cidr)
+        del self.prefixes[cidr]
+        index = self.prefix_index.get((network.version, network.prefixlen), {})
+        index.pop(int(network.network_address), None)
+        if len(index) == 0:
+            self.prefix_index.pop((network.version, network.prefixlen), None)
+
+    def __find_prefix(self, ip: str) -> Optional[str]:
+        # the longest matching prefix. The number of checks is the number of distinct prefix lengths
+        address = ipaddress.ip_address(ip)
+        address_bits = 32 if address.version == 4 else 128
+        for version, prefixlen in sorted(self.prefix_index.keys(), key=lambda key: -key[1]):
+            if version == address.version:
+                network_address = int(address) & (((1 << prefixlen) - 1) << (address_bits - prefixlen))
+                cidr = self.prefix_index[(version, prefixlen)].get(network_address)
+                if cidr is not None:
+                    return cidr
+        return None
+
+    def get_cached(self, ip: str) -> Tuple[Optional[Dict[str, str]], bool]:
+        # returns the cached info (or None) and whether it is fresh. No lookup is performed
+        try:
+            with self.lock:
+                entry = self.addresses.get(ip)
+                if entry is not None:
+                    self.addresses.move_to_end(ip)
+                else:
+                    cidr = self.__find_prefix(ip)
+                    if cidr is None:
+                        return None, False
+                    entry = self.prefixes[cidr]
+                    self.prefixes.move_to_end(cidr)
+                return {'asn': entry['asn']}, entry['expires'] > time.time()
+        except ValueError:
+            return None, False
+
+    def get_ip_info(self, ip: str) -> Dict[str, str]:
+        # blocking. Returns the cached info if fresh, otherwise the info is looked up
+        info, is_fresh = self.get_cached(ip)
+        if info is not None and is_fresh:
+            return info
+        return self.lookup(ip)
+
+    def lookup(self, ip: str) -> Dict[str, str]:
+        # blocking RDAP lookup. The result is cached
+        try:
+            rdap = ipwhois.IPWhois(ip).lookup_rdap()
+            asn = str(rdap['asn_description']).replace(",", " ")
+            expires = time.time() + self.ttl_sec
+            with self.lock:
+                self.addresses[ip] = {'asn': asn, 'expires': expires}
+                self.addresses.move_to_end(ip)
+                for cidr in str(rdap.get('asn_cidr', '')).split(","):
+                    try:
+                        self.__add_prefix(cidr.strip(), {'asn': asn, 'expires': expires})
+                    except ValueError:
+                        pass    # e.g. 'NA'
+                self.__evict()
+            self.__store()
+            logging.info('ip info fetched ' + ip + ":" + asn)
+            return {'asn': asn}
+        except Exception as e:
+            logging.info('error occurred fetching ip info of ' + ip + ' ' + str(e))
+            with self.lock:
+                # failed lookups are not repeated for a while
+                if ip not in self.addresses.keys():
+                    self.addresses[ip] = {'asn': '', 'expires': time.time() + IpInfo.FAILED_LOOKUP_TTL_SEC}
+                    self.__evict()
+            return dict(IpInfo.EMPTY_INFO)
+
+    def __evict(self):
+        while len(self.addresses) > self.max_entries:
+            self.addresses.popitem(last=False)
+        while len(self.prefixes) > self.max_entries:
+            self.__remove_prefix(next(iter(self.prefixes.keys())))
+
+    def __store(self):
+        try:
+            # the snapshot is taken under the store lock as well. So the newest snapshot is written last
+            with self.store_lock:
+                with self.lock:
+                    data = json.dumps({'addresses': self.addresses, 'prefixes': self.prefixes, 'time': datetime.now().isoformat()})
+                tempfile = self.filename + ".tmp"
+                with open(tempfile, "w") as file:
+                    file.write(data)
+                os.replace(tempfile, self.filename)
+        except Exception as e:
+            logging.error("error occurred storing ip info cache " + str(e))
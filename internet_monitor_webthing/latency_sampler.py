@@ -0,0 +1,249 @@
+from array import array
+from dataclasses import dataclass
+from typing import Optional
+from tornado.ioloop import IOLoop
+from internet_monitor_webthing.interface_binding import InterfaceBinding, open_connection
+from internet_monitor_webthing.probe_scheduler import StaggeredStart
+import asyncio
+import logging
+import socket
+import struct
+import math
+import time
+import os
+
+
+class LatencyHistogram:
+
+    # log-scaled buckets (similar to DDSketch). Each quantile is accurate within the relative accuracy.
+    # Samples can be added and removed in O(1). A quantile is read in O(number of buckets). No sorting is required
+    MIN_LATENCY_MS = 0.01
+    MAX_LATENCY_MS = 60 * 1000
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.offset = self.__raw_index(LatencyHistogram.MIN_LATENCY_MS)
+        self.counts = array('l', [0] * (self.__raw_index(LatencyHistogram.MAX_LATENCY_MS) - self.offset + 1))
+        self.total = 0
+
+    def __raw_index(self, value: float) -> int:
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def __index(self, value: float) -> int:
+        value = min(max(value, LatencyHistogram.MIN_LATENCY_MS), LatencyHistogram.MAX_LATENCY_MS)
+        return self.__raw_index(value) - self.offset
+
+    def add(self, value: float):
+        self.counts[self.__index(value)] += 1
+        self.total += 1
+
+    def remove(self, value: float):
+        self.counts[self.__index(value)] -= 1
+        self.total -= 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.total == 0:
+            return None
+        rank = q * (self.total - 1)
+        cumulated = 0
+        for idx, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated > rank:
+                # the bucket covers (gamma^(i-1), gamma^i]. Its (relative) center is returned
+                return 2 * math.pow(self.gamma, idx + self.offset) / (self.gamma + 1)
+        return LatencyHistogram.MAX_LATENCY_MS
+
+
+@dataclass
+class LatencyStatistics:
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+    jitter: Optional[float]       # mean deviation of consecutive latencies (RFC 3550 style)
+    loss: float                   # in percent
+    num_samples: int
+
+
+class RollingLatencyStatistics:
+
+    # the statistics are maintained incrementally over the newest <window_size> samples which are stored in a
+    # ring buffer. A lost sample is stored as NaN
+
+    def __init__(self, window_size: int = 300):
+        self.window_size = window_size
+        self.samples = array('d', [math.nan] * window_size)
+        self.deltas = array('d', [math.nan] * window_size)
+        self.position = 0
+        self.num_samples = 0
+        self.num_lost = 0
+        self.deltas_sum = 0.0
+        self.num_deltas = 0
+        self.previous_latency = None
+        self.histogram = LatencyHistogram()
+
+    def add(self, latency_ms: Optional[float]):
+        # evict the oldest sample
+        if self.num_samples == self.window_size:
+            oldest = self.samples[self.position]
+            if math.isnan(oldest):
+                self.num_lost -= 1
+            else:
+                self.histogram.remove(oldest)
+            oldest_delta = self.deltas[self.position]
+            if not math.isnan(oldest_delta):
+                self.deltas_sum -= oldest_delta
+                self.num_deltas -= 1
+        else:
+            self.num_samples += 1
+
+        if latency_ms is None:
+            self.samples[self.position] = math.nan
+            self.deltas[self.position] = math.nan
+            self.num_lost += 1
+        else:
+            self.samples[self.position] = latency_ms
+            self.histogram.add(latency_ms)
+            if self.previous_latency is None:
+                self.deltas[self.position] = math.nan
+            else:
+                delta = abs(latency_ms - self.previous_latency)
+                self.deltas[self.position] = delta
+                self.deltas_sum += delta
+                self.num_deltas += 1
+            self.previous_latency = latency_ms
+        self.position = (self.position + 1) % self.window_size
+
+    def statistics(self) -> LatencyStatistics:
+        return LatencyStatistics(self.__round(self.histogram.quantile(0.5)),
+                                 self.__round(self.histogram.quantile(0.95)),
+                                 self.__round(self.histogram.quantile(0.99)),
+                                 self.__round(self.deltas_sum / self.num_deltas) if self.num_deltas > 0 else None,
+                                 round(100 * self.num_lost / self.num_samples, 1) if self.num_samples > 0 else 0,
+                                 self.num_samples)
+
+    @staticmethod
+    def __round(value: Optional[float]) -> Optional[float]:
+        return None if value is None else round(value, 1)
+
+
+class LatencySampler:
+
+    # samples the latency by ICMP echo requests (requires permission for unprivileged ICMP sockets, see
+    # net.ipv4.ping_group_range). If not permitted, the tcp connect round trip time is measured. If bound, the
+    # latency of the interface is sampled. The samplers of several interfaces share the staggered start
+    RESOLVE_PERIOD_SEC = 5 * 60
+
+    def __init__(self, target: str = "1.1.1.1:443", period_sec: float = 1, window_size: int = 300, timeout_sec: float = 2,
+                 binding: Optional[InterfaceBinding] = None, stagger: Optional[StaggeredStart] = None):
+        host, _, port = target.rpartition(":")
+        self.host = host if len(host) > 0 else port
+        self.port = int(port) if len(host) > 0 else 443
+        self.period_sec = period_sec
+        self.timeout_sec = timeout_sec
+        self.binding = binding
+        self.stagger = stagger
+        self.statistics = RollingLatencyStatistics(window_size)
+        self.icmp_permitted = True
+        self.sequence = 0
+        self.address = None
+        self.resolved = 0
+        self.task = None
+
+    def listen(self, listener):
+        IOLoop.current().add_callback(self.__start, listener)
+
+    def __start(self, listener):
+        self.task = asyncio.ensure_future(self.sample_periodically(listener))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def sample_periodically(self, listener):
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    if self.stagger is not None:
+                        await self.stagger.wait()
+                    self.statistics.add(await self.sample())
+                    listener(self.statistics.statistics())
+                except Exception as e:
+                    logging.error("error occurred sampling latency " + str(e))
+                await asyncio.sleep(max(0, self.period_sec - (time.monotonic() - started)))
+        except asyncio.CancelledError:
+            logging.info("latency sampler stopped")
+            raise
+
+    async def __resolve(self) -> Optional[str]:
+        # the address is cached and re-resolved periodically. If the resolution fails (e.g. during an outage), the
+        # cached address is used. Without a cached address the sample is lost
+        if self.address is None or time.monotonic() - self.resolved > LatencySampler.RESOLVE_PERIOD_SEC:
+            try:
+                loop = asyncio.get_event_loop()
+                infos = await asyncio.wait_for(loop.getaddrinfo(self.host, self.port, family=socket.AF_INET, type=socket.SOCK_STREAM), self.timeout_sec)
+                self.address = infos[0][4][0]
+                self.resolved = time.monotonic()
+            except (asyncio.TimeoutError, OSError) as e:
+                logging.debug("error occurred resolving latency target " + self.host + " " + str(e))
+        return self.address
+
+    async def sample(self) -> Optional[float]:
+        # returns the latency in milliseconds or None, if lost
+        address = await self.__resolve()
+        if address is None:
+            return None
+        if self.icmp_permitted:
+            try:
+                return await asyncio.wait_for(self.__icmp_echo(address), self.timeout_sec)
+            except PermissionError:
+                logging.info("icmp not permitted. Using tcp connect to sample latency")
+                self.icmp_permitted = False
+            except (asyncio.TimeoutError, OSError):
+                # e.g. the (bound) interface is down
+                return None
+        try:
+            return await asyncio.wait_for(self.__tcp_connect(address), self.timeout_sec)
+        except (asyncio.TimeoutError, OSError):
+            return None
+
+    async def __tcp_connect(self, address: str) -> float:
+        started = time.perf_counter()
+        reader, writer = await open_connection(address, self.port, binding=self.binding)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        writer.close()
+        return elapsed_ms
+
+    async def __icmp_echo(self, address: str) -> float:
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        try:
+            sock.setblocking(False)
+            if self.binding is not None:
+                self.binding.bind(sock, socket.AF_INET)
+            sock.connect((address, 0))
+            self.sequence = (self.sequence + 1) % 0xFFFF
+            # echo request: type 8, code 0, checksum, identifier (replaced by the kernel), sequence, payload
+            payload = os.urandom(16)
+            header = struct.pack('!BBHHH', 8, 0, 0, 0, self.sequence)
+            packet = struct.pack('!BBHHH', 8, 0, self.__checksum(header + payload), 0, self.sequence) + payload
+            started = time.perf_counter()
+            await loop.sock_sendall(sock, packet)
+            while True:
+                reply = await loop.sock_recv(sock, 1024)
+                msg_type, _, _, _, sequence = struct.unpack('!BBHHH', reply[:8])
+                if msg_type == 0 and sequence == self.sequence:
+                    return (time.perf_counter() - started) * 1000
+        finally:
+            sock.close()
+
+    @staticmethod
+    def __checksum(data: bytes) -> int:
+        if len(data) % 2 == 1:
+            data += b'\0'
+        checksum = sum(struct.unpack('!' + str(len(data) // 2) + 'H', data))
+        checksum = (checksum >> 16) + (checksum & 0xFFFF)
+        checksum += checksum >> 16
+        return ~checksum & 0xFFFF
@@ -0,0 +1,220 @@
+from typing import Dict, List, Tuple
+from bisect import bisect_left
+import threading
+import math
+
+
+# minimal metrics registry rendering the Prometheus text format as well as OpenMetrics. The metrics are updated
+# whenever a measurement is done. A scrape just renders the current values and never triggers any I/O. Metrics
+# are updated by the io loop as well as by worker threads (e.g. the speedtest runner, the sync timers of the logs)
+# while a scrape renders them on the io loop. The children (label combinations) are created under the lock of the
+# metric and rendered from a snapshot. Increments and observations are locked per child
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    elif math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    elif value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    else:
+        return repr(float(value))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join([name + '="' + value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') + '"' for name, value in labels]) + "}"
+
+
+class Metric:
+
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: List[str] = None):
+        self.name = name
+        self.description = description
+        self.label_names = [] if label_names is None else label_names
+        self.children = {}
+        self.lock = threading.Lock()
+        if len(self.label_names) == 0:
+            self.children[()] = self.create_child()
+
+    def create_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *label_values: str):
+        key = tuple(zip(self.label_names, [str(value) for value in label_values]))
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.get(key)
+                if child is None:
+                    child = self.create_child()
+                    self.children[key] = child
+        return child
+
+    def child_items(self) -> List[Tuple[Tuple[Tuple[str, str], ...], object]]:
+        # a snapshot. Children may be added concurrently
+        with self.lock:
+            return list(self.children.items())
+
+    def family_name(self, openmetrics: bool) -> str:
+        return self.name
+
+    def render(self, openmetrics: bool) -> List[str]:
+        family = self.family_name(openmetrics)
+        lines = ["# HELP " + family + " " + self.description, "# TYPE " + family + " " + self.TYPE]
+        for labels, child in self.child_items():
+            lines.extend(self.render_child(labels, child))
+        return lines
+
+    def render_child(self, labels: Tuple[Tuple[str, str], ...], child) -> List[str]:
+        return [self.name + _format_labels(labels) + " " + _format_value(child.value)]
+
+
+class _Value:
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def set(self, value: float):
+        self.value = math.nan if value is None else value
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def create_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+
+
+class Counter(Metric):
+
+    # the name has to end with _total. OpenMetrics names the family without this suffix
+    TYPE = 'counter'
+
+    def create_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+
+    def family_name(self, openmetrics: bool) -> str:
+        return self.name[:-len("_total")] if openmetrics and self.name.endswith("_total") else self.name
+
+
+class _Buckets:
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)    # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.max = max(self.max, value)
+
+    def snapshot(self) -> Tuple[List[int], float, int, float]:
+        # the buckets, the sum, the count and the max
+        with self.lock:
+            return list(self.counts), self.sum, self.count, self.max
+
+    def quantile(self, q: float, snapshot: Tuple[List[int], float, int, float] = None) -> float:
+        # returns the upper bound of the bucket containing the quantile (the max for the +Inf bucket). If several
+        # figures are computed, they should be computed from the same snapshot
+        counts, _, count_, max_ = self.snapshot() if snapshot is None else snapshot
+        rank = q * count_
+        cumulated = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulated += count
+            if cumulated >= rank:
+                return min(bound, max_)
+        return max_
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, name: str, description: str, label_names: List[str] = None, buckets: List[float] = None):
+        self.buckets = sorted(Histogram.DEFAULT_BUCKETS if buckets is None else buckets)
+        super().__init__(name, description, label_names)
+
+    def create_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def render_child(self, labels: Tuple[Tuple[str, str], ...], child) -> List[str]:
+        lines = []
+        cumulated = 0
+        counts, sum_, count_, _ = child.snapshot()   # the buckets, the sum and the count are consistent
+        for bound, count in zip(self.buckets + [math.inf], counts):
+            cumulated += count
+            lines.append(self.name + "_bucket" + _format_labels(labels + (('le', _format_value(bound)),)) + " " + str(cumulated))
+        lines.append(self.name + "_sum" + _format_labels(labels) + " " + _format_value(sum_))
+        lines.append(self.name + "_count" + _format_labels(labels) + " " + str(count_))
+        return lines
+
+
+class MetricsRegistry:
+
+    PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics.keys():
+            raise ValueError("metric " + metric.name + " is registered already")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name: str, description: str, label_names: List[str] = None) -> Gauge:
+        return self.register(Gauge(name, description, label_names))
+
+    def counter(self, name: str, description: str, label_names: List[str] = None) -> Counter:
+        return self.register(Counter(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: List[str] = None, buckets: List[float] = None) -> Histogram:
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def render(self, openmetrics: bool = False) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# shared by all persistent stores
+STORE_WRITE_SECONDS = REGISTRY.histogram('netmonitor_store_write_seconds', 'Time to write a record to a persistent store', ['store'],
+                                         buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1])
+STORE_SYNC_SECONDS = REGISTRY.histogram('netmonitor_store_sync_seconds', 'Time to sync the appended records of a write-ahead log to the disk',
+                                        buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1])
@@ -0,0 +1,276 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+import copy
+
+
+def period_start(period: str, date: datetime) -> datetime:
+    day = datetime(date.year, date.month, date.day)
+    if period == 'day':
+        return day
+    elif period == 'week':
+        return day - timedelta(days=day.weekday())
+    else:
+        return datetime(date.year, date.month, 1)
+
+
+def period_key(period: str, start: datetime) -> str:
+    if period == 'day':
+        return start.strftime('%Y-%m-%d')
+    elif period == 'week':
+        return start.strftime('%G-W%V')
+    else:
+        return start.strftime('%Y-%m')
+
+
+def next_day(date: datetime) -> datetime:
+    day = datetime(date.year, date.month, date.day)
+    return day + timedelta(days=1)
+
+
+class OutageAnalytics:
+
+    # running aggregates of the connectivity history. Each state change updates the aggregates incrementally. The
+    # time since the last state change (the open interval) is added at read time. Reading the figures of the current
+    # periods is O(1), the report is bounded by the number of retained periods instead of the history size
+    RETAINED_PERIODS = {'day': 90, 'week': 52, 'month': 24}
+    OUTAGE_HISTOGRAM_SEC = [60, 5 * 60, 15 * 60, 60 * 60, 6 * 60 * 60, 24 * 60 * 60]
+    MAX_ASNS = 50
+    STATE_VERSION = 1
+
+    def __init__(self):
+        self.since = None           # the first observation
+        self.changed = None         # the (estimated) date of the last connectivity state change
+        self.accumulated = None     # the aggregates cover the time until this date
+        self.is_connected = None
+        self.asn = ""
+        self.outage_asn = ""        # the asn of the connection lost by the current outage
+        self.connected_sec = 0
+        self.disconnected_sec = 0
+        self.outages = 0
+        self.finished_outages = 0
+        self.finished_outage_sec = 0
+        self.longest_outage_sec = 0
+        self.outage_histogram = [0] * (len(OutageAnalytics.OUTAGE_HISTOGRAM_SEC) + 1)
+        self.periods = {period: OrderedDict() for period in OutageAnalytics.RETAINED_PERIODS.keys()}   # key -> aggregates
+        self.asns = OrderedDict()   # asn -> aggregates
+
+    def add(self, date: datetime, is_connected: bool, asn: str = ""):
+        # the state changes have to be added in chronological order
+        if self.accumulated is None:
+            self.since = date
+        else:
+            date = max(date, self.accumulated)
+            self.__accumulate(self.periods, self.asns, self.accumulated, date, self.is_connected, self.asn)
+            if self.is_connected and not is_connected:
+                self.outages += 1
+                self.outage_asn = self.asn
+                for period, aggregates_by_key in self.periods.items():
+                    self.__period(aggregates_by_key, period, date)['outages'] += 1
+                self.__asn(self.asns, self.asn)['outages'] += 1
+            elif not self.is_connected and is_connected and self.outages > 0:
+                outage_sec = (date - self.changed).total_seconds()
+                self.finished_outages += 1
+                self.finished_outage_sec += outage_sec
+                self.longest_outage_sec = max(self.longest_outage_sec, outage_sec)
+                self.outage_histogram[self.__histogram_idx(outage_sec)] += 1
+                self.__asn(self.asns, self.outage_asn)['outage_sec'] += outage_sec
+        if self.changed is None or is_connected != self.is_connected:
+            self.changed = date
+        self.accumulated = date
+        self.is_connected = is_connected
+        if is_connected:
+            self.asn = asn
+
+    def state(self) -> Dict:
+        # the aggregates as json serializable dict (e.g. to checkpoint them). The dates are epoch seconds
+        def timestamp(date: Optional[datetime]) -> Optional[float]:
+            return None if date is None else date.timestamp()
+        return {'version': OutageAnalytics.STATE_VERSION,
+                'since': timestamp(self.since),
+                'changed': timestamp(self.changed),
+                'accumulated': timestamp(self.accumulated),
+                'is_connected': self.is_connected,
+                'asn': self.asn,
+                'outage_asn': self.outage_asn,
+                'connected_sec': self.connected_sec,
+                'disconnected_sec': self.disconnected_sec,
+                'outages': self.outages,
+                'finished_outages': self.finished_outages,
+                'finished_outage_sec': self.finished_outage_sec,
+                'longest_outage_sec': self.longest_outage_sec,
+                'outage_histogram': self.outage_histogram,
+                'periods': {period: list(aggregates_by_key.items()) for period, aggregates_by_key in self.periods.items()},
+                'asns': list(self.asns.items())}
+
+    @staticmethod
+    def of_state(state: Dict):
+        # raises a ValueError, if the state is invalid or has been written by another version
+        def date(timestamp: Optional[float]) -> Optional[datetime]:
+            return None if timestamp is None else datetime.fromtimestamp(timestamp)
+        try:
+            if state['version'] != OutageAnalytics.STATE_VERSION:
+                raise ValueError("unsupported analytics state version " + str(state['version']))
+            analytics = OutageAnalytics()
+            analytics.since = date(state['since'])
+            analytics.changed = date(state['changed'])
+            analytics.accumulated = date(state['accumulated'])
+            analytics.is_connected = state['is_connected']
+            analytics.asn = state['asn']
+            analytics.outage_asn = state['outage_asn']
+            analytics.connected_sec = state['connected_sec']
+            analytics.disconnected_sec = state['disconnected_sec']
+            analytics.outages = state['outages']
+            analytics.finished_outages = state['finished_outages']
+            analytics.finished_outage_sec = state['finished_outage_sec']
+            analytics.longest_outage_sec = state['longest_outage_sec']
+            if len(state['outage_histogram']) != len(analytics.outage_histogram):
+                raise ValueError("analytics state histogram does not match")
+            analytics.outage_histogram = list(state['outage_histogram'])
+            for period in analytics.periods.keys():
+                analytics.periods[period] = OrderedDict((key, dict(aggregates)) for key, aggregates in state['periods'][period])
+            analytics.asns = OrderedDict((asn, dict(aggregates)) for asn, aggregates in state['asns'])
+            return analytics
+        except (KeyError, TypeError, OverflowError, OSError) as e:
+            raise ValueError("invalid analytics state " + str(e))
+
+    @staticmethod
+    def __histogram_idx(outage_sec: float) -> int:
+        for idx, limit in enumerate(OutageAnalytics.OUTAGE_HISTOGRAM_SEC):
+            if outage_sec < limit:
+                return idx
+        return len(OutageAnalytics.OUTAGE_HISTOGRAM_SEC)
+
+    @staticmethod
+    def __period(aggregates_by_key: OrderedDict, period: str, date: datetime) -> Dict:
+        key = period_key(period, period_start(period, date))
+        aggregates = aggregates_by_key.get(key, None)
+        if aggregates is None:
+            aggregates = {'connected_sec': 0, 'disconnected_sec': 0, 'outages': 0}
+            aggregates_by_key[key] = aggregates
+            while len(aggregates_by_key) > OutageAnalytics.RETAINED_PERIODS[period]:
+                aggregates_by_key.popitem(last=False)
+        return aggregates
+
+    @staticmethod
+    def __asn(asns: Dict, asn: str) -> Dict:
+        aggregates = asns.get(asn, None)
+        if aggregates is None:
+            aggregates = {'connected_sec': 0, 'outages': 0, 'outage_sec': 0}
+            asns[asn] = aggregates
+            while len(asns) > OutageAnalytics.MAX_ASNS:
+                asns.popitem(last=False)
+        else:
+            asns.move_to_end(asn)
+        return aggregates
+
+    def __accumulate(self, periods: Dict, asns: Dict, start: datetime, end: datetime, is_connected: bool, asn: str, totals: bool = True):
+        # the interval is split by days. A day belongs to exactly one week and one month
+        state = 'connected_sec' if is_connected else 'disconnected_sec'
+        if totals:
+            if is_connected:
+                self.connected_sec += (end - start).total_seconds()
+            else:
+                self.disconnected_sec += (end - start).total_seconds()
+        if is_connected:
+            self.__asn(asns, asn)['connected_sec'] += (end - start).total_seconds()
+        piece_start = start
+        while piece_start < end:
+            piece_end = min(end, next_day(piece_start))
+            for period in periods.keys():
+                self.__period(periods[period], period, piece_start)[state] += (piece_end - piece_start).total_seconds()
+            piece_start = piece_end
+
+    def __open_interval_sec(self, start: datetime, now: datetime) -> float:
+        # the part of the open interval (since the last added entry) which overlaps the period starting at start
+        if self.accumulated is None:
+            return 0
+        return max(0.0, (now - max(self.accumulated, start)).total_seconds())
+
+    def uptime(self, period: str, now: datetime = None) -> Optional[float]:
+        # the uptime in percent of the current day, week or month. O(1)
+        now = datetime.now() if now is None else now
+        start = period_start(period, now)
+        aggregates = self.periods[period].get(period_key(period, start), {'connected_sec': 0, 'disconnected_sec': 0})
+        connected_sec = aggregates['connected_sec']
+        disconnected_sec = aggregates['disconnected_sec']
+        if self.is_connected:
+            connected_sec += self.__open_interval_sec(start, now)
+        elif self.is_connected is not None:
+            disconnected_sec += self.__open_interval_sec(start, now)
+        return self.__percent(connected_sec, disconnected_sec)
+
+    @staticmethod
+    def __percent(connected_sec: float, disconnected_sec: float) -> Optional[float]:
+        if connected_sec + disconnected_sec <= 0:
+            return None
+        return round(100 * connected_sec / (connected_sec + disconnected_sec), 3)
+
+    def mtbf_sec(self, now: datetime = None) -> Optional[float]:
+        # mean time between failures: the connected time per outage
+        if self.outages == 0:
+            return None
+        connected_sec = self.connected_sec + (self.__open_interval_sec(self.accumulated, datetime.now() if now is None else now) if self.is_connected else 0)
+        return round(connected_sec / self.outages, 1)
+
+    def mttr_sec(self) -> Optional[float]:
+        # mean time to repair: the duration of the finished outages
+        if self.finished_outages == 0:
+            return None
+        return round(self.finished_outage_sec / self.finished_outages, 1)
+
+    def __open_interval_start(self, now: datetime) -> datetime:
+        # the open interval is accumulated back to the oldest retained period at most
+        oldest = period_start('day', now) - timedelta(days=max(OutageAnalytics.RETAINED_PERIODS['day'], 31 * OutageAnalytics.RETAINED_PERIODS['month']))
+        return max(self.accumulated, oldest)
+
+    def period_totals(self, period: str, now: datetime = None) -> OrderedDict:
+        # the aggregates (connected_sec, disconnected_sec, outages) of the retained days, weeks or months including the
+        # open interval. The open interval is added to a copy. O(number of retained periods)
+        now = datetime.now() if now is None else now
+        periods = {period: copy.deepcopy(self.periods[period])}
+        if self.accumulated is not None and now > self.accumulated:
+            self.__accumulate(periods, {}, self.__open_interval_start(now), now, self.is_connected, self.asn, totals=False)
+        return periods[period]
+
+    def report(self, now: datetime = None) -> Dict:
+        now = datetime.now() if now is None else now
+        periods = copy.deepcopy(self.periods)
+        asns = copy.deepcopy(self.asns)
+        if self.accumulated is not None and now > self.accumulated:
+            # the open interval is added to copies of the retained periods only
+            start = self.__open_interval_start(now)
+            self.__accumulate(periods, asns, start, now, self.is_connected, self.asn, totals=False)
+            if self.is_connected:
+                asns[self.asn]['connected_sec'] += (start - self.accumulated).total_seconds()
+        histogram_labels = ["<" + self.__print_duration(limit) for limit in OutageAnalytics.OUTAGE_HISTOGRAM_SEC] + \
+                           [">=" + self.__print_duration(OutageAnalytics.OUTAGE_HISTOGRAM_SEC[-1])]
+        return {'since': None if self.since is None else self.since.isoformat(),
+                'connected': self.is_connected,
+                'state_since': None if self.changed is None else self.changed.isoformat(),
+                'uptime': {period: [{'period': key,
+                                     'uptime': self.__percent(aggregates['connected_sec'], aggregates['disconnected_sec']),
+                                     'outages': aggregates['outages'],
+                                     'outage_sec': round(aggregates['disconnected_sec'], 1)}
+                                    for key, aggregates in periods[period].items()]
+                           for period in periods.keys()},
+                'outages': {'count': self.outages,
+                            'finished': self.finished_outages,
+                            'mttr_sec': self.mttr_sec(),
+                            'mtbf_sec': self.mtbf_sec(now),
+                            'longest_sec': round(self.longest_outage_sec, 1),
+                            'histogram': dict(zip(histogram_labels, self.outage_histogram))},
+                'asn': {asn: {'connected_sec': round(aggregates['connected_sec'], 1),
+                              'outages': aggregates['outages'],
+                              'outage_sec': round(aggregates['outage_sec'], 1),
+                              'mtbf_sec': None if aggregates['outages'] == 0 else round(aggregates['connected_sec'] / aggregates['outages'], 1)}
+                        for asn, aggregates in asns.items()}}
+
+    @staticmethod
+    def __print_duration(duration_sec: float) -> str:
+        if duration_sec >= 24 * 60 * 60:
+            return str(int(duration_sec / (24 * 60 * 60))) + "d"
+        elif duration_sec >= 60 * 60:
+            return str(int(duration_sec / (60 * 60))) + "h"
+        else:
+            return str(int(duration_sec / 60)) + "min"
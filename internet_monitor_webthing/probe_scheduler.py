@@ -0,0 +1,65 @@
+from typing import Optional
+import asyncio
+import time
+
+
+class AdaptiveProbeScheduler:
+
+    MIN_PERIOD_SEC = 0.5
+    BACKOFF_FACTOR = 2
+    MIN_TIMEOUT_SEC = 1
+    MAX_TIMEOUT_SEC = 5
+    MAX_CONFIRM_TIMEOUT_SEC = 10
+    LATENCY_SMOOTHING = 0.2       # weight of the newest latency of the exponential moving average
+    LATENCY_ALERT_FACTOR = 3      # latency (compared to the average) which is considered as suspicious
+
+    def __init__(self, max_period_sec: float):
+        self.max_period_sec = max(max_period_sec, AdaptiveProbeScheduler.MIN_PERIOD_SEC)
+        self.period_sec = AdaptiveProbeScheduler.MIN_PERIOD_SEC
+        self.latency_avg_ms = None
+
+    def timeout(self) -> float:
+        # timeout of the first trial. A response which takes much longer than usual is likely to be lost
+        if self.latency_avg_ms is None:
+            return AdaptiveProbeScheduler.MAX_TIMEOUT_SEC
+        else:
+            return min(AdaptiveProbeScheduler.MAX_TIMEOUT_SEC, max(AdaptiveProbeScheduler.MIN_TIMEOUT_SEC, self.latency_avg_ms * 10 / 1000))
+
+    def confirm_timeout(self) -> float:
+        # timeout of the second trial which confirms a failed first trial
+        return min(AdaptiveProbeScheduler.MAX_CONFIRM_TIMEOUT_SEC, self.timeout() * 3)
+
+    def next_period(self, is_connected: bool, num_failed_probes: int, latency_ms: Optional[float]) -> float:
+        # probes are executed with the min period as long as something is suspicious. Otherwise the period
+        # is increased step by step up to the max period
+        suspicious = not is_connected or num_failed_probes > 0
+        if latency_ms is not None:
+            if self.latency_avg_ms is None:
+                self.latency_avg_ms = latency_ms
+            else:
+                suspicious = suspicious or latency_ms > self.latency_avg_ms * AdaptiveProbeScheduler.LATENCY_ALERT_FACTOR
+                self.latency_avg_ms = (1 - AdaptiveProbeScheduler.LATENCY_SMOOTHING) * self.latency_avg_ms + AdaptiveProbeScheduler.LATENCY_SMOOTHING * latency_ms
+
+        if suspicious:
+            self.period_sec = AdaptiveProbeScheduler.MIN_PERIOD_SEC
+        else:
+            self.period_sec = min(self.period_sec * AdaptiveProbeScheduler.BACKOFF_FACTOR, self.max_period_sec)
+        return self.period_sec
+
+
+class StaggeredStart:
+
+    # shared by the monitors of several interfaces (multi-WAN). The probe cycles (or latency samples) of the
+    # interfaces are started one after another with a min gap, so they do not contend for the cpu, the lan and the
+    # local resolver. A waiting monitor does not request the next slot before its current cycle is done. For this
+    # reason the delay is bounded by the number of monitors times the gap
+    def __init__(self, min_gap_sec: float):
+        self.min_gap_sec = min_gap_sec
+        self.next_slot = 0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.min_gap_sec
+        if slot > now:
+            await asyncio.sleep(slot - now)
@@ -0,0 +1,231 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlparse
+from tornado.httpclient import AsyncHTTPClient
+from internet_monitor_webthing.profiling import span
+from internet_monitor_webthing.interface_binding import InterfaceBinding, open_connection
+import dns.asyncresolver
+import dns.message
+import ipaddress
+import asyncio
+import socket
+import logging
+import time
+
+
+@dataclass
+class ProbeResult:
+    target: str
+    is_connected: bool
+    latency_ms: Optional[float]
+    num_bytes: int = 0     # payload bytes sent and received (without tcp/ip and tls overhead)
+
+
+class UnexpectedStatus(Exception):
+    pass
+
+
+class Probe(ABC):
+
+    # the family restricts the probe to an ip version (AF_INET or AF_INET6). AF_UNSPEC leaves the choice to the os.
+    # If bound, the probe is sent via the interface of the binding instead of the default route
+    def __init__(self, target: str, family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None):
+        self.target = target
+        self.family = family
+        self.binding = binding
+        qualifiers = ([] if binding is None else [str(binding)]) + (["ipv6"] if family == socket.AF_INET6 else [])
+        self.name = target if len(qualifiers) == 0 else target + " (" + ", ".join(qualifiers) + ")"
+
+    async def check(self, timeout: float) -> ProbeResult:
+        start = time.monotonic()
+        try:
+            with span('probe', type(self).__name__):
+                num_bytes = await asyncio.wait_for(self.do_check(timeout), timeout)
+            return ProbeResult(self.name, True, round((time.monotonic() - start) * 1000, 1), num_bytes)
+        except Exception as e:
+            logging.info("probe " + self.name + " failed " + str(e))
+            return ProbeResult(self.name, False, None)
+
+    @abstractmethod
+    async def do_check(self, timeout: float) -> int:
+        # returns the number of payload bytes transferred
+        pass
+
+
+class HttpGetProbe(Probe):
+
+    async def do_check(self, timeout: float) -> int:
+        # any response (including error status codes) proves connectivity. The tornado client can be restricted to ipv4 only.
+        # It can be bound to the interface address, but not to the device
+        network_interface = None if self.binding is None else self.binding.address(socket.AF_INET)
+        if network_interface == "":
+            raise ConnectionError("interface " + str(self.binding) + " has no ipv4 address")
+        response = await AsyncHTTPClient().fetch(self.target, connect_timeout=timeout, request_timeout=timeout, raise_error=False, allow_ipv6=self.family != socket.AF_INET, network_interface=network_interface)
+        header_size = sum([len(name) + len(value) + 4 for name, value in response.headers.get_all()])
+        return len(self.target) + header_size + len(response.body)
+
+
+class HttpHeadProbe(Probe):
+
+    # connections idling longer than this may have been dropped silently by NAT routers
+    MAX_IDLE_SEC = 30
+
+    def __init__(self, target: str, expected_status: int = None, family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, family, binding)
+        uri = urlparse(target)
+        self.host = uri.hostname
+        self.ssl = uri.scheme.lower() == 'https'
+        self.port = uri.port if uri.port is not None else (443 if self.ssl else 80)
+        self.expected_status = expected_status
+        path = uri.path if len(uri.path) > 0 else "/"
+        if len(uri.query) > 0:
+            path = path + "?" + uri.query
+        self.request = ("HEAD " + path + " HTTP/1.1\r\n" +
+                        "Host: " + uri.netloc + "\r\n" +
+                        "User-Agent: netmonitor\r\n" +
+                        "Connection: keep-alive\r\n\r\n").encode('ascii')
+        self.reader = None
+        self.writer = None
+        self.last_used = 0
+        self.lock = None    # created on first use. The probe may be built outside of the io loop running it
+
+    async def do_check(self, timeout: float) -> int:
+        # the connection is shared. A check still running from the previous cycle has to be completed first
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            reused = self.__is_reusable()
+            try:
+                return await self.__head()
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                # a response with an unexpected status (UnexpectedStatus) is not retried
+                self.close()
+                if reused:
+                    # the server has closed the idle keep-alive connection meanwhile. Retry using a new one
+                    return await self.__head()
+                else:
+                    raise e
+
+    def __is_reusable(self) -> bool:
+        return self.writer is not None and \
+               not self.writer.is_closing() and \
+               not self.reader.at_eof() and \
+               (time.monotonic() - self.last_used) < HttpHeadProbe.MAX_IDLE_SEC
+
+    async def __head(self) -> int:
+        try:
+            if not self.__is_reusable():
+                self.close()
+                self.reader, self.writer = await open_connection(self.host, self.port, ssl=self.ssl, family=self.family, binding=self.binding)
+            self.writer.write(self.request)
+            await self.writer.drain()
+            # a response to a HEAD request does not include a body
+            header = await self.reader.readuntil(b'\r\n\r\n')
+            self.last_used = time.monotonic()
+            status = int(header.split(b' ', 2)[1])
+            if b'connection: close' in header.lower():
+                self.close()
+            if self.expected_status is not None and status != self.expected_status:
+                raise UnexpectedStatus("got status " + str(status) + " (expected " + str(self.expected_status) + "). Captive portal?")
+            return len(self.request) + len(header)
+        except BaseException as e:
+            self.close()
+            raise e
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+
+class TcpProbe(Probe):
+
+    # target format: tcp://<host>:<port>
+    def __init__(self, target: str, family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, family, binding)
+        uri = urlparse(target)
+        self.host = uri.hostname
+        self.port = uri.port if uri.port is not None else 443
+
+    async def do_check(self, timeout: float) -> int:
+        # the tcp handshake is sufficient. No payload is transferred
+        reader, writer = await open_connection(self.host, self.port, family=self.family, binding=self.binding)
+        writer.close()
+        await writer.wait_closed()
+        return 0
+
+
+class DnsProbe(Probe):
+
+    # target format: dns://<name> (using the system name servers) or dns://<nameserver>/<name>. If restricted to
+    # an ip version, the name servers of this version are queried only. If bound, the queries are sent from the interface address
+    def __init__(self, target: str, family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None):
+        super().__init__(target, family, binding)
+        uri = urlparse(target)
+        self.resolver = dns.asyncresolver.Resolver()
+        if len(uri.path.strip("/")) > 0:
+            self.resolver.nameservers = [uri.hostname]
+            self.query_name = uri.path.strip("/")
+        else:
+            self.query_name = uri.hostname
+        if family != socket.AF_UNSPEC:
+            self.resolver.nameservers = [nameserver for nameserver in self.resolver.nameservers if address_family(nameserver) == family]
+
+        self.query_size = len(dns.message.make_query(self.query_name, 'A').to_wire())
+
+    async def do_check(self, timeout: float) -> int:
+        # the query bypasses the local (os) resolver cache. A cached answer does not prove connectivity
+        if self.binding is None:
+            answer = await self.resolver.resolve(self.query_name, 'A', lifetime=timeout)
+        else:
+            source = self.binding.address(address_family(self.resolver.nameservers[0]))
+            if source == "":
+                raise ConnectionError("interface " + str(self.binding) + " has no address to query " + self.resolver.nameservers[0])
+            answer = await self.resolver.resolve(self.query_name, 'A', lifetime=timeout, source=source)
+        return self.query_size + len(answer.response.to_wire())
+
+
+def address_family(host: str) -> Optional[int]:
+    # the family of an ip address literal. None, if the host is a name
+    try:
+        return socket.AF_INET6 if ipaddress.ip_address(host).version == 6 else socket.AF_INET
+    except ValueError:
+        return None
+
+
+PROBE_METHODS = ['head', 'get', '204', 'tcp']
+
+
+def create_probe(target: str, method: str = 'head', family: int = socket.AF_UNSPEC, binding: Optional[InterfaceBinding] = None) -> Optional[Probe]:
+    # the method applies to http(s) targets only:
+    #   head: HEAD request using a keep-alive connection
+    #   get: GET request downloading the full page (legacy behaviour)
+    #   204: HEAD request expecting status 204 such as http://connectivitycheck.gstatic.com/generate_204 (detects captive portals)
+    #   tcp: tcp handshake with the http(s) server only
+    # None is returned, if the target can not be probed using the requested ip version (family)
+    uri = urlparse(target)
+    scheme = uri.scheme.lower()
+    if family != socket.AF_UNSPEC and address_family(uri.hostname) not in [None, family]:
+        return None
+    if scheme in ['http', 'https']:
+        if method == 'get' and family != socket.AF_INET6:
+            return HttpGetProbe(target, family, binding)
+        elif method == '204':
+            return HttpHeadProbe(target, 204, family, binding)
+        elif method == 'tcp':
+            host = "[" + uri.hostname + "]" if address_family(uri.hostname) == socket.AF_INET6 else uri.hostname
+            return TcpProbe("tcp://" + host + ":" + str(uri.port if uri.port is not None else (443 if scheme == 'https' else 80)), family, binding)
+        elif method in ['head', 'get']:
+            # the tornado client can not be restricted to ipv6. GET targets are probed using HEAD requests via ipv6
+            return HttpHeadProbe(target, family=family, binding=binding)
+        else:
+            raise ValueError("unsupported probe method " + method + " (supported: " + ", ".join(PROBE_METHODS) + ")")
+    elif scheme == 'tcp':
+        return TcpProbe(target, family, binding)
+    elif scheme == 'dns':
+        probe = DnsProbe(target, family, binding)
+        return probe if len(probe.resolver.nameservers) > 0 else None
+    else:
+        raise ValueError("unsupported probe target " + target + " (supported: http://, https://, tcp://, dns://)")
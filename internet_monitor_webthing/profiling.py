@@ -0,0 +1,161 @@
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Tuple
+from internet_monitor_webthing.metrics import REGISTRY
+import threading
+import logging
+import time
+import sys
+import os
+
+
+# the stages of the monitor loops are timed by spans. The durations are kept in a histogram (a few integer
+# increments per span) which is exposed by the metrics and the debug resource
+STAGE_SECONDS = REGISTRY.histogram('netmonitor_stage_duration_seconds', 'Duration of the stages of the monitor loops', ['component', 'stage'],
+                                   buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+
+# the speedtest stages are executed by a worker process. The worker forwards its spans to the webthing process
+_span_forwarder = None
+
+
+def forward_spans(forwarder):
+    global _span_forwarder
+    _span_forwarder = forwarder
+
+
+def record_span(component: str, stage: str, elapsed_sec: float):
+    if _span_forwarder is None:
+        STAGE_SECONDS.labels(component, stage).observe(elapsed_sec)
+    else:
+        _span_forwarder(component, stage, elapsed_sec)
+
+
+class span:
+
+    # usage: with span('connectivity', 'ip_info'): ...  (works for awaits within the block as well)
+
+    def __init__(self, component: str, stage: str):
+        self.component = component
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record_span(self.component, self.stage, time.perf_counter() - self.started)
+        return False
+
+
+def stage_timings() -> Dict[str, Dict[str, Dict[str, float]]]:
+    # returns the stage statistics in milliseconds per component and stage
+    timings = {}
+    for labels, buckets in STAGE_SECONDS.child_items():
+        # the figures are computed from a snapshot. The spans are observed concurrently by other threads
+        snapshot = buckets.snapshot()
+        _, sum_, count_, max_ = snapshot
+        if count_ == 0:
+            continue
+        component = labels[0][1]
+        stage = labels[1][1]
+        timings.setdefault(component, {})[stage] = {'count': count_,
+                                                    'avg_ms': round(sum_ * 1000 / count_, 3),
+                                                    'p50_ms': round(buckets.quantile(0.5, snapshot) * 1000, 3),
+                                                    'p95_ms': round(buckets.quantile(0.95, snapshot) * 1000, 3),
+                                                    'max_ms': round(max_ * 1000, 3),
+                                                    'total_sec': round(sum_, 3)}
+    return timings
+
+
+class SamplingProfiler:
+
+    # on-demand sampling profiler. While running, a thread periodically captures the stacks of all other threads
+    # of this process. Nothing is done while the profiler is not running
+    MAX_DURATION_SEC = 5 * 60
+    MAX_STACK_DEPTH = 40
+
+    def __init__(self, interval_sec: float = 0.005):
+        self.interval_sec = interval_sec
+        self.stacks = Counter()
+        self.num_samples = 0
+        self.started = None
+        self.duration_sec = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration_sec: float, done_callback = None) -> bool:
+        if self.is_running():
+            return False
+        self.stacks = Counter()
+        self.num_samples = 0
+        self.started = time.time()
+        self.duration_sec = min(max(duration_sec, 0), SamplingProfiler.MAX_DURATION_SEC)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__sample, args=(done_callback,), daemon=True, name="sampling profiler")
+        self.thread.start()
+        logging.info("profiling for " + str(self.duration_sec) + " sec")
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def __sample(self, done_callback):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.duration_sec
+        try:
+            while time.monotonic() < deadline and not self.stopped.is_set():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_id:
+                        self.stacks[(names.get(thread_id, str(thread_id)),) + self.__stack(frame)] += 1
+                self.num_samples += 1
+                self.stopped.wait(self.interval_sec)
+        except Exception as e:
+            logging.error("error occurred profiling " + str(e))
+        finally:
+            self.duration_sec = round(time.time() - self.started, 1)
+            logging.info("profiling done. " + str(self.num_samples) + " samples taken")
+            if done_callback is not None:
+                done_callback()
+
+    @staticmethod
+    def __stack(frame) -> Tuple[str, ...]:
+        stack = []
+        while frame is not None and len(stack) < SamplingProfiler.MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(os.path.basename(code.co_filename) + ":" + code.co_name)
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def report(self, limit: int = 20) -> Dict:
+        # self: samples of the innermost function; inclusive: samples of the function somewhere on the stack;
+        # stacks: collapsed stacks (thread;outer;...;inner) e.g. to render a flame graph
+        stacks = dict(self.stacks)
+        total = sum(stacks.values())
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in stacks.items():
+            if len(stack) > 1:
+                own[stack[-1]] += count
+            for function in set(stack[1:]):
+                inclusive[function] += count
+        return {'running': self.is_running(),
+                'started': None if self.started is None else datetime.fromtimestamp(self.started).isoformat(),
+                'duration_sec': self.duration_sec,
+                'samples': self.num_samples,
+                'self': self.__top(own, total, limit),
+                'inclusive': self.__top(inclusive, total, limit),
+                'stacks': [{'stack': ";".join(stack), 'samples': count} for stack, count in Counter(stacks).most_common(limit)]}
+
+    @staticmethod
+    def __top(counter: Counter, total: int, limit: int) -> List[Dict]:
+        return [{'function': function, 'samples': count, 'percent': round(100 * count / total, 1) if total > 0 else 0}
+                for function, count in counter.most_common(limit)]
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,220 @@
+from typing import Iterator, Iterable, Optional
+from internet_monitor_webthing.metrics import STORE_SYNC_SECONDS
+import threading
+import logging
+import struct
+import zlib
+import time
+import mmap
+import os
+
+
+SYNC_RECORD = 'record'        # each append is synced before it returns
+SYNC_SHUTDOWN = 'shutdown'    # synced on close only (the page cache is written by the os)
+SYNC_POLICY = '1000'          # default: the appends are synced within 1000 ms (group commit)
+
+
+def sync_interval_sec(sync: str) -> Optional[float]:
+    # the sync policy: record, shutdown or the max delay in milliseconds (e.g. 1000 or 1000ms). None means on shutdown
+    sync = sync.strip().lower()
+    if sync == SYNC_RECORD:
+        return 0
+    elif sync == SYNC_SHUTDOWN:
+        return None
+    else:
+        try:
+            return max(0.0, float(sync[:-2] if sync.endswith("ms") else sync) / 1000)
+        except ValueError:
+            raise ValueError("invalid sync policy " + sync + " (record, shutdown or <milliseconds>)")
+
+
+# fdatasync skips the metadata update (mtime) which is not required to read the records
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def fsync_dir(filename: str):
+    # makes a rename or the creation of the file durable
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# append-only binary log of fixed-size records. The file starts with a small header (magic, record version, record
+# size and flags) followed by the records. Records are addressed by index and read through a read-only memory map.
+# The log is the write-ahead log of the stores: a record is complete once it is appended, nothing is rewritten in
+# place. Each record is followed by its CRC32. On open, the valid prefix is recovered: a torn or corrupted record
+# and all records after it are dropped. Appends are written to the os immediately and synced to the disk according
+# to the sync policy. With an interval, the appends within the interval share a single sync (group commit)
+class RecordLog:
+
+    MAGIC = b'NMRLOG'
+    HEADER = struct.Struct('<6sHII')   # magic, record version, record size, flags
+    CHECKSUM = struct.Struct('<I')
+    FLAG_CHECKSUM = 1
+
+    def __init__(self, filename: str, record_size: int, version: int, sync: str = SYNC_POLICY):
+        self.filename = filename
+        self.sync_policy = sync
+        self.interval_sec = sync_interval_sec(sync)
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.sync_timer = None
+        self.dirty = False
+        self.mmap = None
+        self.mapped_size = 0
+        self.__open(record_size, version)
+
+    def __open(self, record_size: int, version: int):
+        # opens the log file and recovers its valid prefix. Called on init and after the file has been replaced
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) < RecordLog.HEADER.size:
+            self.__create(self.filename, record_size, version)
+            fsync_dir(self.filename)
+
+        with open(self.filename, "rb") as file:
+            magic, self.version, self.record_size, flags = RecordLog.HEADER.unpack(file.read(RecordLog.HEADER.size))
+            if magic != RecordLog.MAGIC:
+                raise ValueError(self.filename + " is not a record log file")
+            if flags & RecordLog.FLAG_CHECKSUM == 0:
+                # log files written before checksums were introduced are converted once
+                records = []
+                while True:
+                    record = file.read(self.record_size)
+                    if len(record) < self.record_size:
+                        break
+                    records.append(record)
+                self.__replace(records, self.record_size, self.version)
+                logging.info("log file " + self.filename + " converted to checksummed records. " + str(len(records)) + " records")
+        self.slot_size = self.record_size + RecordLog.CHECKSUM.size
+
+        self.file = open(self.filename, "r+b")
+        file_size = self.file.seek(0, os.SEEK_END)
+        self.count = self.__recover((file_size - RecordLog.HEADER.size) // self.slot_size)
+        valid_size = self.__offset(self.count)
+        if valid_size < file_size:
+            logging.warning("log file " + self.filename + " contains an incomplete or corrupted tail (" + str(file_size - valid_size) + " bytes). Truncating it")
+            self.file.truncate(valid_size)
+            os.fsync(self.file.fileno())
+        self.file.seek(valid_size)
+
+    @staticmethod
+    def __create(filename: str, record_size: int, version: int):
+        with open(filename, "wb") as file:
+            file.write(RecordLog.HEADER.pack(RecordLog.MAGIC, version, record_size, RecordLog.FLAG_CHECKSUM))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def __replace(self, records: Iterable[bytes], record_size: int, version: int):
+        # the records are written and synced to a temp file first which replaces the log file finally. A crash
+        # leaves either the old or the new log file
+        tempfile = self.filename + ".tmp"
+        self.__create(tempfile, record_size, version)
+        with open(tempfile, "ab") as file:
+            for record in records:
+                file.write(record + RecordLog.CHECKSUM.pack(zlib.crc32(record)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tempfile, self.filename)
+        fsync_dir(self.filename)
+
+    def __recover(self, num_slots: int) -> int:
+        # returns the number of valid records. The records are checked once on open
+        if num_slots == 0:
+            return 0
+        self.__remap()
+        for idx in range(num_slots):
+            start = self.__offset(idx)
+            checksum = RecordLog.CHECKSUM.unpack_from(self.mmap, start + self.record_size)[0]
+            if zlib.crc32(self.mmap[start:start + self.record_size]) != checksum:
+                logging.warning("log file " + self.filename + " record " + str(idx) + " is corrupted. Recovering the " + str(idx) + " records before")
+                return idx
+        return num_slots
+
+    def __offset(self, idx: int) -> int:
+        return RecordLog.HEADER.size + idx * self.slot_size
+
+    def __len__(self):
+        return self.count
+
+    def append(self, record: bytes):
+        if len(record) != self.record_size:
+            raise ValueError("invalid record size " + str(len(record)) + " (expected " + str(self.record_size) + ")")
+        with self.lock:
+            self.file.write(record + RecordLog.CHECKSUM.pack(zlib.crc32(record)))
+            self.file.flush()
+            self.count += 1
+            self.dirty = True
+            if self.interval_sec is not None and self.interval_sec > 0 and self.sync_timer is None:
+                self.sync_timer = threading.Timer(self.interval_sec, self.sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+        if self.interval_sec == 0:
+            self.sync()
+
+    def sync(self):
+        # writes the appended records to the disk. May be called at any time, e.g. before an append is acknowledged.
+        # Appends are not blocked while syncing
+        with self.sync_lock:
+            with self.lock:
+                self.sync_timer = None
+                dirty = self.dirty and not self.file.closed
+                self.dirty = False
+            if dirty:
+                started = time.perf_counter()
+                fdatasync(self.file.fileno())
+                STORE_SYNC_SECONDS.observe(time.perf_counter() - started)
+
+    def get(self, idx: int) -> bytes:
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError("record index " + str(idx) + " out of range")
+        start = self.__offset(idx)
+        end = start + self.record_size
+        with self.lock:
+            # the map is replaced by concurrent remaps, rewrites and close
+            if end > self.mapped_size:
+                self.__remap()
+            return self.mmap[start:end]
+
+    def last(self) -> Optional[bytes]:
+        if self.count > 0:
+            return self.get(-1)
+        else:
+            return None
+
+    def records(self, start: int = 0, end: int = None) -> Iterator[bytes]:
+        end = self.count if end is None else min(end, self.count)
+        for idx in range(max(start, 0), end):
+            yield self.get(idx)
+
+    def __remap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mapped_size = len(self.mmap)
+
+    def rewrite(self, records: Iterable[bytes], record_size: int, version: int):
+        # the records may be read from this log. They are materialized before the file is closed
+        records = list(records)
+        with self.sync_lock, self.lock:
+            self.__close()
+            self.__replace(records, record_size, version)
+            self.__open(record_size, version)
+
+    def close(self):
+        self.sync()
+        with self.sync_lock, self.lock:
+            self.__close()
+
+    def __close(self):
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        self.dirty = False
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+            self.mapped_size = 0
+        self.file.close()
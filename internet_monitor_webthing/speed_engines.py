@@ -0,0 +1,370 @@
+from speedtest import Speedtest
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Tuple, Optional
+from urllib.parse import urlparse
+from internet_monitor_webthing.profiling import span
+from internet_monitor_webthing.interface_binding import interface_address
+import http.client
+import threading
+import logging
+import time
+import json
+import os
+
+
+@dataclass
+class Speed:
+    server: str
+    downloadspeed: int
+    uploadspeed: int
+    ping: float
+    report_uri: str
+    bytes_received: int = 0
+    bytes_sent: int = 0
+    # traffic of the monitored interface in bit/sec (without the speedtest traffic) measured before and while running
+    # the speedtest. It covers other lan clients only if this host is the gateway
+    background_before: Optional[float] = None
+    background_during: Optional[float] = None
+
+
+class SpeedtestServerUnreachable(Exception):
+    pass
+
+
+class SpeedEngine(ABC):
+
+    # an engine is prepared by the webthing process. The measurement itself is executed by a worker
+    # process. For this reason the engine has to be picklable after having been prepared
+
+    def prepare(self):
+        pass
+
+    def reset(self) -> bool:
+        # called if the server is unreachable. Returns True, if a retry is worthwhile
+        return False
+
+    @abstractmethod
+    def measure(self, progress_listener) -> Speed:
+        # progress_listener(phase, percent, throughput) whereby throughput is the partial throughput
+        # in bit/sec or None, if not supported
+        pass
+
+
+class CachedConfigSpeedtest(Speedtest):
+
+    # Speedtest fetches the speedtest.net config within its constructor. This one uses the given config instead
+    def __init__(self, config: Dict, **kwargs):
+        self.cached_config = config
+        super().__init__(**kwargs)
+
+    def get_config(self):
+        self.config.update(self.cached_config)
+        client = self.config['client']
+        self.lat_lon = (float(client['lat']), float(client['lon']))
+        return self.config
+
+
+def source_address(interface: Optional[str]) -> Optional[str]:
+    # the address the speedtest connections are bound to (multi-WAN). None, if not bound to an interface
+    if interface is None:
+        return None
+    address = interface_address(interface)
+    if address == "":
+        raise ConnectionError("interface " + interface + " has no ipv4 address")
+    return address
+
+
+class SpeedtestServerCache:
+
+    # the speedtest.net config and the best server are cached on disk. Once the ttl is expired, they are
+    # re-validated in the background while the cached ones are still used. The best server depends on
+    # the connection. For this reason each interface has its own cache
+    UNREACHABLE_PING_MS = 60 * 1000
+
+    def __init__(self, filename: str = None, ttl_sec: int = 6 * 60 * 60, interface: str = None):
+        if filename is None:
+            dir = os.path.join("var", "lib", "netmonitor")
+            os.makedirs(dir, exist_ok=True)
+            self.filename = os.path.join(dir, "speedtest_servers.json" if interface is None else "speedtest_servers_" + interface + ".json")
+        else:
+            self.filename = filename
+        self.interface = interface
+        self.ttl_sec = ttl_sec
+        self.config = None
+        self.best = None
+        self.cached_time = datetime.fromtimestamp(0)
+        self.lock = threading.Lock()
+        self.refreshing = False
+        try:
+            with open(self.filename, "r") as file:
+                data = json.load(file)
+                self.config = data['config']
+                self.best = data['best']
+                self.cached_time = datetime.fromtimestamp(data['time'])
+                logging.info("speedtest server cache " + self.filename + " loaded. best server: " + self.best.get('sponsor', '') + "/" + self.best.get('name', ''))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred loading speedtest server cache " + self.filename + " " + str(e))
+
+    def is_present(self) -> bool:
+        return self.config is not None and self.best is not None
+
+    def is_expired(self) -> bool:
+        return (datetime.now() - self.cached_time).total_seconds() > self.ttl_sec
+
+    def refresh(self):
+        # downloads the config, the server list and pings the closest servers
+        with self.lock:
+            speedtest = Speedtest(source_address=source_address(self.interface))
+            best = speedtest.get_best_server()
+            self.config = speedtest.config
+            self.best = best
+            self.cached_time = datetime.now()
+            self.__store()
+            logging.info("speedtest server cache refreshed. best server: " + best.get('sponsor', '') + "/" + best.get('name', ''))
+
+    def refresh_in_background(self):
+        if not self.refreshing:
+            self.refreshing = True
+            threading.Thread(target=self.__refresh_in_background, daemon=True).start()
+
+    def __refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.warning("error occurred refreshing speedtest server cache " + str(e))
+        finally:
+            self.refreshing = False
+
+    def invalidate(self):
+        self.best = None
+
+    def __store(self):
+        try:
+            tempfile = self.filename + ".tmp"
+            with open(tempfile, "w") as file:
+                json.dump({'config': self.config, 'best': self.best, 'time': self.cached_time.timestamp()}, file)
+            os.replace(tempfile, self.filename)
+        except Exception as e:
+            logging.error("error occurred storing speedtest server cache " + str(e))
+
+    def get(self) -> Tuple[Dict, Dict]:
+        # returns the config and the best server
+        if not self.is_present():
+            self.refresh()
+        elif self.is_expired():
+            self.refresh_in_background()
+        with self.lock:
+            return self.config, self.best
+
+
+def measure_speed(config: Dict, best: Dict, progress_listener, interface: str = None) -> Speed:
+    with span('speedtest', 'config'):
+        s = CachedConfigSpeedtest(config, source_address=source_address(interface))
+    # pings the cached server only (instead of the closest ones) to measure the current latency
+    with span('speedtest', 'server_selection'):
+        s.get_best_server([dict(best)])
+    if s.results.ping >= SpeedtestServerCache.UNREACHABLE_PING_MS:
+        raise SpeedtestServerUnreachable("speedtest server " + best.get('sponsor', '') + "/" + best.get('name', '') + " is not reachable")
+    # speedtest-cli does not provide the partial throughput
+    with span('speedtest', 'download'):
+        s.download(callback=lambda i, count, **kwargs: progress_listener('download', round(100 * (i + 1) / count), None) if kwargs.get('end', False) else None)
+    with span('speedtest', 'upload'):
+        s.upload(callback=lambda i, count, **kwargs: progress_listener('upload', round(100 * (i + 1) / count), None) if kwargs.get('end', False) else None)
+    try:
+        with span('speedtest', 'share'):
+            link = s.results.share()   # POST data to the speedtest.net API to obtain a share results link
+    except:
+        link = None
+    metrics = s.results.dict()
+    return Speed(metrics['server'].get('sponsor', '') + "/" + metrics['server'].get('name', ''), int(metrics['download']), int(metrics['upload']), metrics['ping'], link, int(metrics['bytes_received']), int(metrics['bytes_sent']))
+
+
+class SpeedtestCliEngine(SpeedEngine):
+
+    # measures against the best speedtest.net server by using speedtest-cli. If an interface is given, the
+    # connections are bound to its address (source based routing is required)
+
+    def __init__(self, server_cache: SpeedtestServerCache = None, interface: str = None):
+        self.server_cache = server_cache
+        self.interface = interface
+        self.config = None
+        self.best = None
+
+    def __getstate__(self):
+        # the server cache remains in the webthing process
+        return {'server_cache': None, 'interface': self.interface, 'config': self.config, 'best': self.best}
+
+    def prepare(self):
+        if self.server_cache is None:
+            self.server_cache = SpeedtestServerCache(interface=self.interface)
+        self.config, self.best = self.server_cache.get()
+
+    def reset(self) -> bool:
+        logging.info("refreshing speedtest server cache")
+        self.server_cache.invalidate()
+        self.server_cache.refresh()
+        return True
+
+    def measure(self, progress_listener) -> Speed:
+        return measure_speed(self.config, self.best, progress_listener, self.interface)
+
+
+class HttpThroughputEngine(SpeedEngine):
+
+    # measures the throughput by several parallel http streams against a self-hosted endpoint such as the
+    # throughput_server of this package. The endpoint has to support
+    #   GET <url>/download?size=<bytes>   returns <bytes> bytes
+    #   POST <url>/upload                 discards the request body
+    # The response data is read into preallocated buffers (one per stream) and the upload data is sent from a
+    # single preallocated buffer. This avoids per-chunk allocations and keeps the cpu load low
+    BUFFER_SIZE = 128 * 1024
+    DOWNLOAD_SIZE = 1024 * 1024 * 1024     # per request. A request which is running once the duration is elapsed is aborted
+    UPLOAD_SIZE = 64 * 1024 * 1024
+    PROGRESS_PERIOD_SEC = 1
+    LATENCY_SAMPLES = 5
+    TIMEOUT_SEC = 10
+
+    def __init__(self, url: str, streams: int = 4, duration_sec: float = 10, interface: str = None):
+        uri = urlparse(url)
+        if uri.scheme.lower() not in ['http', 'https'] or uri.hostname is None:
+            raise ValueError("unsupported throughput test url " + url + " (http(s)://<host>[:<port>][/<path>] expected)")
+        self.url = url
+        self.host = uri.hostname
+        self.ssl = uri.scheme.lower() == 'https'
+        self.port = uri.port if uri.port is not None else (443 if self.ssl else 80)
+        self.path = uri.path.rstrip('/')
+        self.streams = max(1, streams)
+        self.duration_sec = duration_sec
+        self.interface = interface
+
+    def __connect(self) -> http.client.HTTPConnection:
+        address = source_address(self.interface)
+        source = None if address is None else (address, 0)
+        if self.ssl:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=HttpThroughputEngine.TIMEOUT_SEC, source_address=source)
+        else:
+            return http.client.HTTPConnection(self.host, self.port, timeout=HttpThroughputEngine.TIMEOUT_SEC, source_address=source)
+
+    def measure(self, progress_listener) -> Speed:
+        with span('speedtest', 'latency'):
+            ping = self.__measure_latency()
+        with span('speedtest', 'download'):
+            bytes_received, download_sec = self.__transfer('download', self.__download_stream, progress_listener)
+        with span('speedtest', 'upload'):
+            bytes_sent, upload_sec = self.__transfer('upload', self.__upload_stream, progress_listener)
+        return Speed(self.host + ":" + str(self.port),
+                     int(bytes_received * 8 / download_sec),
+                     int(bytes_sent * 8 / upload_sec),
+                     ping,
+                     None,
+                     bytes_received,
+                     bytes_sent)
+
+    def __measure_latency(self) -> float:
+        # the first request includes the connection setup. The min of the remaining ones is taken
+        connection = self.__connect()
+        try:
+            latencies = []
+            for i in range(HttpThroughputEngine.LATENCY_SAMPLES + 1):
+                started = time.perf_counter()
+                connection.request('GET', self.path + '/download?size=0')
+                connection.getresponse().read()
+                latencies.append((time.perf_counter() - started) * 1000)
+            return round(min(latencies[1:]), 3)
+        except OSError as e:
+            raise SpeedtestServerUnreachable("throughput server " + self.url + " is not reachable " + str(e))
+        finally:
+            connection.close()
+
+    def __transfer(self, phase: str, stream, progress_listener) -> Tuple[int, float]:
+        # returns the transferred bytes and the elapsed time
+        counters = [0] * self.streams      # each stream updates its own counter only
+        errors: List[Exception] = []
+        stopped = threading.Event()
+        threads = [threading.Thread(target=stream, args=(idx, counters, errors, stopped), daemon=True) for idx in range(self.streams)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+
+        last_time = started
+        last_bytes = 0
+        while True:
+            elapsed_sec = time.monotonic() - started
+            if elapsed_sec >= self.duration_sec or len(errors) == self.streams:
+                break
+            time.sleep(min(HttpThroughputEngine.PROGRESS_PERIOD_SEC, self.duration_sec - elapsed_sec))
+            now = time.monotonic()
+            num_bytes = sum(counters)
+            progress_listener(phase, min(100, round(100 * (now - started) / self.duration_sec)), (num_bytes - last_bytes) * 8 / (now - last_time))
+            last_time = now
+            last_bytes = num_bytes
+
+        stopped.set()
+        num_bytes = sum(counters)
+        elapsed_sec = time.monotonic() - started
+        for thread in threads:
+            thread.join(HttpThroughputEngine.TIMEOUT_SEC)
+        if num_bytes == 0:
+            raise SpeedtestServerUnreachable("throughput server " + self.url + " is not reachable " + ", ".join(set([str(error) for error in errors])))
+        return num_bytes, elapsed_sec
+
+    def __download_stream(self, idx: int, counters: List[int], errors: List[Exception], stopped: threading.Event):
+        buffer = memoryview(bytearray(HttpThroughputEngine.BUFFER_SIZE))
+        connection = self.__connect()
+        try:
+            while not stopped.is_set():
+                connection.request('GET', self.path + '/download?size=' + str(HttpThroughputEngine.DOWNLOAD_SIZE))
+                response = connection.getresponse()
+                while not stopped.is_set():
+                    num_read = response.readinto(buffer)
+                    if num_read == 0:
+                        break
+                    counters[idx] += num_read
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # closing aborts a running response
+            connection.close()
+
+    def __upload_stream(self, idx: int, counters: List[int], errors: List[Exception], stopped: threading.Event):
+        buffer = memoryview(os.urandom(HttpThroughputEngine.BUFFER_SIZE))
+        connection = self.__connect()
+        try:
+            while not stopped.is_set():
+                connection.putrequest('POST', self.path + '/upload')
+                connection.putheader('Content-Type', 'application/octet-stream')
+                connection.putheader('Content-Length', str(HttpThroughputEngine.UPLOAD_SIZE))
+                connection.endheaders()
+                remaining = HttpThroughputEngine.UPLOAD_SIZE
+                while remaining > 0 and not stopped.is_set():
+                    chunk = buffer if remaining >= len(buffer) else buffer[:remaining]
+                    connection.sock.sendall(chunk)
+                    counters[idx] += len(chunk)
+                    remaining -= len(chunk)
+                if remaining == 0:
+                    connection.getresponse().read()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+
+SPEED_ENGINES = ['speedtest', 'http']
+
+
+def create_engine(engine: str = 'speedtest', url: str = None, streams: int = 4, duration_sec: float = 10, interface: str = None) -> SpeedEngine:
+    #   speedtest: speedtest.net by using speedtest-cli
+    #   http: parallel http streams against a self-hosted endpoint (see throughput_server)
+    # If an interface is given, the engine measures the connection of this interface
+    if engine == 'speedtest':
+        return SpeedtestCliEngine(interface=interface)
+    elif engine == 'http':
+        if url is None or len(url.strip()) == 0:
+            raise ValueError("the http speed engine requires a throughput test url")
+        return HttpThroughputEngine(url.strip(), streams, duration_sec, interface)
+    else:
+        raise ValueError("unsupported speed engine " + engine + " (supported: " + ", ".join(SPEED_ENGINES) + ")")
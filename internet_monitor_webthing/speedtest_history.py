@@ -0,0 +1,258 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Dict, List, Optional
+from internet_monitor_webthing.speedtest_monitor import Speed
+from internet_monitor_webthing.metrics import STORE_WRITE_SECONDS
+import logging
+import json
+import math
+import os
+import time
+
+
+def rounded(value: float) -> Optional[float]:
+    # unknown values (NaN) are answered as null. NaN is not valid JSON
+    return None if math.isnan(value) else round(value, 1)
+
+
+class Rollup:
+
+    # unknown values (NaN, such as a metric missing in a row ingested by the hub) are skipped. For this reason, the
+    # values are counted per metric
+    METRICS = ['download', 'upload', 'ping']
+
+    def __init__(self, start: datetime):
+        self.start = start
+        self.count = 0
+        self.counts = {metric: 0 for metric in Rollup.METRICS}
+        self.min = {metric: None for metric in Rollup.METRICS}
+        self.max = {metric: None for metric in Rollup.METRICS}
+        self.sum = {metric: 0.0 for metric in Rollup.METRICS}
+
+    def add(self, values: Dict[str, float]):
+        self.count += 1
+        for metric in Rollup.METRICS:
+            value = values[metric]
+            if math.isnan(value):
+                continue
+            self.counts[metric] += 1
+            self.sum[metric] += value
+            self.min[metric] = value if self.min[metric] is None else min(self.min[metric], value)
+            self.max[metric] = value if self.max[metric] is None else max(self.max[metric], value)
+
+    def merge(self, other):
+        # e.g. the rollups of several sites (hub)
+        self.count += other.count
+        for metric in Rollup.METRICS:
+            self.counts[metric] += other.counts[metric]
+            self.sum[metric] += other.sum[metric]
+            if other.min[metric] is not None:
+                self.min[metric] = other.min[metric] if self.min[metric] is None else min(self.min[metric], other.min[metric])
+                self.max[metric] = other.max[metric] if self.max[metric] is None else max(self.max[metric], other.max[metric])
+
+    def state(self) -> List:
+        return [self.start.timestamp(), self.count, self.min, self.max, self.sum, self.counts]
+
+    @staticmethod
+    def of_state(state: List):
+        rollup = Rollup(datetime.fromtimestamp(state[0]))
+        rollup.count = state[1]
+        rollup.min = {metric: state[2][metric] for metric in Rollup.METRICS}
+        rollup.max = {metric: state[3][metric] for metric in Rollup.METRICS}
+        rollup.sum = {metric: state[4][metric] for metric in Rollup.METRICS}
+        # checkpoints of former versions do not include the counts per metric
+        rollup.counts = {metric: state[5][metric] if len(state) > 5 else state[1] for metric in Rollup.METRICS}
+        return rollup
+
+    def to_dict(self) -> Dict:
+        data = {'time': self.start.isoformat(), 'count': self.count}
+        for metric in Rollup.METRICS:
+            if self.counts[metric] == 0:
+                data[metric] = {'min': None, 'avg': None, 'max': None}
+            else:
+                data[metric] = {'min': round(self.min[metric], 1),
+                                'avg': round(self.sum[metric] / self.counts[metric], 1),
+                                'max': round(self.max[metric], 1)}
+        return data
+
+
+class SpeedHistory:
+
+    # the results are stored column by column. Each column is an array of doubles which is persisted in its own
+    # append-only file. Download and upload speed as well as the background traffic of the interface are
+    # stored in Mbit/sec, ping in milliseconds. Unknown values are stored as NaN. The rollups are checkpointed each
+    # CHECKPOINT_ROWS appends. On start only the rows appended after the checkpoint are rolled up
+    CHECKPOINT_ROWS = 100
+    COLUMNS = ['time', 'download', 'upload', 'ping', 'background']
+    RESOLUTIONS = {'hour': lambda date: date.replace(minute=0, second=0, microsecond=0),
+                   'day': lambda date: date.replace(hour=0, minute=0, second=0, microsecond=0),
+                   'month': lambda date: date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)}
+
+    def __init__(self, dir: str = None):
+        if dir is None:
+            dir = os.path.join("var", "lib", "netmonitor", "speedhistory")
+        os.makedirs(dir, exist_ok=True)
+        self.dir = dir
+        self.columns = {name: self.__load(name) for name in SpeedHistory.COLUMNS}
+
+        # columns which have been added later are filled up with NaN
+        for name, column in self.columns.items():
+            if len(column) == 0 and not os.path.exists(self.__filename(name)):
+                column.extend([math.nan] * len(self.columns['time']))
+                with open(self.__filename(name), "wb") as file:
+                    column.tofile(file)
+
+        # a crash may have interrupted an append. Drop incomplete rows
+        num_rows = min([len(column) for column in self.columns.values()])
+        for name, column in self.columns.items():
+            if len(column) > num_rows:
+                del column[num_rows:]
+                with open(self.__filename(name), "r+b") as file:
+                    file.truncate(num_rows * column.itemsize)
+
+        # the date of the last appended row (Last-Modified of the history resource)
+        self.modified = datetime.fromtimestamp(os.path.getmtime(self.__filename('time'))) if os.path.exists(self.__filename('time')) else datetime.now()
+        self.checkpoint_filename = os.path.join(self.dir, "rollups.json")
+        self.rollups = {resolution: list() for resolution in SpeedHistory.RESOLUTIONS.keys()}
+        self.rollup_times = {resolution: list() for resolution in SpeedHistory.RESOLUTIONS.keys()}
+        self.checkpointed = self.__load_checkpoint()
+        for idx in range(self.checkpointed, num_rows):
+            self.__update_rollups(self.__row(idx))
+        if num_rows - self.checkpointed >= SpeedHistory.CHECKPOINT_ROWS:
+            self.checkpoint()
+        logging.info("speed history " + dir + " loaded. " + str(num_rows) + " results found")
+
+    def __load_checkpoint(self) -> int:
+        # returns the number of rows covered by the restored rollups. The checkpoint is valid, if the history still
+        # contains its last covered row
+        try:
+            with open(self.checkpoint_filename, "r") as file:
+                checkpoint = json.load(file)
+            num_rows = int(checkpoint['rows'])
+            if num_rows > len(self) or (num_rows > 0 and self.columns['time'][num_rows - 1] != checkpoint['last_time']):
+                logging.info("rollup checkpoint " + self.checkpoint_filename + " does not match the history. Rolling up the history")
+                return 0
+            rollups = {resolution: [Rollup.of_state(state) for state in checkpoint['rollups'][resolution]] for resolution in SpeedHistory.RESOLUTIONS.keys()}
+            for resolution in SpeedHistory.RESOLUTIONS.keys():
+                self.rollups[resolution] = rollups[resolution]
+                self.rollup_times[resolution] = [rollup.start.timestamp() for rollup in rollups[resolution]]
+            return num_rows
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("error occurred loading rollup checkpoint " + self.checkpoint_filename + " " + str(e) + ". Rolling up the history")
+        return 0
+
+    def checkpoint(self):
+        # the checkpoint is a cache of the rollups. A lost or outdated checkpoint is detected on start
+        try:
+            num_rows = len(self)
+            checkpoint = {'rows': num_rows,
+                          'last_time': self.columns['time'][num_rows - 1] if num_rows > 0 else 0,
+                          'rollups': {resolution: [rollup.state() for rollup in rollups] for resolution, rollups in self.rollups.items()}}
+            tempfile = self.checkpoint_filename + ".tmp"
+            with open(tempfile, "w") as file:
+                json.dump(checkpoint, file)
+            os.replace(tempfile, self.checkpoint_filename)
+            self.checkpointed = num_rows
+        except Exception as e:
+            logging.error("error occurred storing rollup checkpoint " + self.checkpoint_filename + " " + str(e))
+
+    def __filename(self, name: str) -> str:
+        return os.path.join(self.dir, name + ".bin")
+
+    def __load(self, name: str) -> array:
+        column = array('d')
+        filename = self.__filename(name)
+        if os.path.exists(filename):
+            with open(filename, "rb") as file:
+                column.fromfile(file, os.path.getsize(filename) // column.itemsize)
+        return column
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __row(self, idx: int) -> Dict[str, float]:
+        return {name: column[idx] for name, column in self.columns.items()}
+
+    def append(self, date: datetime, speed: Speed):
+        self.append_row({'time': date.timestamp(),
+                         'download': speed.downloadspeed / (1000 * 1000),
+                         'upload': speed.uploadspeed / (1000 * 1000),
+                         'ping': speed.ping,
+                         'background': math.nan if speed.background_during is None else speed.background_during / (1000 * 1000)})
+
+    def append_row(self, row: Dict[str, float]):
+        # the row includes all columns. Rows have to be appended in chronological order: the queries bisect the time
+        # column. A row older than the newest one (system clock has been set back?) gets the time of the newest one
+        times = self.columns['time']
+        if len(times) > 0 and row['time'] < times[-1]:
+            logging.warning("speed result time " + datetime.fromtimestamp(row['time']).isoformat() + " is older than newest result time " + datetime.fromtimestamp(times[-1]).isoformat() + ". Using newest result time")
+            row = dict(row)
+            row['time'] = times[-1]
+        try:
+            started = time.perf_counter()
+            for name in SpeedHistory.COLUMNS:
+                with open(self.__filename(name), "ab") as file:
+                    array('d', [row[name]]).tofile(file)
+            STORE_WRITE_SECONDS.labels('speed_history').observe(time.perf_counter() - started)
+        except Exception as e:
+            # the row is stored completely or not at all. Otherwise, the columns would get different lengths
+            logging.error("error occurred storing speed result " + str(e))
+            self.__truncate(len(self))
+            return
+        # the columns are appended in memory only after all files have been written
+        for name in SpeedHistory.COLUMNS:
+            self.columns[name].append(row[name])
+        self.modified = datetime.now()
+        self.__update_rollups(row)
+        if len(self) - self.checkpointed >= SpeedHistory.CHECKPOINT_ROWS:
+            self.checkpoint()
+
+    def __truncate(self, num_rows: int):
+        for name in SpeedHistory.COLUMNS:
+            try:
+                with open(self.__filename(name), "r+b") as file:
+                    file.truncate(num_rows * self.columns[name].itemsize)
+            except Exception as e:
+                logging.error("error occurred truncating " + self.__filename(name) + " " + str(e))
+
+    def __update_rollups(self, row: Dict[str, float]):
+        date = datetime.fromtimestamp(row['time'])
+        for resolution, truncate in SpeedHistory.RESOLUTIONS.items():
+            start = truncate(date)
+            rollups = self.rollups[resolution]
+            if len(rollups) == 0 or rollups[-1].start < start:
+                rollups.append(Rollup(start))
+                self.rollup_times[resolution].append(start.timestamp())
+            rollups[-1].add(row)
+
+    def raw_rows(self, start_idx: int, end_idx: int = None) -> List[Dict[str, float]]:
+        # the rows addressed by index as stored (epoch seconds, Mbit/sec, milliseconds, NaN if unknown)
+        end_idx = len(self) if end_idx is None else min(end_idx, len(self))
+        return [self.__row(idx) for idx in range(max(0, start_idx), end_idx)]
+
+    def rows(self, start: datetime, end: datetime, limit: int = None) -> List[Dict]:
+        times = self.columns['time']
+        start_idx = bisect_left(times, start.timestamp())
+        end_idx = bisect_right(times, end.timestamp())
+        if limit is not None:
+            end_idx = min(end_idx, start_idx + limit)
+        return [{'time': datetime.fromtimestamp(times[idx]).isoformat(),
+                 'download': rounded(self.columns['download'][idx]),
+                 'upload': rounded(self.columns['upload'][idx]),
+                 'ping': rounded(self.columns['ping'][idx]),
+                 'background': rounded(self.columns['background'][idx])}
+                for idx in range(start_idx, end_idx)]
+
+    def rollups_of(self, resolution: str, start: datetime, end: datetime) -> List[Rollup]:
+        if resolution not in SpeedHistory.RESOLUTIONS.keys():
+            raise ValueError("unsupported resolution " + resolution + " (supported: " + ", ".join(SpeedHistory.RESOLUTIONS.keys()) + ")")
+        times = self.rollup_times[resolution]
+        start_idx = bisect_left(times, SpeedHistory.RESOLUTIONS[resolution](start).timestamp())
+        end_idx = bisect_right(times, end.timestamp())
+        return self.rollups[resolution][start_idx:end_idx]
+
+    def rollup(self, resolution: str, start: datetime, end: datetime) -> List[Dict]:
+        return [rollup.to_dict() for rollup in self.rollups_of(resolution, start, end)]
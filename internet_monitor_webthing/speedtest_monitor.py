@@ -1,43 +1,237 @@
-from speedtest import Speedtest
-from dataclasses import dataclass
+from typing import Optional
+from internet_monitor_webthing.interface_traffic import InterfaceTraffic
+from internet_monitor_webthing.speed_engines import Speed, SpeedEngine, SpeedtestCliEngine, SpeedtestServerUnreachable
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.profiling import span, record_span, forward_spans
+import multiprocessing
+import random
 import threading
+import queue
 import time
 import logging
+import os
 
 
-@dataclass
-class Speed:
-    server: str
-    downloadspeed: int
-    uploadspeed: int
-    ping: float
-    report_uri: str
+SPEEDTESTS = REGISTRY.counter('netmonitor_speedtests_total', 'Executed speedtests', ['status'])
+SPEEDTEST_DEFERRALS = REGISTRY.counter('netmonitor_speedtest_deferrals_total', 'Periodic speedtests deferred as the monitored interface has been busy')
+SPEEDTEST_DURATION_SECONDS = REGISTRY.histogram('netmonitor_speedtest_duration_seconds', 'Duration of a speedtest run', buckets=[5, 10, 20, 30, 45, 60, 90, 120, 180, 300])
+
+
+class SpeedtestTimeout(Exception):
+    pass
+
+
+# the worker process runs with lower priority and limited memory to keep the webthing server responsive
+WORKER_NICENESS = 10
+WORKER_MAX_MEMORY_BYTES = 1024 * 1024 * 1024
+
+
+def speedtest_worker(engine: SpeedEngine, results):
+    try:
+        os.nice(WORKER_NICENESS)
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (WORKER_MAX_MEMORY_BYTES, WORKER_MAX_MEMORY_BYTES))
+    except Exception as e:
+        logging.debug("could not limit speedtest worker resources " + str(e))
+
+    forward_spans(lambda component, stage, elapsed_sec: results.put(('span', component, stage, elapsed_sec)))
+    try:
+        speed = engine.measure(lambda phase, percent, throughput: results.put(('progress', phase, percent, throughput)))
+        results.put(('result', speed))
+    except SpeedtestServerUnreachable as e:
+        results.put(('unreachable', str(e)))
+    except Exception as e:
+        results.put(('error', str(e)))
+
+
+class SpeedtestRun:
+
+    def __init__(self):
+        self.status = 'queued'
+        self.speed = None
+        self.error = None
+        self.callbacks = list()
+        self.lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if self.status not in ['completed', 'failed']:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def complete(self, speed: Speed = None, error: Exception = None):
+        with self.lock:
+            self.speed = speed
+            self.error = error
+            self.status = 'failed' if speed is None else 'completed'
+            callbacks = self.callbacks
+            self.callbacks = list()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.error(e)
 
 
 class SpeedtestRunner:
 
-    def __init__(self, listener):
+    # periodic runs are deferred while the interface is busy (background traffic above the threshold). A deferred
+    # run is retried after a randomized delay. Once the max deferral time is exceeded, it runs anyway. The
+    # background traffic is read from the counters of the interface of this host. It includes the traffic of other
+    # lan clients only if this host is the gateway (router) forwarding it
+    DEFERRAL_DELAY_SEC = 60
+    DEFERRAL_JITTER_SEC = 60
+    BACKGROUND_SAMPLE_SEC = 2
+    PROTOCOL_OVERHEAD = 1.05      # tcp/ip overhead of the speedtest traffic counted by the interface
+
+    # the runners of several interfaces (multi-WAN) share the exclusive lock. Their speedtests are executed one
+    # after another, so they do not contend for the cpu and the interface and are not counted as background traffic
+    def __init__(self, listener, progress_listener = None, timeout_sec: int = 3 * 60, busy_threshold_bps: float = 0, max_deferral_sec: int = 60 * 60, engine: SpeedEngine = None,
+                 interface: str = None, exclusive: threading.Lock = None):
         self.listener = listener
+        self.progress_listener = progress_listener
+        self.timeout_sec = timeout_sec
+        self.busy_threshold_bps = busy_threshold_bps
+        self.max_deferral_sec = max_deferral_sec
+        self.traffic = InterfaceTraffic(interface)
+        self.exclusive = threading.Lock() if exclusive is None else exclusive
+        self.background_before = None
+        self.engine = SpeedtestCliEngine() if engine is None else engine
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.current_run = None
 
     def run_periodically(self, measure_period_sec: int):
         threading.Thread(target=self.__measure_periodically, args=(measure_period_sec,), daemon=True).start()
 
+    def trigger(self) -> SpeedtestRun:
+        # triggers are coalesced: if a run is queued or in flight already, the trigger shares it
+        with self.lock:
+            if self.current_run is None:
+                self.current_run = SpeedtestRun()
+                self.wakeup.set()
+            return self.current_run
+
     def __measure_periodically(self, measure_period_sec: int):
+        # all runs (periodic and triggered ones) are executed by this thread one after another
+        next_run_time = time.monotonic()
+        deferred_since = None
         while True:
-            try:
-                speed = self.measure()
-                self.listener(speed)
-            except Exception as e:
-                logging.error(e)
-            time.sleep(measure_period_sec)
+            self.wakeup.wait(max(0, next_run_time - time.monotonic()))
+            self.wakeup.clear()
+            with self.exclusive:
+                self.background_before = self.__sample_background()
+                # the wakeup may have been missed (triggered after the wait has timed out). The pending run decides
+                with self.lock:
+                    triggered = self.current_run is not None
+                if not triggered and self.__is_busy(deferred_since):
+                    if deferred_since is None:
+                        deferred_since = time.monotonic()
+                    SPEEDTEST_DEFERRALS.inc()
+                    next_run_time = time.monotonic() + SpeedtestRunner.DEFERRAL_DELAY_SEC + random.uniform(0, SpeedtestRunner.DEFERRAL_JITTER_SEC)
+                    continue
+                deferred_since = None
+                with self.lock:
+                    if self.current_run is None:
+                        self.current_run = SpeedtestRun()
+                    run = self.current_run
+                    run.status = 'running'
+                started = time.monotonic()
+                try:
+                    speed = self.measure(self.progress_listener)
+                    SPEEDTESTS.labels('completed').inc()
+                    self.listener(speed)
+                    run.complete(speed=speed)
+                except Exception as e:
+                    logging.error(e)
+                    SPEEDTESTS.labels('failed').inc()
+                    run.complete(error=e)
+                finally:
+                    SPEEDTEST_DURATION_SECONDS.observe(time.monotonic() - started)
+                    with self.lock:
+                        self.current_run = None
+                next_run_time = time.monotonic() + measure_period_sec
+
+    def __sample_background(self) -> Optional[float]:
+        if self.busy_threshold_bps > 0:
+            with span('speedtest', 'background_sample'):
+                return self.traffic.measure(SpeedtestRunner.BACKGROUND_SAMPLE_SEC)
+        else:
+            return None
+
+    def __is_busy(self, deferred_since: Optional[float]) -> bool:
+        if self.background_before is None or self.background_before <= self.busy_threshold_bps:
+            return False
+        elif deferred_since is not None and (time.monotonic() - deferred_since) > self.max_deferral_sec:
+            logging.info("interface is busy (" + str(round(self.background_before / (1000 * 1000), 1)) + " Mbit/sec). Max deferral time exceeded. Running speedtest anyway")
+            return False
+        else:
+            logging.info("interface is busy (" + str(round(self.background_before / (1000 * 1000), 1)) + " Mbit/sec). Deferring speedtest")
+            return True
+
+    def measure(self, progress_listener = None) -> Speed:
+        counters_before = self.traffic.counters()
+        started = time.monotonic()
+        speed = self.__measure(progress_listener)
+        counters_after = self.traffic.counters()
+        speed.background_before = self.background_before
+        if counters_before is not None and counters_after is not None:
+            # the traffic caused by the speedtest itself is not background traffic
+            test_bytes = (speed.bytes_received + speed.bytes_sent) * SpeedtestRunner.PROTOCOL_OVERHEAD
+            background_bytes = max(0, sum(counters_after) - sum(counters_before) - test_bytes)
+            speed.background_during = background_bytes * 8 / (time.monotonic() - started)
+        return speed
+
+    def __measure(self, progress_listener = None) -> Speed:
+        with span('speedtest', 'prepare'):
+            self.engine.prepare()
+        try:
+            return self.__measure_in_worker(progress_listener)
+        except SpeedtestServerUnreachable as e:
+            logging.info(str(e))
+            if self.engine.reset():
+                self.engine.prepare()
+                return self.__measure_in_worker(progress_listener)
+            raise
 
-    def measure(self) -> Speed:
-        s = Speedtest()
-        s.download()
-        s.upload()
+    def __measure_in_worker(self, progress_listener) -> Speed:
+        # the cpu-heavy speedtest is executed by a worker process (not by a thread of this process) to avoid
+        # blocking the webthing server by the GIL. A hanging worker is killed on timeout
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        worker = context.Process(target=speedtest_worker, args=(self.engine, results), daemon=True)
+        with span('speedtest', 'worker_start'):
+            worker.start()
+        deadline = time.monotonic() + self.timeout_sec
         try:
-            link = s.results.share()   # POST data to the speedtest.net API to obtain a share results link
-        except:
-            link = None
-        metrics = s.results.dict()
-        return Speed(metrics['server'].get('sponsor', '') + "/" + metrics['server'].get('name', ''), int(metrics['download']), int(metrics['upload']), metrics['ping'], link)
+            while True:
+                remaining_sec = deadline - time.monotonic()
+                if remaining_sec <= 0:
+                    raise SpeedtestTimeout("speedtest has not been completed within " + str(self.timeout_sec) + " sec")
+                try:
+                    message = results.get(timeout=min(remaining_sec, 1))
+                except queue.Empty:
+                    if not worker.is_alive():
+                        raise Exception("speedtest worker terminated unexpectedly (exit code " + str(worker.exitcode) + ")")
+                    continue
+                if message[0] == 'span':
+                    record_span(message[1], message[2], message[3])
+                elif message[0] == 'progress':
+                    if progress_listener is not None:
+                        progress_listener(message[1], message[2], message[3])
+                elif message[0] == 'result':
+                    return message[1]
+                elif message[0] == 'unreachable':
+                    raise SpeedtestServerUnreachable(message[1])
+                else:
+                    raise Exception("speedtest failed " + message[1])
+        finally:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join(5)
+                if worker.is_alive():
+                    logging.warning("speedtest worker does not terminate. Killing it")
+                    worker.kill()
+            worker.join()
+            results.close()
@@ -1,29 +1,78 @@
-from webthing import (Property, Thing, Value, Action)
+from webthing import (Property, Value, Action, Event)
+from webthing.utils import timestamp
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
 from internet_monitor_webthing.speedtest_monitor import SpeedtestRunner, Speed
+from internet_monitor_webthing.speed_engines import create_engine
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.speedtest_history import SpeedHistory
+from internet_monitor_webthing.interface_binding import wan_dir
 from datetime import datetime
+from typing import Optional
 import tornado.ioloop
+import threading
 import uuid
+import os
+
+
+DOWNLOAD_SPEED = REGISTRY.gauge('netmonitor_download_speed_bits_per_second', 'Download speed of the last speedtest', ['wan'])
+UPLOAD_SPEED = REGISTRY.gauge('netmonitor_upload_speed_bits_per_second', 'Upload speed of the last speedtest', ['wan'])
+PING_SECONDS = REGISTRY.gauge('netmonitor_ping_seconds', 'Ping of the last speedtest', ['wan'])
+BACKGROUND_TRAFFIC = REGISTRY.gauge('netmonitor_background_traffic_bits_per_second', 'Traffic of the monitored interface besides the last speedtest (other lan clients only if the monitor runs on the gateway)', ['wan'])
+LAST_SPEEDTEST = REGISTRY.gauge('netmonitor_last_speedtest_timestamp_seconds', 'Time of the last successful speedtest (epoch seconds)', ['wan'])
 
 
 class TriggerSpeedTest(Action):
 
     def __init__(self, thing, input_):
         Action.__init__(self, uuid.uuid4().hex, thing, 'trigger', input_=input_)
+        self.error = None
+
+    def start(self):
+        # returns immediately. The action remains pending until the (shared) speedtest run is done
+        self.status = 'pending'
+        self.thing.action_notify(self)
+        self.perform_action()
 
     def perform_action(self):
-        self.thing.speedtest_runner.measure()
+        run = self.thing.speedtest_runner.trigger()
+        run.add_done_callback(lambda run: self.thing.ioloop.add_callback(self.__done, run))
+
+    def __done(self, run):
+        if run.status == 'failed':
+            self.fail("speedtest failed" if run.error is None else str(run.error))
+        else:
+            self.finish()
+
+    def fail(self, error: str):
+        self.status = 'failed'
+        self.error = error
+        self.time_completed = timestamp()
+        self.thing.action_notify(self)
 
+    def as_action_description(self):
+        description = Action.as_action_description(self)
+        if self.error is not None:
+            description[self.name]['error'] = self.error
+        return description
 
-class InternetSpeedMonitorWebthing(Thing):
+
+class InternetSpeedMonitorWebthing(CoalescingThing):
+
+    # webthing stores each event without limit. Progress events are pushed to the subscribers only. Of the other
+    # events (results), the newest MAX_STORED_EVENTS are stored
+    MAX_STORED_EVENTS = 50
 
     # regarding capabilities refer https://iot.mozilla.org/schemas
     # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
 
-    def __init__(self, description: str, speedtest_period: int):
-        Thing.__init__(
+    # if a wan (name) and its interface are given, the speed of this interface is measured. The monitors of several
+    # wans share the exclusive lock, so their speedtests do not overlap
+    def __init__(self, description: str, speedtest_period: int, speedtest_busy_threshold: float = 0, speedtest_engine: str = 'speedtest', speedtest_url: str = None, speedtest_streams: int = 4, speedtest_duration: float = 10,
+                 wan: str = None, interface: str = None, exclusive: threading.Lock = None):
+        CoalescingThing.__init__(
             self,
-            'urn:dev:ops:speedmonitor-1',
-            'Internet Speed Monitor',
+            'urn:dev:ops:speedmonitor-1' + ("" if wan is None else "-" + wan),
+            'Internet Speed Monitor' + ("" if wan is None else " (" + wan + ")"),
             ['MultiLevelSensor'],
             description
         )
@@ -96,6 +145,46 @@ class InternetSpeedMonitorWebthing(Thing):
                          'readOnly': True,
                      }))
 
+        self.busy_threshold = Value(speedtest_busy_threshold)
+        self.add_property(
+            Property(self,
+                     'speedtest_busy_threshold',
+                     self.busy_threshold,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Speedtest busy threshold',
+                         'type': 'number',
+                         'description': 'Periodic speedtests are deferred while the traffic of the monitored interface of this host exceeds this threshold (0 = never deferred). It covers other lan clients only if the monitor runs on the gateway',
+                         'unit': 'Mbit/sec',
+                         'readOnly': True,
+                     }))
+
+        self.background_traffic = Value(0)
+        self.add_property(
+            Property(self,
+                     'background_traffic',
+                     self.background_traffic,
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Background traffic',
+                         'type': 'number',
+                         'description': 'The traffic of the monitored interface of this host besides the speedtest traffic while running the last speedtest. It includes the traffic of other lan clients only if the monitor runs on the gateway (router), otherwise it is the traffic of this host',
+                         'unit': 'Mbit/sec',
+                         'readOnly': True,
+                     }))
+
+        self.engine = Value(speedtest_engine)
+        self.add_property(
+            Property(self,
+                     'speedtest_engine',
+                     self.engine,
+                     metadata={
+                         'title': 'Speedtest engine',
+                         'type': 'string',
+                         'description': 'The engine which performs the speedtest (speedtest: speedtest.net, http: parallel http streams against a self-hosted endpoint)',
+                         'readOnly': True,
+                     }))
+
         self.testserver = Value("")
         self.add_property(
             Property(self,
@@ -120,27 +209,69 @@ class InternetSpeedMonitorWebthing(Thing):
                          'readOnly': True,
                      }))
 
+        self.wan = "" if wan is None else wan
+        self.speed_history = SpeedHistory(None if wan is None else os.path.join(wan_dir(wan), "speedhistory"))
         self.ioloop = tornado.ioloop.IOLoop.current()
-        self.speedtest_runner = SpeedtestRunner(self.__on_speed_updated)
+        self.speedtest_runner = SpeedtestRunner(self.__on_speed_updated, self.__on_progress, busy_threshold_bps=speedtest_busy_threshold * 1000 * 1000, engine=create_engine(speedtest_engine, speedtest_url, speedtest_streams, speedtest_duration, interface),
+                                                interface=interface, exclusive=exclusive)
         self.add_available_action(
             'trigger',
             {
                 'title': 'Trigger',
-                'description': 'Triggers a speed test run',
+                'description': 'Triggers a speed test run. If a run is in progress already, the trigger joins it. The action is failed, if the run fails',
             },
             TriggerSpeedTest)
+        self.add_available_event(
+            'progress',
+            {
+                'description': 'The progress of the running speed test',
+                'type': 'object',
+            })
+        self.add_available_event(
+            'result',
+            {
+                'description': 'The result of a completed speed test',
+                'type': 'object',
+            })
         self.speedtest_runner.run_periodically(self.testperiod.get())
 
+    def add_event(self, event: Event):
+        if event.get_name() == 'progress':
+            self.event_notify(event)
+        else:
+            CoalescingThing.add_event(self, event)
+            del self.events[:-InternetSpeedMonitorWebthing.MAX_STORED_EVENTS]
+
     def __on_speed_updated(self, speed: Speed):
         self.ioloop.add_callback(self.__update_speed_props, speed)
 
+    def __on_progress(self, phase: str, percent: int, throughput: Optional[float]):
+        # throughput is the partial throughput in bit/sec, if supported
+        self.ioloop.add_callback(self.add_event, Event(self, 'progress', {'phase': phase,
+                                                                          'progress': percent,
+                                                                          'throughput': None if throughput is None else self.__to_mbit(throughput)}))
+
     def __update_speed_props(self, speed: Speed):
+        self.speed_history.append(datetime.now(), speed)
+        DOWNLOAD_SPEED.labels(self.wan).set(speed.downloadspeed)
+        UPLOAD_SPEED.labels(self.wan).set(speed.uploadspeed)
+        PING_SECONDS.labels(self.wan).set(speed.ping / 1000)
+        BACKGROUND_TRAFFIC.labels(self.wan).set(speed.background_during)
+        LAST_SPEEDTEST.labels(self.wan).set(datetime.now().timestamp())
         self.uploadspeed.notify_of_external_update(self.__to_mbit(speed.uploadspeed))
         self.downloadspeed.notify_of_external_update(self.__to_mbit(speed.downloadspeed))
         self.ping_time.notify_of_external_update(speed.ping)
         self.testdate.notify_of_external_update(datetime.now().isoformat())
         self.testserver.notify_of_external_update(speed.server)
-        self.resulturi.notify_of_external_update(speed.report_uri)
+        self.resulturi.notify_of_external_update("" if speed.report_uri is None else speed.report_uri)
+        if speed.background_during is not None:
+            self.background_traffic.notify_of_external_update(self.__to_mbit(speed.background_during))
+        self.add_event(Event(self, 'result', {'download_speed': self.__to_mbit(speed.downloadspeed),
+                                              'upload_speed': self.__to_mbit(speed.uploadspeed),
+                                              'ping': speed.ping,
+                                              'speedtest_server': speed.server,
+                                              'speedtest_result_uri': speed.report_uri,
+                                              'background_traffic': None if speed.background_during is None else self.__to_mbit(speed.background_during)}))
 
     def __to_mbit(self, bit_pre_sec: int):
         return round(bit_pre_sec / (1000 * 1000), 1)
@@ -0,0 +1,92 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import logging
+
+
+class ThroughputRequestHandler(BaseHTTPRequestHandler):
+
+    # minimal endpoint of the http speed engine
+    #   GET <path>/download?size=<bytes>   returns <bytes> bytes
+    #   POST <path>/upload                 discards the request body
+    # The data is sent from and received into a preallocated buffer
+    protocol_version = 'HTTP/1.1'
+    BUFFER_SIZE = 128 * 1024
+    MAX_DOWNLOAD_SIZE = 10 * 1024 * 1024 * 1024
+    DATA = memoryview(bytes(BUFFER_SIZE))
+
+    def do_GET(self):
+        uri = urlparse(self.path)
+        if not uri.path.rstrip('/').endswith('/download'):
+            self.send_error(404)
+            return
+        try:
+            size = min(int(parse_qs(uri.query).get('size', ['0'])[0]), self.MAX_DOWNLOAD_SIZE)
+        except ValueError:
+            self.send_error(400)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        remaining = size
+        try:
+            while remaining > 0:
+                chunk = self.DATA if remaining >= len(self.DATA) else self.DATA[:remaining]
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        except ConnectionError:
+            # the client aborts the download once its measurement duration is elapsed
+            self.close_connection = True
+
+    def do_POST(self):
+        if not urlparse(self.path).path.rstrip('/').endswith('/upload'):
+            self.send_error(404)
+            return
+        buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        remaining = int(self.headers.get('Content-Length', '0'))
+        try:
+            while remaining > 0:
+                num_read = self.rfile.readinto(buffer if remaining >= len(buffer) else buffer[:remaining])
+                if num_read == 0:
+                    self.close_connection = True
+                    return
+                remaining -= num_read
+        except ConnectionError:
+            self.close_connection = True
+            return
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + " " + (format % args))
+
+
+class ThroughputServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+
+def run_throughput_server(port: int = 8088, host: str = ''):
+    server = ThroughputServer((host, port), ThroughputRequestHandler)
+    logging.info("throughput server listening on port " + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def main():
+    # local stand-in of a throughput test endpoint, e.g. to test the http speed engine offline
+    #   python -m internet_monitor_webthing.throughput_server --port 8088
+    parser = argparse.ArgumentParser(description='throughput test endpoint of the http speed engine')
+    parser.add_argument('--port', metavar='port', required=False, type=int, default=8088, help='the port to listen')
+    parser.add_argument('--host', metavar='host', required=False, type=str, default='', help='the address to bind (default: all)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+    run_throughput_server(args.port, args.host)
+
+
+if __name__ == '__main__':
+    main()
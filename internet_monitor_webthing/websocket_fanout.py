@@ -0,0 +1,181 @@
+from webthing import Thing
+from typing import Dict, List
+from internet_monitor_webthing.metrics import REGISTRY
+import tornado.ioloop
+import tornado.websocket
+import logging
+import json
+import time
+import uuid
+
+
+WEBSOCKET_MESSAGES = REGISTRY.counter('netmonitor_websocket_messages_total', 'Messages pushed to the websocket subscribers', ['type'])
+WEBSOCKET_DROPPED_CLIENTS = REGISTRY.counter('netmonitor_websocket_dropped_clients_total', 'Websocket subscribers closed because they did not keep up')
+
+
+class Client:
+
+    def __init__(self):
+        self.last_sent = 0
+        self.buffered_bytes = 0      # written, but not flushed to the socket yet
+        self.pending = {}            # names of the properties held back by the rate limit (ordered)
+        self.timeout = None
+
+    def written(self, future, num_bytes: int):
+        self.buffered_bytes -= num_bytes
+        if not future.cancelled():
+            # the error (closed connection) is handled by on_close. Retrieving it suppresses the warning of the io loop
+            future.exception()
+
+
+class CoalescingThing(Thing):
+
+    # webthing pushes each property change as a message of its own, serialized per subscriber. Here, the changes of
+    # an io loop iteration (such as all the props updated by a connectivity state change) are coalesced into a single
+    # propertyStatus message. The message is serialized once and the same bytes are written to all subscribers.
+    # A subscriber receives at most one propertyStatus message per MIN_INTERVAL_SEC. Changes within this interval
+    # are held back and sent merged. A subscriber whose unflushed messages exceed MAX_BUFFERED_BYTES is closed
+    # instead of buffering without limit.
+    # Each property change bumps the version of the thing. The serialized properties (polled by /<idx>/properties)
+    # are cached per version and their ETag is derived from the version.
+    # Telemetry properties (such as the traffic of a probe cycle or the rolling latency percentiles) change
+    # continuously. They would outdate the ETag and trigger a push each second. Their changes are collected and
+    # bump the version and are pushed at most once per TELEMETRY_INTERVAL_SEC. Until then, /<idx>/properties
+    # provides their values of the previous version
+    MIN_INTERVAL_SEC = 0.5
+    TELEMETRY_INTERVAL_SEC = 10
+    MAX_BUFFERED_BYTES = 256 * 1024
+
+    def __init__(self, id_: str, title: str, type_: List[str], description: str):
+        Thing.__init__(self, id_, title, type_, description)
+        self.__changed = {}          # names of the properties changed since the last flush (ordered)
+        self.__clients: Dict[object, Client] = {}
+        self.__fanout_ioloop = tornado.ioloop.IOLoop.current()
+        self.version = 0
+        self.__instance = uuid.uuid4().hex[:8]      # the version restarts on restart
+        self.__properties_json = (-1, b'')
+        self.__telemetry = set()     # names of the telemetry properties
+        self.__telemetry_changed = {}    # names of the telemetry properties changed since the last telemetry flush (ordered)
+        self.__telemetry_flushed = 0
+        self.__telemetry_timeout = None
+
+    def add_telemetry_property(self, property_):
+        self.add_property(property_)
+        self.__telemetry.add(property_.name)
+
+    def add_subscriber(self, subscriber):
+        Thing.add_subscriber(self, subscriber)
+        self.__clients[subscriber] = Client()
+
+    def remove_subscriber(self, subscriber):
+        Thing.remove_subscriber(self, subscriber)
+        client = self.__clients.pop(subscriber, None)
+        if client is not None and client.timeout is not None:
+            self.__fanout_ioloop.remove_timeout(client.timeout)
+
+    def properties_etag(self) -> str:
+        return '"' + self.__instance + '-' + str(self.version) + '"'
+
+    def properties_json(self) -> bytes:
+        if self.__properties_json[0] != self.version:
+            self.__properties_json = (self.version, json.dumps(self.get_properties()).encode('utf-8'))
+        return self.__properties_json[1]
+
+    def property_notify(self, property_):
+        if property_.name in self.__telemetry:
+            self.__telemetry_changed[property_.name] = True
+            if self.__telemetry_timeout is None:
+                wait_sec = self.__telemetry_flushed + CoalescingThing.TELEMETRY_INTERVAL_SEC - time.monotonic()
+                self.__telemetry_timeout = self.__fanout_ioloop.call_later(max(0, wait_sec), self.__flush_telemetry)
+        else:
+            self.__changed_notify([property_.name])
+
+    def __changed_notify(self, names: List[str]):
+        self.version += 1
+        if len(self.__changed) == 0:
+            self.__fanout_ioloop.add_callback(self.__flush)
+        for name in names:
+            self.__changed[name] = True
+
+    def __flush_telemetry(self):
+        self.__telemetry_timeout = None
+        self.__telemetry_flushed = time.monotonic()
+        names = list(self.__telemetry_changed.keys())
+        self.__telemetry_changed = {}
+        if len(names) > 0:
+            self.__changed_notify(names)
+
+    def action_notify(self, action):
+        self.__broadcast(list(self.subscribers), 'actionStatus', action.as_action_description())
+
+    def event_notify(self, event):
+        if event.name in self.available_events:
+            self.__broadcast(list(self.available_events[event.name]['subscribers']), 'event', event.as_event_description())
+
+    def __message(self, names) -> bytes:
+        # bytes are written as they are (text frame), a str would be encoded per subscriber
+        data = {}
+        for name in names:
+            property_ = self.find_property(name)
+            if property_ is not None:
+                data[name] = property_.get_value()
+        return json.dumps({'messageType': 'propertyStatus', 'data': data}).encode('utf-8')
+
+    def __flush(self):
+        names = list(self.__changed.keys())
+        self.__changed = {}
+        if len(names) == 0 or len(self.subscribers) == 0:
+            return
+        message = None
+        now = time.monotonic()
+        for subscriber in list(self.subscribers):
+            client = self.__clients.get(subscriber)
+            if client is None:
+                continue
+            wait_sec = client.last_sent + CoalescingThing.MIN_INTERVAL_SEC - now
+            if wait_sec > 0 or client.timeout is not None:
+                for name in names:
+                    client.pending[name] = True
+                if client.timeout is None:
+                    client.timeout = self.__fanout_ioloop.call_later(wait_sec, self.__flush_held_back, subscriber)
+            else:
+                if message is None:
+                    message = self.__message(names)
+                    WEBSOCKET_MESSAGES.labels('propertyStatus').inc()
+                self.__send(subscriber, client, message)
+
+    def __flush_held_back(self, subscriber):
+        client = self.__clients.get(subscriber)
+        if client is not None:
+            client.timeout = None
+            names = list(client.pending.keys())
+            client.pending = {}
+            if len(names) > 0:
+                WEBSOCKET_MESSAGES.labels('propertyStatus').inc()
+                self.__send(subscriber, client, self.__message(names))
+
+    def __broadcast(self, subscribers: List, message_type: str, data: Dict):
+        # actions and events are discrete. They are not coalesced, but serialized once and subject to the backpressure
+        if len(subscribers) > 0:
+            message = json.dumps({'messageType': message_type, 'data': data}).encode('utf-8')
+            WEBSOCKET_MESSAGES.labels(message_type).inc()
+            for subscriber in subscribers:
+                client = self.__clients.get(subscriber)
+                if client is not None:
+                    self.__send(subscriber, client, message)
+
+    def __send(self, subscriber, client: Client, message: bytes):
+        if client.buffered_bytes > CoalescingThing.MAX_BUFFERED_BYTES:
+            logging.warning("closing websocket subscriber " + str(subscriber.request.remote_ip) + " of " + self.get_title() + ". " + str(client.buffered_bytes) + " bytes have not been consumed")
+            WEBSOCKET_DROPPED_CLIENTS.inc()
+            self.remove_subscriber(subscriber)
+            subscriber.close()
+            return
+        try:
+            future = subscriber.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            self.remove_subscriber(subscriber)
+            return
+        client.last_sent = time.monotonic()
+        client.buffered_bytes += len(message)
+        future.add_done_callback(lambda future: client.written(future, len(message)))
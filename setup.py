@@ -38,6 +38,7 @@ setup(
         'webthing==0.15.0',
         'speedtest-cli==2.1.3',
         'ipwhois',
+        'dnspython',
         'requests'
     ],
     classifiers=[
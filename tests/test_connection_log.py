@@ -0,0 +1,260 @@
+from datetime import datetime, timedelta
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, ConnectionLog, ConnectionTester, PathInfo
+from internet_monitor_webthing.record_log import RecordLog
+import asyncio
+import pickle
+import os
+
+
+START = datetime(2021, 3, 1, 12, 0, 0)
+
+
+def legacy_entries(num: int):
+    # the pickled entries of the legacy log cover the date, the state, the ip address and the ip info only
+    entries = []
+    for idx in range(num):
+        connected = idx % 2 == 0
+        entries.append(ConnectionInfo(START + timedelta(minutes=idx), connected, "1.2.3.4" if connected else "", {'asn': 'AS1' if connected else ''}))
+    return entries
+
+
+def write_legacy(filename: str, entries):
+    with open(filename, "wb") as file:
+        pickle.dump(entries, file)
+
+
+def test_migration(tmp_path):
+    write_legacy(str(tmp_path / "log.p"), legacy_entries(5))
+    log = ConnectionLog(str(tmp_path / "log.bin"))
+    entries = list(log.entries())
+    assert [entry.date for entry in entries] == [START + timedelta(minutes=idx) for idx in range(5)]
+    assert [entry.is_connected for entry in entries] == [True, False, True, False, True]
+    assert entries[0].ip_address == "1.2.3.4"
+    assert entries[0].ipv4 == PathInfo(True, "1.2.3.4", {'asn': 'AS1'})
+    assert entries[1].ipv4.is_connected is False
+    assert entries[0].ipv6 is None
+    assert os.path.exists(str(tmp_path / "log.p.migrated"))
+    assert not os.path.exists(str(tmp_path / "log.p"))
+    log.close()
+
+
+def test_failed_migration_is_retried(tmp_path):
+    with open(str(tmp_path / "log.p"), "wb") as file:
+        file.write(b'corrupted')
+    log = ConnectionLog(str(tmp_path / "log.bin"))
+    assert len(log) == 0
+    log.append(ConnectionInfo.of_paths(START + timedelta(days=1), PathInfo(True, "5.6.7.8", {'asn': 'AS2'}), None))
+    log.close()
+    assert os.path.exists(str(tmp_path / "log.p"))
+
+    # the legacy file is readable now. The legacy entries are migrated and the newer entry is kept
+    write_legacy(str(tmp_path / "log.p"), legacy_entries(3))
+    log = ConnectionLog(str(tmp_path / "log.bin"))
+    entries = list(log.entries())
+    assert len(entries) == 4
+    assert entries[-1].ip_address == "5.6.7.8"
+    assert not os.path.exists(str(tmp_path / "log.bin.migrating"))
+    log.close()
+
+
+def write_records(filename: str, version: int, entries):
+    log = RecordLog(filename, ConnectionLog.RECORDS[version].size, version)
+    for entry in entries:
+        fields = [entry.date.timestamp(), entry.is_connected, entry.ip_address.encode('utf-8'), entry.ip_info['asn'].encode('utf-8')]
+        if version >= 2:
+            fields += [(entry.date - timedelta(seconds=2)).timestamp(), entry.date.timestamp()]
+        if version >= 3:
+            fields += [int(entry.is_connected), 10.0, -1, float('nan'), b'', b'']
+        log.append(ConnectionLog.RECORDS[version].pack(*fields))
+    log.close()
+
+
+def test_upgrade_of_record_version_1(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    write_records(filename, 1, legacy_entries(4))
+    log = ConnectionLog(filename)
+    assert log.log.version == ConnectionLog.RECORD_VERSION
+    entries = list(log.entries())
+    assert [entry.is_connected for entry in entries] == [True, False, True, False]
+    assert entries[0].change_after is None
+    assert entries[2].ipv4 == PathInfo(True, "1.2.3.4", {'asn': 'AS1'})
+    log.close()
+
+
+def test_upgrade_of_record_version_2(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    write_records(filename, 2, legacy_entries(4))
+    log = ConnectionLog(filename)
+    entries = list(log.entries())
+    assert entries[1].change_after == START + timedelta(minutes=1, seconds=-2)
+    assert entries[1].change_before == START + timedelta(minutes=1)
+    assert entries[1].ipv4 == PathInfo(False, "", {'asn': ''})
+    log.close()
+
+    # reopened without another upgrade
+    log = ConnectionLog(filename)
+    assert [entry.date for entry in log.entries()] == [entry.date for entry in entries]
+    log.close()
+
+
+def test_migrated_and_upgraded_entries_are_consistent(tmp_path):
+    os.makedirs(str(tmp_path / "a"))
+    os.makedirs(str(tmp_path / "b"))
+    write_legacy(str(tmp_path / "a" / "log.p"), legacy_entries(4))
+    write_records(str(tmp_path / "b" / "log.bin"), 1, legacy_entries(4))
+    migrated = ConnectionLog(str(tmp_path / "a" / "log.bin"))
+    upgraded = ConnectionLog(str(tmp_path / "b" / "log.bin"))
+    assert list(migrated.entries()) == list(upgraded.entries())
+    migrated.close()
+    upgraded.close()
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    log = ConnectionLog(filename)
+    info = ConnectionInfo.of_paths(START, PathInfo(True, "1.2.3.4", {'asn': 'AS1'}, 12.5), PathInfo(False, "", {'asn': ''}, None))
+    info.change_after = START - timedelta(seconds=3)
+    info.change_before = START
+    log.append(info)
+    log.close()
+    assert list(ConnectionLog(filename).entries()) == [info]
+
+
+def test_empty_ip_infos_are_not_shared():
+    first, second = PathInfo(False), PathInfo(False)
+    first.ip_info['asn'] = 'AS1'
+    assert second.ip_info == {'asn': ''}
+    disconnected = ConnectionInfo.of_paths(START, first, None)
+    disconnected.ip_info['asn'] = 'AS2'
+    assert ConnectionInfo.of_paths(START, PathInfo(False), None).ip_info == {'asn': ''}
+
+
+def test_upgrade_of_record_version_3(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    write_records(filename, 3, legacy_entries(2))
+    log = ConnectionLog(filename)
+    assert log.log.version == ConnectionLog.RECORD_VERSION
+    entries = list(log.entries())
+    assert entries[0].ipv4 == PathInfo(True, "1.2.3.4", {'asn': 'AS1'}, 10.0)
+    assert entries[0].ipv6 is None
+    assert not entries[1].unobserved
+    log.close()
+
+
+def test_unobserved_change_is_dated_when_observed(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    log = ConnectionLog(filename)
+    info = ConnectionInfo(START, False, "", {'asn': ''}, START - timedelta(days=3), START, unobserved=True)
+    assert info.estimated_date == START
+    assert info.precision_sec == 3 * 24 * 60 * 60
+    log.append(info)
+    log.close()
+    assert list(ConnectionLog(filename).entries()) == [info]
+
+
+def test_change_detected_on_restart_is_unobserved(tmp_path, monkeypatch):
+    # the previous process observed the connected state the last time at an unknown date
+    monkeypatch.chdir(tmp_path)
+    log = ConnectionLog(str(tmp_path / "log.bin"))
+    connected = ConnectionInfo.of_paths(datetime.now() - timedelta(days=3), PathInfo(True, "1.2.3.4", {'asn': 'AS1'}), None)
+    log.append(connected)
+    tester = ConnectionTester(log, test_uris=["tcp://127.0.0.1:1"])
+
+    async def measure(timeout, confirm_timeout):
+        return ConnectionInfo.of_paths(datetime.now(), PathInfo(False), None)
+    tester.measure = measure
+
+    async def run():
+        changes = []
+        task = asyncio.ensure_future(tester.measure_periodically(60, changes.append))
+        while len(changes) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return changes[1]
+
+    changed = asyncio.run(run())
+    assert changed.unobserved
+    assert changed.change_after == log.oldest().date
+    assert abs((changed.estimated_date - datetime.now()).total_seconds()) < 5
+    assert changed.precision_sec > 2 * 24 * 60 * 60
+    tester.stop()
+    log.close()
+
+
+def append_changes(log: ConnectionLog, first: int, num: int):
+    for idx in range(first, first + num):
+        connected = idx % 2 == 0
+        log.append(ConnectionInfo.of_paths(START + timedelta(minutes=7 * idx), PathInfo(connected, "1.2.3.4" if connected else "", {'asn': 'AS1' if connected else ''}), None))
+
+
+def test_analytics_are_restored_from_the_checkpoint(tmp_path, monkeypatch):
+    filename = str(tmp_path / "log.bin")
+    log = ConnectionLog(filename)
+    append_changes(log, 0, 500)
+    expected = log.analytics.report(START + timedelta(days=5))
+    log.close()
+    assert os.path.exists(str(tmp_path / "log.analytics.json"))
+
+    # the checkpoint covers all entries. Nothing is replayed
+    decoded = []
+    decode = ConnectionLog._ConnectionLog__decode
+    monkeypatch.setattr(ConnectionLog, '_ConnectionLog__decode', staticmethod(lambda record, version=ConnectionLog.RECORD_VERSION: decoded.append(record) or decode(record, version)))
+    log = ConnectionLog(filename)
+    assert decoded == []
+    assert log.analytics.report(START + timedelta(days=5)) == expected
+    log.close()
+
+
+def test_entries_after_the_checkpoint_are_replayed(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    reference = ConnectionLog(str(tmp_path / "reference.bin"))
+    append_changes(reference, 0, 30)
+    log = ConnectionLog(filename)
+    append_changes(log, 0, 20)
+    log.checkpoint()
+    append_changes(log, 20, 10)
+    # crash: the close (and its checkpoint) is missing
+    log.sync()
+    reopened = ConnectionLog(filename)
+    now = START + timedelta(days=1)
+    assert reopened.checkpointed == 20
+    assert reopened.analytics.report(now) == reference.analytics.report(now)
+    reopened.close()
+    reference.close()
+
+
+def test_outdated_checkpoint_is_ignored(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    log = ConnectionLog(filename)
+    append_changes(log, 0, 20)
+    log.close()
+    checkpoint = str(tmp_path / "log.analytics.json")
+    with open(checkpoint, "rb") as file:
+        data = file.read()
+    # the log is recreated. The checkpoint does not match it
+    os.remove(filename)
+    log = ConnectionLog(filename)
+    append_changes(log, 100, 25)
+    log.sync()
+    with open(checkpoint, "wb") as file:
+        file.write(data)
+    reopened = ConnectionLog(filename)
+    assert reopened.analytics.since == START + timedelta(minutes=700)
+    assert reopened.analytics.outages == 12
+    reopened.close()
+    log.log.close()
+
+
+def test_checkpoint_survives_compaction(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    log = ConnectionLog(filename, max_entries=40)
+    append_changes(log, 0, 100)
+    now = START + timedelta(days=1)
+    expected = log.analytics.report(now)
+    assert len(log) <= 50
+    log.close()
+    reopened = ConnectionLog(filename, max_entries=40)
+    # the analytics still cover the dropped entries
+    assert reopened.analytics.report(now) == expected
+    assert reopened.analytics.outages == 50
+    reopened.close()
@@ -0,0 +1,59 @@
+from internet_monitor_webthing.connectivity_monitor import ConnectionTester
+from internet_monitor_webthing.ip_info import IpInfo
+from internet_monitor_webthing.probes import ProbeResult
+import asyncio
+import time
+
+
+TARGETS = ["tcp://127.0.0.1:1", "tcp://127.0.0.1:2", "tcp://127.0.0.1:3"]
+
+
+def new_tester(tmp_path, outcomes, quorum: int) -> ConnectionTester:
+    # the probes are replaced by ones answering after the given delay (sec) with the given state
+    tester = ConnectionTester(None, TARGETS, quorum=quorum, ip_address_sources=[], ip_info=IpInfo(str(tmp_path / "ip_info.json")))
+    for probe, (delay_sec, is_connected) in zip(tester.paths[0].probes, outcomes):
+        async def check(timeout: float, probe=probe, delay_sec=delay_sec, is_connected=is_connected) -> ProbeResult:
+            await asyncio.sleep(delay_sec)
+            return ProbeResult(probe.name, is_connected, delay_sec * 1000 if is_connected else None, 10)
+        probe.check = check
+    return tester
+
+
+def is_connected(tester: ConnectionTester):
+    async def run():
+        started = time.monotonic()
+        connected = await tester.is_connected(5)
+        elapsed = time.monotonic() - started
+        # the slower probes keep running in the background
+        await asyncio.sleep(0.5)
+        return connected, elapsed
+    return asyncio.run(run())
+
+
+def test_quorum_is_reached_without_waiting_for_the_slowest_probe(tmp_path):
+    tester = new_tester(tmp_path, [(0.01, True), (0.3, True), (0.02, True)], quorum=2)
+    connected, elapsed = is_connected(tester)
+    assert connected
+    assert elapsed < 0.2
+    # the latency of the slow probe is updated nevertheless
+    assert tester.latencies[tester.paths[0].probes[1].name] == 300
+    assert tester.cycle_bytes == 30
+
+
+def test_failed_probes_are_tolerated_by_the_quorum(tmp_path):
+    tester = new_tester(tmp_path, [(0.01, False), (0.02, True), (0.03, True)], quorum=2)
+    connected, _ = is_connected(tester)
+    assert connected
+    assert tester.paths[0].cycle_failures == 1
+
+
+def test_disconnected_as_soon_as_the_quorum_can_not_be_reached(tmp_path):
+    tester = new_tester(tmp_path, [(0.01, False), (0.02, False), (0.3, True)], quorum=2)
+    connected, elapsed = is_connected(tester)
+    assert not connected
+    assert elapsed < 0.2
+
+
+def test_quorum_is_limited_by_the_number_of_targets(tmp_path):
+    tester = ConnectionTester(None, TARGETS, quorum=5, ip_address_sources=[], ip_info=IpInfo(str(tmp_path / "ip_info.json")))
+    assert tester.paths[0].quorum == 3
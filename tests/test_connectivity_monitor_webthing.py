@@ -0,0 +1,140 @@
+from datetime import datetime
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, PathInfo, ProbeStatistics
+from internet_monitor_webthing.connectivity_monitor_webthing import InternetConnectivityMonitorWebthing, NullableValue
+from internet_monitor_webthing.latency_sampler import LatencyStatistics
+from internet_monitor_webthing.handlers import PropertiesHandler
+from internet_monitor_webthing.metrics import REGISTRY
+from internet_monitor_webthing.outage_analytics import OutageAnalytics
+from datetime import timedelta
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import asyncio
+import json
+import pytest
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    thing = InternetConnectivityMonitorWebthing("test", 10, "tcp://127.0.0.1:1", latency_period=0)
+    yield thing
+    thing.connection_log.close()
+    asyncio.get_event_loop().close()
+
+
+def update(monitor, connection_info: ConnectionInfo):
+    monitor._InternetConnectivityMonitorWebthing__update_connected_props(connection_info)
+
+
+def test_nullable_value_accepts_none():
+    value = NullableValue(True)
+    updates = []
+    value.on('update', updates.append)
+    value.notify_of_external_update(None)
+    assert value.get() is None
+    assert updates == [None]
+
+
+def test_path_properties_are_reset(monitor):
+    ipv4 = PathInfo(True, "1.2.3.4", {'asn': 'AS1'}, 12.5)
+    ipv6 = PathInfo(True, "2001:db8::1", {'asn': 'AS1'}, 14.0)
+    update(monitor, ConnectionInfo.of_paths(datetime.now(), ipv4, ipv6))
+    assert monitor.get_property('ipv6_connected') is True
+    assert monitor.get_property('ipv6_latency') == 14.0
+
+    # the ipv6 path is not monitored anymore (e.g. the ipv6 route is gone)
+    update(monitor, ConnectionInfo.of_paths(datetime.now(), ipv4, None))
+    assert monitor.get_property('ipv6_connected') is None
+    assert monitor.get_property('ipv6_latency') is None
+    assert monitor.get_property('ipv6_address') == ""
+
+    # the ipv4 path is disconnected
+    update(monitor, ConnectionInfo.of_paths(datetime.now(), PathInfo(False), None))
+    assert monitor.get_property('ipv4_connected') is False
+    assert monitor.get_property('ipv4_latency') is None
+    assert monitor.get_property('connected') is False
+
+
+def test_latency_properties_are_reset_on_total_loss(monitor):
+    sampled = monitor._InternetConnectivityMonitorWebthing__latency_sampled
+    sampled(LatencyStatistics(10.0, 20.0, 30.0, 2.0, 0, 10))
+    assert monitor.get_property('latency_p50') == 10.0
+    sampled(LatencyStatistics(None, None, None, None, 100, 10))
+    assert monitor.get_property('latency_p50') is None
+    assert monitor.get_property('latency_p99') is None
+    assert monitor.get_property('jitter') is None
+    assert monitor.get_property('packet_loss') == 100
+
+
+def test_properties_are_not_modified_within_a_probe_cycle(monitor):
+    app = tornado.web.Application([(r"/properties", PropertiesHandler, dict(thing=monitor))])
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    url = "http://127.0.0.1:" + str(port) + "/properties"
+
+    async def poll(etag: str = None):
+        headers = {} if etag is None else {'If-None-Match': etag}
+        return await AsyncHTTPClient().fetch(url, headers=headers, raise_error=False)
+
+    async def run():
+        # the probe loop is stopped. The probe cycles are simulated
+        await asyncio.sleep(0)
+        monitor.tester.stop()
+        probed = monitor._InternetConnectivityMonitorWebthing__probed
+        update(monitor, ConnectionInfo.of_paths(datetime.now(), PathInfo(True, "1.2.3.4", {'asn': 'AS1'}, 12.5), None))
+        probed(ProbeStatistics({'tcp://127.0.0.1:1': 12.0}, 100, 100, 1.0))
+        await asyncio.sleep(0.01)
+        first = await poll()
+        assert first.code == 200
+        assert json.loads(first.body)['connected'] is True
+        assert json.loads(first.body)['connection_test_traffic'] == 100
+
+        # a probe cycle and several latency samples update the telemetry only. Its changes are rate limited
+        probed(ProbeStatistics({'tcp://127.0.0.1:1': 12.5}, 120, 1200, 1.5))
+        for latency in [10.0, 11.0, 12.0]:
+            monitor._InternetConnectivityMonitorWebthing__latency_sampled(LatencyStatistics(latency, latency, latency, 1.0, 0, 3))
+        await asyncio.sleep(0)
+        second = await poll(first.headers['ETag'])
+        assert second.code == 304
+        assert monitor.get_property('latency_p50') == 12.0
+
+        # a state change outdates the etag
+        update(monitor, ConnectionInfo.of_paths(datetime.now(), PathInfo(False), None))
+        third = await poll(first.headers['ETag'])
+        assert third.code == 200
+        assert json.loads(third.body)['connected'] is False
+
+    try:
+        IOLoop.current().run_sync(run)
+    finally:
+        server.stop()
+    metrics = REGISTRY.render()
+    assert 'netmonitor_probe_cycle_cpu_seconds{wan=""} 0.0015' in metrics
+    assert 'netmonitor_latency_seconds{wan="",quantile="0.5"} 0.012' in metrics
+
+
+def test_analytics_properties_are_reset(monitor):
+    analytics = OutageAnalytics()
+    start = datetime.now() - timedelta(hours=3)
+    analytics.add(start, True, "AS1")
+    analytics.add(start + timedelta(hours=1), False)
+    analytics.add(start + timedelta(hours=2), True, "AS1")
+    monitor.connection_log.analytics = analytics
+    update_analytics = monitor._InternetConnectivityMonitorWebthing__update_analytics_props
+    update_analytics()
+    assert monitor.get_property('mttr') == 3600
+    assert monitor.get_property('outages') == 1
+    assert monitor.get_property('uptime_day') is not None
+
+    # e.g. the history has been recreated
+    monitor.connection_log.analytics = OutageAnalytics()
+    update_analytics()
+    assert monitor.get_property('mttr') is None
+    assert monitor.get_property('mtbf') is None
+    assert monitor.get_property('uptime_day') is None
+    assert monitor.get_property('outages') == 0
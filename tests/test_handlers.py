@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, ConnectionLog
+from internet_monitor_webthing.handlers import ConnectivityHistoryHandler, OutageReportHandler, PropertiesHandler, SpeedHistoryHandler, parse_time
+from internet_monitor_webthing.outage_analytics import OutageAnalytics
+from internet_monitor_webthing.speedtest_history import SpeedHistory
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
+from webthing import Property, Value
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from types import SimpleNamespace
+import internet_monitor_webthing.handlers as handlers
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import asyncio
+import json
+import pytest
+
+
+def serve(handlers, requests):
+    # runs the requests (a coroutine function getting the base url) against a server of the handlers
+    app = tornado.web.Application(handlers)
+    sock, port = tornado.testing.bind_unused_port()
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    try:
+        IOLoop.current().run_sync(lambda: requests("http://127.0.0.1:" + str(port)))
+    finally:
+        server.stop()
+        IOLoop.current().close(all_fds=True)
+
+
+async def get(url: str, headers=None):
+    return await AsyncHTTPClient().fetch(url, headers=headers, raise_error=False)
+
+
+def test_properties_etag():
+    async def requests(base_url: str):
+        url = base_url + "/properties"
+        first = await get(url)
+        assert first.code == 200
+        assert json.loads(first.body) == {'connected': True}
+        assert first.headers['Cache-Control'] == 'no-cache'
+        etag = first.headers['ETag']
+
+        second = await get(url, {'If-None-Match': etag})
+        assert second.code == 304
+        assert second.headers['ETag'] == etag
+
+        thing.set_property('connected', False)
+        third = await get(url, {'If-None-Match': etag})
+        assert third.code == 200
+        assert json.loads(third.body) == {'connected': False}
+        assert third.headers['ETag'] != etag
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    thing = CoalescingThing("urn:test", "test", [], "test")
+    thing.add_property(Property(thing, 'connected', Value(True)))
+    serve([(r"/properties", PropertiesHandler, dict(thing=thing))], requests)
+
+
+def test_history_conditional_requests(tmp_path):
+    async def requests(base_url: str):
+        url = base_url + "/history"
+        first = await get(url)
+        assert first.code == 200
+        assert len(json.loads(first.body)) == 2
+        etag = first.headers['ETag']
+        last_modified = first.headers['Last-Modified']
+
+        assert (await get(url, {'If-None-Match': etag})).code == 304
+        assert (await get(url, {'If-Modified-Since': last_modified})).code == 304
+        assert (await get(url, {'If-Modified-Since': 'invalid'})).code == 200
+        # If-Modified-Since is ignored, if If-None-Match is given
+        assert (await get(url, {'If-None-Match': '"outdated"', 'If-Modified-Since': last_modified})).code == 200
+
+        log.append(ConnectionInfo(datetime.now(), True, "1.2.3.5", {'asn': 'AS1'}))
+        log.modified = log.modified + timedelta(seconds=2)
+        changed = await get(url, {'If-None-Match': etag})
+        assert changed.code == 200
+        assert len(json.loads(changed.body)) == 3
+        assert (await get(url, {'If-Modified-Since': last_modified})).code == 200
+
+        for invalid in ["inf", "1e20", "99999999999999", "yesterday"]:
+            assert (await get(url + "?from=" + invalid)).code == 400
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    log = ConnectionLog(str(tmp_path / "log.bin"))
+    log.append(ConnectionInfo(datetime.now() - timedelta(minutes=2), True, "1.2.3.4", {'asn': 'AS1'}))
+    log.append(ConnectionInfo(datetime.now() - timedelta(minutes=1), False, "", {}))
+    try:
+        serve([(r"/history", ConnectivityHistoryHandler, dict(connection_log=log))], requests)
+    finally:
+        log.close()
+
+
+def test_outage_report_conditional_requests(monkeypatch):
+    async def requests(base_url: str):
+        url = base_url + "/report"
+        first = await get(url)
+        assert first.code == 200
+        assert json.loads(first.body)['outages']['count'] == 1
+        assert 'Last-Modified' not in first.headers
+        etag = first.headers['ETag']
+        assert etag.startswith('W/')
+
+        assert (await get(url, {'If-None-Match': etag})).code == 304
+
+        analytics.add(datetime.now(), False)
+        changed = await get(url, {'If-None-Match': etag})
+        assert changed.code == 200
+        assert json.loads(changed.body)['outages']['count'] == 2
+
+        # the open interval grows with the time
+        later = changed.headers['ETag']
+        monkeypatch.setattr(handlers, 'datetime', SimpleNamespace(now=lambda: datetime.now() + timedelta(minutes=1)))
+        assert (await get(url, {'If-None-Match': later})).code == 200
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    analytics = OutageAnalytics()
+    start = datetime.now() - timedelta(hours=3)
+    analytics.add(start, True, "AS1")
+    analytics.add(start + timedelta(hours=1), False)
+    analytics.add(start + timedelta(hours=2), True, "AS1")
+    serve([(r"/report", OutageReportHandler, dict(analytics=analytics))], requests)
+
+
+def test_speed_history_parameters_are_validated_first(tmp_path):
+    async def requests(base_url: str):
+        url = base_url + "/speed"
+        first = await get(url)
+        assert first.code == 200
+        etag = first.headers['ETag']
+        assert (await get(url + "?resolution=day", {'If-None-Match': etag})).code == 304
+        # invalid parameters are answered with 400, even if the client's copy is valid
+        assert (await get(url + "?resolution=bogus", {'If-None-Match': etag})).code == 400
+        assert (await get(url + "?resolution=raw&limit=many", {'If-None-Match': etag})).code == 400
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    history = SpeedHistory(str(tmp_path))
+    history.append_row({'time': datetime.now().timestamp(), 'download': 100, 'upload': 10, 'ping': 20, 'background': 0})
+    serve([(r"/speed", SpeedHistoryHandler, dict(speed_history=history))], requests)
+
+
+def test_parse_time():
+    default = datetime(2021, 3, 1)
+    assert parse_time(None, default) == default
+    assert parse_time(" ", default) == default
+    assert parse_time("1614600000", default) == datetime.fromtimestamp(1614600000)
+    assert parse_time("2021-03-01T12:00:00", default) == datetime(2021, 3, 1, 12)
+    for invalid in ["inf", "nan", "-1e20", "99999999999999", "yesterday"]:
+        with pytest.raises(ValueError):
+            parse_time(invalid, default)
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+from internet_monitor_webthing.connectivity_monitor import ConnectionInfo, PathInfo
+from internet_monitor_webthing.hub_store import HubStore, encode_connection
+from tornado.ioloop import IOLoop
+import asyncio
+import json
+import os
+import pytest
+
+
+START = datetime(2021, 3, 1, 12, 0, 0)
+LOG_ID = START.timestamp()
+
+
+def connection_entries(first: int, num: int):
+    return [encode_connection(ConnectionInfo.of_paths(START + timedelta(minutes=idx), PathInfo(idx % 2 == 0, "1.2.3.4" if idx % 2 == 0 else "", {'asn': 'AS1'}), None))
+            for idx in range(first, first + num)]
+
+
+def batch(start, entries, log_id: float = LOG_ID):
+    return {'site': 'berlin', 'wans': [{'wan': 'dsl', 'connection': {'log_id': log_id, 'start': start, 'entries': entries}}]}
+
+
+def ingest(store: HubStore, batch_) -> int:
+    return IOLoop.current().run_sync(lambda: store.ingest(batch_))['wans']['dsl']['connection']
+
+
+@pytest.fixture
+def store(tmp_path):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    store = HubStore(str(tmp_path / "hub"))
+    yield store
+    store.close()
+
+
+def dates(store: HubStore):
+    return [entry.date for entry in store.find('berlin', 'dsl').connection_log.entries()]
+
+
+def test_batches_are_appended(store):
+    assert ingest(store, batch(0, connection_entries(0, 3))) == 3
+    assert ingest(store, batch(3, connection_entries(3, 2))) == 5
+    assert dates(store) == [START + timedelta(minutes=idx) for idx in range(5)]
+
+
+def test_duplicate_batch_is_skipped(store):
+    # the acknowledge of the first push has been lost. The agent pushes the same batch again
+    assert ingest(store, batch(0, connection_entries(0, 3))) == 3
+    assert ingest(store, batch(0, connection_entries(0, 3))) == 3
+    # overlapping batch: the already ingested entries are skipped
+    assert ingest(store, batch(2, connection_entries(2, 3))) == 5
+    assert dates(store) == [START + timedelta(minutes=idx) for idx in range(5)]
+
+
+def test_out_of_order_batch_is_rejected(store):
+    assert ingest(store, batch(0, connection_entries(0, 2))) == 2
+    # a gap: the agent has to resend from the expected index
+    assert ingest(store, batch(4, connection_entries(4, 2))) == 2
+    assert len(dates(store)) == 2
+    assert ingest(store, batch(2, connection_entries(2, 4))) == 6
+    assert dates(store) == [START + timedelta(minutes=idx) for idx in range(6)]
+
+
+def test_recreated_agent_history_is_replayed(store):
+    assert ingest(store, batch(0, connection_entries(0, 3))) == 3
+    # the agent history has been compacted (new log id). Ingesting the middle of it is refused
+    assert ingest(store, batch(1, connection_entries(2, 2), LOG_ID + 60)) == 0
+    # the replay overlaps with the stored entries. Entries not newer than the stored ones are skipped
+    assert ingest(store, batch(0, connection_entries(2, 3), LOG_ID + 60)) == 3
+    assert dates(store) == [START + timedelta(minutes=idx) for idx in range(5)]
+
+
+def test_ingest_state_is_stored(store, tmp_path):
+    ingest(store, batch(0, connection_entries(0, 3)))
+    with open(str(tmp_path / "hub" / "berlin" / "dsl" / "ingest.json")) as file:
+        assert json.load(file)['streams']['connection'] == {'log_id': LOG_ID, 'next': 3}
+    store.close()
+    reloaded = HubStore(str(tmp_path / "hub"))
+    assert IOLoop.current().run_sync(lambda: reloaded.ingest(batch(0, connection_entries(0, 3))))['wans']['dsl']['connection'] == 3
+    assert len(list(reloaded.find('berlin', 'dsl').connection_log.entries())) == 3
+    reloaded.close()
+
+
+def test_concurrent_batches_of_a_site_are_serialized(store):
+    async def push():
+        return await asyncio.gather(store.ingest(batch(0, connection_entries(0, 3))), store.ingest(batch(0, connection_entries(0, 3))))
+    responses = IOLoop.current().run_sync(push)
+    assert [response['wans']['dsl']['connection'] for response in responses] == [3, 3]
+    assert len(dates(store)) == 3
+
+
+def test_invalid_batch(store):
+    with pytest.raises(ValueError):
+        IOLoop.current().run_sync(lambda: store.ingest({'wans': []}))
+    with pytest.raises(ValueError):
+        IOLoop.current().run_sync(lambda: store.ingest({'site': '../etc', 'wans': [{'wan': 'dsl'}]}))
+    assert not os.path.exists(os.path.join(store.dir, '..', 'etc'))
+
+
+def test_speed_rows_with_missing_metrics_are_rolled_up(store):
+    entries = [{'time': START.timestamp(), 'download': 100, 'upload': 10, 'ping': 20},
+               {'time': (START + timedelta(minutes=10)).timestamp(), 'download': None, 'upload': 30},
+               {'time': (START + timedelta(minutes=20)).timestamp(), 'download': 50, 'upload': 20, 'ping': None}]
+    IOLoop.current().run_sync(lambda: store.ingest({'site': 'berlin', 'wans': [{'wan': 'dsl', 'speed': {'log_id': LOG_ID, 'start': 0, 'entries': entries}}]}))
+    hours = store.speed_rollup('hour', START, START + timedelta(hours=1))
+    assert hours[0]['count'] == 3
+    assert hours[0]['download'] == {'min': 50, 'avg': 75, 'max': 100}
+    assert hours[0]['upload'] == {'min': 10, 'avg': 20, 'max': 30}
+    assert hours[0]['ping'] == {'min': 20, 'avg': 20, 'max': 20}
+    json.loads(json.dumps(hours), parse_constant=lambda constant: pytest.fail("invalid json " + constant))
+
+
+def test_summary_and_rows_with_missing_metrics_are_valid_json(store):
+    entries = [{'time': START.timestamp(), 'download': 100, 'upload': None}]
+    IOLoop.current().run_sync(lambda: store.ingest({'site': 'berlin', 'wans': [{'wan': 'dsl', 'speed': {'log_id': LOG_ID, 'start': 0, 'entries': entries}}]}))
+    summaries = store.summaries(None)
+    assert summaries[0]['speed'] == {'time': START.isoformat(), 'download': 100, 'upload': None, 'ping': None}
+    rows = store.find('berlin', 'dsl').speed_history.rows(START, START)
+    assert rows == [{'time': START.isoformat(), 'download': 100, 'upload': None, 'ping': None, 'background': None}]
+    json.loads(json.dumps([summaries, rows]), parse_constant=lambda constant: pytest.fail("invalid json " + constant))
@@ -0,0 +1,70 @@
+from internet_monitor_webthing.interface_binding import InterfaceBinding, interface_address, open_connection, parse_wans
+import asyncio
+import socket
+import pytest
+
+
+class UnprivilegedSocket:
+
+    # binding to a device requires CAP_NET_RAW
+    def __init__(self):
+        self.bound = None
+
+    def setsockopt(self, level, option, value):
+        raise PermissionError("not permitted")
+
+    def bind(self, address):
+        self.bound = address
+
+
+def test_interface_address():
+    assert interface_address("lo") == "127.0.0.1"
+    assert interface_address("unknown0") == ""
+    assert interface_address("unknown0", socket.AF_INET6) == ""
+
+
+def test_address_binding_is_the_fallback_of_the_device_binding():
+    binding = InterfaceBinding("lo")
+    sock = UnprivilegedSocket()
+    binding.bind(sock)
+    assert sock.bound == ("127.0.0.1", 0)
+    assert not binding.device_binding
+
+    with pytest.raises(ConnectionError):
+        InterfaceBinding("unknown0").bind(UnprivilegedSocket())
+
+
+def test_bound_connection():
+    async def run(binding: InterfaceBinding):
+        peers = []
+
+        async def accept(reader, writer):
+            peers.append(writer.get_extra_info('peername')[0])
+            writer.close()
+        server = await asyncio.start_server(accept, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await open_connection("127.0.0.1", port, family=socket.AF_INET, binding=binding)
+            assert writer.get_extra_info('sockname')[0] == "127.0.0.1"
+            await reader.read()
+            writer.close()
+        finally:
+            server.close()
+        return peers
+
+    binding = InterfaceBinding("lo")
+    # the address binding works without privileges
+    binding.device_binding = False
+    assert asyncio.run(run(binding)) == ["127.0.0.1"]
+    with pytest.raises(ConnectionError):
+        binding = InterfaceBinding("unknown0")
+        binding.device_binding = False
+        asyncio.run(run(binding))
+
+
+def test_parse_wans():
+    assert parse_wans("dsl=eth0, lte=wwan0") == {'dsl': 'eth0', 'lte': 'wwan0'}
+    assert parse_wans("eth0,") == {'eth0': 'eth0'}
+    assert parse_wans("") == {}
+    with pytest.raises(ValueError):
+        parse_wans("../etc=eth0")
@@ -0,0 +1,132 @@
+from internet_monitor_webthing.ip_address_resolver import AddressChangeMonitor, IpAddressResolver, IpAddressSource, create_source, DnsSource, public_address
+import internet_monitor_webthing.ip_address_resolver as ip_address_resolver
+import asyncio
+import socket
+import pytest
+
+
+class FakeSource(IpAddressSource):
+
+    def __init__(self, target: str, address: str, delay_sec: float, is_local: bool = False):
+        super().__init__(target, is_local=is_local)
+        self.address = address
+        self.delay_sec = delay_sec
+        self.queries = 0
+        self.cancelled = False
+
+    async def do_resolve(self, timeout: float) -> str:
+        self.queries += 1
+        try:
+            await asyncio.sleep(self.delay_sec)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.address is None:
+            raise ConnectionError("no address")
+        return self.address
+
+
+@pytest.fixture
+def route(monkeypatch):
+    # the source address of the default route
+    route = {'address': "192.168.1.2"}
+    monkeypatch.setattr(ip_address_resolver, 'local_address', lambda family, binding: route['address'])
+    return route
+
+
+def new_resolver(sources) -> IpAddressResolver:
+    resolver = IpAddressResolver([])
+    resolver.sources = sources
+    # the kernel is not listened to
+    resolver.monitor = AddressChangeMonitor(resolver.clear_cache)
+    return resolver
+
+
+def test_fastest_valid_source_wins(route):
+    failing = FakeSource("fail://", None, 0.01)
+    fast = FakeSource("fast://", "1.2.3.4", 0.05)
+    slow = FakeSource("slow://", "5.6.7.8", 1)
+    resolver = new_resolver([failing, fast, slow])
+
+    async def run():
+        address = await resolver.get_internet_address(2)
+        await asyncio.sleep(0)
+        return address
+
+    assert asyncio.run(run()) == "1.2.3.4"
+    # the pending queries are cancelled
+    assert slow.cancelled
+
+
+def test_no_source_resolves(route):
+    resolver = new_resolver([FakeSource("fail://", None, 0.01)])
+    assert asyncio.run(resolver.get_internet_address(2)) == ""
+    assert resolver.next_retry > 0
+
+
+def test_address_is_cached_until_a_change_is_indicated(route):
+    source = FakeSource("fast://", "1.2.3.4", 0)
+    resolver = new_resolver([source])
+
+    async def run():
+        await resolver.get_internet_address(2)
+        await resolver.get_internet_address(2)
+        assert source.queries == 1
+        # e.g. the connection has been lost
+        resolver.clear_cache()
+        await resolver.get_internet_address(2)
+        assert source.queries == 2
+        # the source address of the default route has changed
+        route['address'] = "192.168.1.3"
+        await resolver.get_internet_address(2)
+        assert source.queries == 3
+
+    asyncio.run(run())
+
+
+def test_local_source_reporting_another_address_invalidates_the_cache(route, monkeypatch):
+    monkeypatch.setattr(IpAddressResolver, 'LOCAL_POLL_PERIOD_SEC', 0)
+    router = FakeSource("upnp://", "1.2.3.4", 0, is_local=True)
+    remote = FakeSource("remote://", "1.2.3.4", 0.05)
+    resolver = new_resolver([router, remote])
+
+    async def run():
+        assert await resolver.get_internet_address(2) == "1.2.3.4"
+        await resolver.get_internet_address(2)
+        assert remote.queries == 1
+        router.address = "5.6.7.8"
+        return await resolver.get_internet_address(2)
+
+    assert asyncio.run(run()) == "5.6.7.8"
+    assert remote.queries == 2
+
+
+def test_change_monitor_reports_address_and_route_changes():
+    events = []
+    monitor = AddressChangeMonitor(events.append)
+    monitor.sock, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    monitor.sock.setblocking(False)
+    try:
+        # netlink messages: new address (20), an unrelated one (2 = error), deleted route (25)
+        messages = b''.join([AddressChangeMonitor.HEADER.pack(20, msg_type, 0, 0, 0) + b'\0\0\0\0' for msg_type in [20, 2, 25]])
+        peer.send(messages)
+        monitor._AddressChangeMonitor__on_readable()
+        # nothing to read
+        monitor._AddressChangeMonitor__on_readable()
+    finally:
+        peer.close()
+        monitor.sock.close()
+    assert events == ["deleted route, new address"]
+
+
+def test_sources():
+    assert create_source("dns://[2620:119:35::35]/myip.opendns.com").family == socket.AF_INET6
+    dns_source = create_source("dns://208.67.222.222/myip.opendns.com")
+    assert isinstance(dns_source, DnsSource) and dns_source.record_type == 'A'
+    assert create_source("upnp://").is_local
+    # sources of the other ip version are dropped
+    assert [source.target for source in IpAddressResolver(["dns://208.67.222.222/myip.opendns.com", "dns://[2620:119:35::35]/myip.opendns.com"], socket.AF_INET6).sources] == ["dns://[2620:119:35::35]/myip.opendns.com"]
+    with pytest.raises(ValueError):
+        create_source("ftp://example.org")
+    with pytest.raises(ValueError):
+        public_address("100.64.1.2")     # carrier-grade NAT
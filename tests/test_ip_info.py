@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from internet_monitor_webthing.ip_info import IpInfo
+import ipwhois
+import json
+import os
+
+
+class IPWhois:
+
+    def __init__(self, ip: str):
+        self.ip = ip
+
+    def lookup_rdap(self):
+        return {'asn_description': 'AS' + self.ip.split('.')[2] + ', DE', 'asn_cidr': '10.' + self.ip.split('.')[1] + '.' + self.ip.split('.')[2] + '.0/24'}
+
+
+def test_lookup_is_cached_by_prefix(tmp_path, monkeypatch):
+    monkeypatch.setattr(ipwhois, 'IPWhois', IPWhois)
+    ip_info = IpInfo(str(tmp_path / "ip_info.json"))
+    assert ip_info.get_ip_info("10.1.2.3") == {'asn': 'AS2  DE'}
+    assert ip_info.get_cached("10.1.2.200") == ({'asn': 'AS2  DE'}, True)
+    assert ip_info.get_cached("10.1.3.1") == (None, False)
+
+
+def test_concurrent_lookups_store_a_consistent_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ipwhois, 'IPWhois', IPWhois)
+    filename = str(tmp_path / "ip_info.json")
+    ip_info = IpInfo(filename)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        infos = list(executor.map(ip_info.lookup, ["10.1." + str(idx) + ".1" for idx in range(200)]))
+    assert infos == [{'asn': 'AS' + str(idx) + '  DE'} for idx in range(200)]
+    assert not os.path.exists(filename + ".tmp")
+    with open(filename) as file:
+        assert len(json.load(file)['addresses']) == 200
+    assert len(IpInfo(filename).addresses) == 200
@@ -0,0 +1,31 @@
+from internet_monitor_webthing.latency_sampler import LatencySampler
+import asyncio
+import socket
+
+
+def test_unresolvable_target_is_a_lost_sample(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise socket.gaierror("name resolution failed")
+
+    async def sample():
+        monkeypatch.setattr(asyncio.get_event_loop(), 'getaddrinfo', fail)
+        return await LatencySampler("unresolvable.invalid:443", timeout_sec=0.5).sample()
+
+    assert asyncio.run(sample()) is None
+
+
+def test_cached_address_is_used_if_resolution_fails(monkeypatch):
+    async def sample():
+        sampler = LatencySampler("localhost:1", timeout_sec=0.5)
+        sampler.icmp_permitted = False
+        await sampler.sample()
+        assert sampler.address == "127.0.0.1"
+
+        async def fail(*args, **kwargs):
+            raise socket.gaierror("name resolution failed")
+        monkeypatch.setattr(asyncio.get_event_loop(), 'getaddrinfo', fail)
+        sampler.resolved = 0
+        await sampler.sample()
+        return sampler.address
+
+    assert asyncio.run(sample()) == "127.0.0.1"
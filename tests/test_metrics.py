@@ -0,0 +1,75 @@
+from internet_monitor_webthing.metrics import MetricsRegistry
+import threading
+import sys
+
+
+def test_render():
+    registry = MetricsRegistry()
+    registry.counter('test_requests_total', 'Requests', ['status']).labels('ok').inc(2)
+    registry.gauge('test_temperature', 'Temperature').set(None)
+    registry.histogram('test_duration_seconds', 'Duration', buckets=[0.1, 1]).observe(0.5)
+    assert registry.render() == "\n".join(['# HELP test_requests_total Requests',
+                                           '# TYPE test_requests_total counter',
+                                           'test_requests_total{status="ok"} 2',
+                                           '# HELP test_temperature Temperature',
+                                           '# TYPE test_temperature gauge',
+                                           'test_temperature NaN',
+                                           '# HELP test_duration_seconds Duration',
+                                           '# TYPE test_duration_seconds histogram',
+                                           'test_duration_seconds_bucket{le="0.1"} 0',
+                                           'test_duration_seconds_bucket{le="1"} 1',
+                                           'test_duration_seconds_bucket{le="+Inf"} 1',
+                                           'test_duration_seconds_sum 0.5',
+                                           'test_duration_seconds_count 1']) + "\n"
+    assert registry.render(openmetrics=True).endswith("# EOF\n")
+    assert '# TYPE test_requests counter' in registry.render(openmetrics=True)
+
+
+def test_scrape_while_worker_threads_add_children():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('test_stage_seconds', 'Stages', ['stage'])
+    counter = registry.counter('test_events_total', 'Events', ['kind'])
+    errors = []
+
+    def work(worker: int):
+        try:
+            for idx in range(5000):
+                histogram.labels('stage' + str(worker) + '_' + str(idx)).observe(0.01)
+                counter.labels('shared').inc()
+        except Exception as e:
+            errors.append(e)
+
+    # frequent thread switches provoke the interleaving of the scrape and the updates
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(0.000001)
+    try:
+        workers = [threading.Thread(target=work, args=(worker,)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                registry.render()
+        except Exception as e:
+            errors.append(e)
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert len(histogram.child_items()) == 4 * 5000
+    assert counter.labels('shared').value == 4 * 5000
+    assert 'test_events_total{kind="shared"} 20000' in registry.render()
+
+
+def test_quantiles_of_a_snapshot_are_consistent():
+    registry = MetricsRegistry()
+    buckets = registry.histogram('test_duration_seconds', 'Duration', buckets=[0.1, 1]).labels()
+    for value in [0.05, 0.05, 0.5]:
+        buckets.observe(value)
+    snapshot = buckets.snapshot()
+    # observed after the snapshot has been taken
+    buckets.observe(30)
+    counts, sum_, count_, max_ = snapshot
+    assert (counts, count_, max_) == ([2, 1, 0], 3, 0.5)
+    assert buckets.quantile(0.99, snapshot) == 0.5
+    assert buckets.quantile(0.99) == 30
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from internet_monitor_webthing.outage_analytics import OutageAnalytics
+
+
+HOUR = 60 * 60
+
+
+def test_outage_crossing_midnight_is_split_by_day():
+    analytics = OutageAnalytics()
+    analytics.add(datetime(2021, 3, 10, 12, 0), True, "AS1")
+    analytics.add(datetime(2021, 3, 10, 23, 0), False)
+    analytics.add(datetime(2021, 3, 11, 2, 0), True, "AS1")
+    days = analytics.period_totals('day', datetime(2021, 3, 11, 12, 0))
+    assert days['2021-03-10'] == {'connected_sec': 11 * HOUR, 'disconnected_sec': 1 * HOUR, 'outages': 1}
+    assert days['2021-03-11'] == {'connected_sec': 10 * HOUR, 'disconnected_sec': 2 * HOUR, 'outages': 0}
+    assert analytics.mttr_sec() == 3 * HOUR
+    assert analytics.uptime('day', datetime(2021, 3, 11, 12, 0)) == round(100 * 10 / 12, 3)
+
+
+def test_outage_crossing_week_boundary():
+    # 2021-03-14 is a sunday. ISO weeks start on monday
+    analytics = OutageAnalytics()
+    analytics.add(datetime(2021, 3, 14, 0, 0), True, "AS1")
+    analytics.add(datetime(2021, 3, 14, 20, 0), False)
+    analytics.add(datetime(2021, 3, 15, 6, 0), True, "AS1")
+    weeks = analytics.period_totals('week', datetime(2021, 3, 15, 12, 0))
+    assert weeks['2021-W10'] == {'connected_sec': 20 * HOUR, 'disconnected_sec': 4 * HOUR, 'outages': 1}
+    assert weeks['2021-W11'] == {'connected_sec': 6 * HOUR, 'disconnected_sec': 6 * HOUR, 'outages': 0}
+
+
+def test_outage_crossing_month_and_year_boundary():
+    analytics = OutageAnalytics()
+    analytics.add(datetime(2020, 12, 31, 0, 0), True, "AS1")
+    analytics.add(datetime(2020, 12, 31, 18, 0), False)
+    analytics.add(datetime(2021, 1, 2, 6, 0), True, "AS2")
+    now = datetime(2021, 1, 2, 12, 0)
+    months = analytics.period_totals('month', now)
+    assert months['2020-12'] == {'connected_sec': 18 * HOUR, 'disconnected_sec': 6 * HOUR, 'outages': 1}
+    assert months['2021-01'] == {'connected_sec': 6 * HOUR, 'disconnected_sec': 30 * HOUR, 'outages': 0}
+    # 2021-01-02 belongs to the last iso week of 2020
+    weeks = analytics.period_totals('week', now)
+    assert list(weeks.keys()) == ['2020-W53']
+    assert analytics.longest_outage_sec == 36 * HOUR
+
+    report = analytics.report(now)
+    assert [entry['period'] for entry in report['uptime']['day']] == ['2020-12-31', '2021-01-01', '2021-01-02']
+    assert report['uptime']['day'][1]['uptime'] == 0
+    assert report['outages']['histogram']['>=1d'] == 1
+    assert report['asn']['AS1']['outages'] == 1
+    assert report['asn']['AS1']['outage_sec'] == 36 * HOUR
+    assert report['asn']['AS2']['connected_sec'] == 6 * HOUR
+
+
+def test_open_interval_is_added_at_read_time_only():
+    analytics = OutageAnalytics()
+    analytics.add(datetime(2021, 3, 31, 22, 0), True, "AS1")
+    analytics.add(datetime(2021, 3, 31, 23, 0), False)
+    # the outage is ongoing. It covers the end of march and the first day of april
+    now = datetime(2021, 4, 2, 0, 0)
+    months = analytics.period_totals('month', now)
+    assert months['2021-03']['disconnected_sec'] == 1 * HOUR
+    assert months['2021-04']['disconnected_sec'] == 24 * HOUR
+    assert analytics.uptime('month', now) == 0
+    assert analytics.periods['month'].get('2021-04') is None
+    assert analytics.disconnected_sec == 0
+    assert analytics.mttr_sec() is None
+
+
+def test_retained_periods_are_bounded():
+    analytics = OutageAnalytics()
+    start = datetime(2021, 1, 1)
+    for day in range(OutageAnalytics.RETAINED_PERIODS['day'] + 10):
+        analytics.add(start + timedelta(days=day), day % 2 == 0, "AS1")
+    assert len(analytics.periods['day']) == OutageAnalytics.RETAINED_PERIODS['day']
+    assert analytics.outages == (OutageAnalytics.RETAINED_PERIODS['day'] + 10) // 2
@@ -0,0 +1,61 @@
+from internet_monitor_webthing.probe_scheduler import AdaptiveProbeScheduler, StaggeredStart
+import asyncio
+import time
+import pytest
+
+
+def test_period_backs_off_while_connected():
+    scheduler = AdaptiveProbeScheduler(10)
+    assert [scheduler.next_period(True, 0, 20) for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+
+def test_period_is_reset_if_suspicious():
+    scheduler = AdaptiveProbeScheduler(10)
+    for _ in range(5):
+        scheduler.next_period(True, 0, 20)
+    assert scheduler.next_period(False, 0, None) == AdaptiveProbeScheduler.MIN_PERIOD_SEC
+    assert scheduler.next_period(True, 0, 20) == 1
+    # a failed probe of a connected path
+    assert scheduler.next_period(True, 1, 20) == AdaptiveProbeScheduler.MIN_PERIOD_SEC
+    # a latency spike
+    assert scheduler.next_period(True, 0, 20) == 1
+    assert scheduler.next_period(True, 0, 100) == AdaptiveProbeScheduler.MIN_PERIOD_SEC
+
+
+def test_latency_average():
+    scheduler = AdaptiveProbeScheduler(10)
+    assert scheduler.timeout() == AdaptiveProbeScheduler.MAX_TIMEOUT_SEC
+    scheduler.next_period(True, 0, 200)
+    assert scheduler.latency_avg_ms == 200
+    scheduler.next_period(True, 0, 300)
+    assert scheduler.latency_avg_ms == pytest.approx(220)
+    # ten times the average latency, bounded by the min and the max timeout
+    assert scheduler.timeout() == pytest.approx(2.2)
+    assert scheduler.confirm_timeout() == pytest.approx(6.6)
+    scheduler.latency_avg_ms = 10
+    assert scheduler.timeout() == AdaptiveProbeScheduler.MIN_TIMEOUT_SEC
+    scheduler.latency_avg_ms = 2000
+    assert scheduler.timeout() == AdaptiveProbeScheduler.MAX_TIMEOUT_SEC
+    assert scheduler.confirm_timeout() == AdaptiveProbeScheduler.MAX_CONFIRM_TIMEOUT_SEC
+
+
+def test_max_period_is_not_below_the_min_period():
+    assert AdaptiveProbeScheduler(0.1).next_period(True, 0, 20) == AdaptiveProbeScheduler.MIN_PERIOD_SEC
+
+
+def test_staggered_start():
+    async def run():
+        stagger = StaggeredStart(0.1)
+        started = time.monotonic()
+        starts = []
+
+        async def cycle():
+            await stagger.wait()
+            starts.append(time.monotonic() - started)
+        await asyncio.gather(cycle(), cycle(), cycle())
+        return starts
+
+    starts = asyncio.run(run())
+    assert starts[0] < 0.05
+    assert 0.1 <= starts[1] < 0.15
+    assert 0.2 <= starts[2] < 0.25
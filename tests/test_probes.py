@@ -0,0 +1,138 @@
+from internet_monitor_webthing.probes import create_probe, HttpHeadProbe, HttpGetProbe, TcpProbe
+import asyncio
+import socket
+import pytest
+
+
+class HttpServer:
+
+    # answers HEAD requests with the given status. The connections are kept alive, unless close_idle is set
+    def __init__(self, status: int = 200, close_idle: bool = False):
+        self.status = status
+        self.close_idle = close_idle
+        self.connections = 0
+        self.requests = 0
+        self.server = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self.__handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def __handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                self.requests += 1
+                writer.write(("HTTP/1.1 " + str(self.status) + " OK\r\nContent-Length: 0\r\n\r\n").encode('ascii'))
+                await writer.drain()
+                if self.close_idle:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+def check(server: HttpServer, target: str, num_checks: int, expected_status: int = None):
+    async def run():
+        port = await server.start()
+        probe = HttpHeadProbe(target.replace("<port>", str(port)), expected_status)
+        try:
+            results = []
+            for _ in range(num_checks):
+                results.append(await probe.check(2))
+                await asyncio.sleep(0.05)
+            return results
+        finally:
+            probe.close()
+            server.close()
+    return asyncio.run(run())
+
+
+def test_head_probe_reuses_the_connection():
+    server = HttpServer()
+    results = check(server, "http://127.0.0.1:<port>/", 3)
+    assert [result.is_connected for result in results] == [True, True, True]
+    assert server.requests == 3
+    assert server.connections == 1
+    assert results[0].num_bytes > 0
+
+
+def test_head_probe_reconnects_if_the_idle_connection_has_been_closed():
+    server = HttpServer(close_idle=True)
+    results = check(server, "http://127.0.0.1:<port>/", 2)
+    assert [result.is_connected for result in results] == [True, True]
+    assert server.connections == 2
+
+
+def test_unexpected_status_is_a_failure():
+    # e.g. a captive portal redirecting the generate_204 request
+    results = check(HttpServer(status=302), "http://127.0.0.1:<port>/generate_204", 1, 204)
+    assert not results[0].is_connected
+    assert results[0].latency_ms is None
+    results = check(HttpServer(status=204), "http://127.0.0.1:<port>/generate_204", 1, 204)
+    assert results[0].is_connected
+
+
+def test_unexpected_status_of_a_reused_connection_is_not_retried():
+    async def run():
+        server = HttpServer(status=204)
+        port = await server.start()
+        probe = HttpHeadProbe("http://127.0.0.1:" + str(port) + "/generate_204", 204)
+        try:
+            first = await probe.check(2)
+            # a captive portal answers meanwhile
+            server.status = 302
+            second = await probe.check(2)
+            return first, second, server.requests
+        finally:
+            probe.close()
+            server.close()
+
+    first, second, requests = asyncio.run(run())
+    assert first.is_connected
+    assert not second.is_connected
+    assert requests == 2
+
+
+def test_head_probe_built_outside_of_the_loop():
+    server = HttpServer()
+    probe = HttpHeadProbe("http://127.0.0.1:1/")    # the port is assigned once the server has been started
+
+    async def run():
+        probe.port = await server.start()
+        try:
+            return await probe.check(2)
+        finally:
+            probe.close()
+            server.close()
+
+    assert asyncio.run(run()).is_connected
+
+
+def test_tcp_probe_of_a_closed_port_fails():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    result = asyncio.run(TcpProbe("tcp://127.0.0.1:" + str(port)).check(2))
+    assert not result.is_connected
+
+
+def test_create_probe():
+    assert isinstance(create_probe("http://example.org", 'head'), HttpHeadProbe)
+    assert isinstance(create_probe("http://example.org", 'get'), HttpGetProbe)
+    assert create_probe("http://example.org/generate_204", '204').expected_status == 204
+    tcp = create_probe("https://example.org", 'tcp')
+    assert isinstance(tcp, TcpProbe) and tcp.port == 443
+    # the tornado client can not be restricted to ipv6
+    assert isinstance(create_probe("http://example.org", 'get', socket.AF_INET6), HttpHeadProbe)
+    # address literals are probed by their ip version only
+    assert create_probe("tcp://127.0.0.1:80", 'head', socket.AF_INET6) is None
+    assert create_probe("tcp://[::1]:80", 'head', socket.AF_INET6).name == "tcp://[::1]:80 (ipv6)"
+    with pytest.raises(ValueError):
+        create_probe("ftp://example.org")
+    with pytest.raises(ValueError):
+        create_probe("http://example.org", 'ping')
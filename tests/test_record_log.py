@@ -0,0 +1,144 @@
+from internet_monitor_webthing.record_log import RecordLog, sync_interval_sec
+import threading
+import struct
+import pytest
+import time
+
+
+RECORD = struct.Struct('<q')
+
+
+def values(log: RecordLog):
+    return [RECORD.unpack(record)[0] for record in log.records()]
+
+
+def create(filename: str, num: int, sync: str = '1000') -> RecordLog:
+    log = RecordLog(filename, RECORD.size, 1, sync)
+    for value in range(num):
+        log.append(RECORD.pack(value))
+    return log
+
+
+def test_append_and_reopen(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    create(filename, 5).close()
+    log = RecordLog(filename, RECORD.size, 1)
+    assert values(log) == [0, 1, 2, 3, 4]
+    assert RECORD.unpack(log.last())[0] == 4
+    assert RECORD.unpack(log.get(-2))[0] == 3
+    log.close()
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    create(filename, 3).close()
+    with open(filename, "ab") as file:
+        file.write(RECORD.pack(3)[:5])
+    log = RecordLog(filename, RECORD.size, 1)
+    assert values(log) == [0, 1, 2]
+    log.append(RECORD.pack(3))
+    log.close()
+    assert values(RecordLog(filename, RECORD.size, 1)) == [0, 1, 2, 3]
+
+
+def test_corrupted_record_drops_the_tail(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    create(filename, 5).close()
+    with open(filename, "r+b") as file:
+        file.seek(RecordLog.HEADER.size + 2 * (RECORD.size + RecordLog.CHECKSUM.size) + 1)
+        file.write(b'\xff')
+    log = RecordLog(filename, RECORD.size, 1)
+    assert values(log) == [0, 1]
+    log.close()
+
+
+def test_zero_filled_tail_is_dropped(tmp_path):
+    # e.g. the file size has been updated, but not the data (power loss)
+    filename = str(tmp_path / "log.bin")
+    create(filename, 2).close()
+    with open(filename, "ab") as file:
+        file.write(b'\0' * 2 * (RECORD.size + RecordLog.CHECKSUM.size))
+    assert values(RecordLog(filename, RECORD.size, 1)) == [0, 1]
+
+
+def test_unchecksummed_log_is_converted(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    with open(filename, "wb") as file:
+        file.write(RecordLog.HEADER.pack(RecordLog.MAGIC, 1, RECORD.size, 0))
+        for value in range(4):
+            file.write(RECORD.pack(value))
+        file.write(b'\1\2\3')
+    log = RecordLog(filename, RECORD.size, 1)
+    assert values(log) == [0, 1, 2, 3]
+    log.append(RECORD.pack(4))
+    log.close()
+    with open(filename, "rb") as file:
+        assert RecordLog.HEADER.unpack(file.read(RecordLog.HEADER.size))[3] & RecordLog.FLAG_CHECKSUM
+    assert values(RecordLog(filename, RECORD.size, 1)) == [0, 1, 2, 3, 4]
+
+
+def test_rewrite(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    log = create(filename, 6)
+    log.rewrite(log.records(4), RECORD.size, 1)
+    assert values(log) == [4, 5]
+    log.append(RECORD.pack(6))
+    log.close()
+    assert values(RecordLog(filename, RECORD.size, 1)) == [4, 5, 6]
+
+
+def test_invalid_file(tmp_path):
+    filename = str(tmp_path / "log.bin")
+    with open(filename, "wb") as file:
+        file.write(b'x' * 100)
+    with pytest.raises(ValueError):
+        RecordLog(filename, RECORD.size, 1)
+
+
+def test_sync_policies(tmp_path):
+    assert sync_interval_sec('record') == 0
+    assert sync_interval_sec('shutdown') is None
+    assert sync_interval_sec('250ms') == 0.25
+    with pytest.raises(ValueError):
+        sync_interval_sec('sometimes')
+
+    log = create(str(tmp_path / "record.bin"), 3, 'record')
+    assert not log.dirty
+    log.close()
+
+    log = create(str(tmp_path / "shutdown.bin"), 3, 'shutdown')
+    assert log.dirty
+    log.close()
+    assert not log.dirty
+
+    # group commit: the appends of the interval are synced by a single timer
+    log = create(str(tmp_path / "interval.bin"), 3, '50')
+    assert log.dirty
+    timer = log.sync_timer
+    time.sleep(0.3)
+    assert not log.dirty
+    assert not timer.is_alive()
+    log.close()
+
+
+def test_concurrent_reads_and_appends(tmp_path):
+    log = create(str(tmp_path / "log.bin"), 1)
+    errors = []
+
+    def read():
+        try:
+            for _ in range(2000):
+                log.get(len(log) - 1)
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for value in range(1, 2000):
+        log.append(RECORD.pack(value))
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    assert len(log) == 2000
+    log.close()
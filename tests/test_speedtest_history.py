@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from internet_monitor_webthing.speedtest_history import SpeedHistory, Rollup
+from internet_monitor_webthing.speed_engines import Speed
+import math
+import os
+
+
+START = datetime(2021, 1, 31, 22, 0, 0)
+
+
+def row(date: datetime, download: float, upload: float = 10, ping: float = 20):
+    return {'time': date.timestamp(), 'download': download, 'upload': upload, 'ping': ping, 'background': math.nan}
+
+
+def fill(history: SpeedHistory, num: int, period: timedelta = timedelta(minutes=30)):
+    for idx in range(num):
+        history.append_row(row(START + idx * period, 100 + idx))
+
+
+def test_rollups(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, 8)    # 22:00 ... 01:30, crossing the day and month boundary
+    hours = history.rollup('hour', START, START + timedelta(hours=4))
+    assert [rollup['time'] for rollup in hours] == [(START + timedelta(hours=idx)).isoformat() for idx in range(4)]
+    assert hours[0]['count'] == 2
+    assert hours[0]['download'] == {'min': 100, 'avg': 100.5, 'max': 101}
+    days = history.rollup('day', START, START + timedelta(days=1))
+    assert [(rollup['time'], rollup['count']) for rollup in days] == [('2021-01-31T00:00:00', 4), ('2021-02-01T00:00:00', 4)]
+    months = history.rollup('month', START, START + timedelta(days=1))
+    assert [(rollup['time'], rollup['count']) for rollup in months] == [('2021-01-01T00:00:00', 4), ('2021-02-01T00:00:00', 4)]
+    assert months[1]['download'] == {'min': 104, 'avg': 105.5, 'max': 107}
+    # a query starting within a rollup period includes it
+    assert len(history.rollup('day', START + timedelta(hours=1), START + timedelta(hours=1))) == 1
+
+
+def test_rollups_are_merged():
+    first = Rollup(START)
+    first.add({'download': 100, 'upload': 10, 'ping': 20})
+    second = Rollup(START)
+    second.add({'download': 50, 'upload': 30, 'ping': 10})
+    second.merge(first)
+    assert second.to_dict()['download'] == {'min': 50, 'avg': 75, 'max': 100}
+    assert second.count == 2
+
+
+def test_unknown_values_are_not_rolled_up():
+    rollup = Rollup(START)
+    rollup.add({'download': 100, 'upload': math.nan, 'ping': 20})
+    rollup.add({'download': math.nan, 'upload': math.nan, 'ping': 10})
+    assert rollup.to_dict() == {'time': START.isoformat(), 'count': 2,
+                                'download': {'min': 100, 'avg': 100, 'max': 100},
+                                'upload': {'min': None, 'avg': None, 'max': None},
+                                'ping': {'min': 10, 'avg': 15, 'max': 20}}
+    # checkpoints of former versions do not include the counts per metric
+    assert Rollup.of_state(rollup.state()[:5]).counts == {'download': 2, 'upload': 2, 'ping': 2}
+
+
+def test_rows_and_append(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    history.append(START, Speed("server", 100 * 1000 * 1000, 20 * 1000 * 1000, 12.3, "", background_during=2 * 1000 * 1000))
+    fill(history, 3)
+    rows = history.rows(START, START + timedelta(minutes=30))
+    assert len(rows) == 3
+    assert rows[0] == {'time': START.isoformat(), 'download': 100, 'upload': 20, 'ping': 12.3, 'background': 2}
+    assert rows[1]['background'] is None
+    assert len(history.rows(START, START + timedelta(days=1), limit=2)) == 2
+
+
+def test_out_of_order_row_gets_the_newest_time(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, 4)
+    # the system clock has been set back
+    history.append_row(row(START - timedelta(days=1), 50))
+    assert len(history) == 5
+    assert history.raw_rows(4)[0]['time'] == (START + timedelta(minutes=90)).timestamp()
+    assert len(history.rows(START + timedelta(minutes=90), START + timedelta(minutes=90))) == 2
+    assert history.rollup('hour', START + timedelta(hours=1), START + timedelta(hours=1))[0]['count'] == 3
+    assert SpeedHistory(str(tmp_path)).rows(START, START + timedelta(days=1)) == history.rows(START, START + timedelta(days=1))
+
+
+def test_incomplete_row_is_dropped(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, 3)
+    # a crash interrupted the append of a row
+    with open(os.path.join(str(tmp_path), "time.bin"), "ab") as file:
+        file.write(b'\0' * 8)
+    reloaded = SpeedHistory(str(tmp_path))
+    assert len(reloaded) == 3
+    assert os.path.getsize(os.path.join(str(tmp_path), "time.bin")) == 3 * 8
+
+
+def test_failed_append_is_rolled_back(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, 3)
+    incomplete = row(START + timedelta(hours=2), 200)
+    del incomplete['ping']       # fails after the time, download and upload columns have been written
+    history.append_row(incomplete)
+    assert len(history) == 3
+    assert all(len(column) == 3 for column in history.columns.values())
+    assert all(os.path.getsize(os.path.join(str(tmp_path), name + ".bin")) == 3 * 8 for name in SpeedHistory.COLUMNS)
+    assert sum(rollup['count'] for rollup in history.rollup('hour', START, START + timedelta(days=1))) == 3
+
+    history.append_row(row(START + timedelta(hours=2), 200))
+    assert history.raw_rows(3)[0]['download'] == 200
+    assert SpeedHistory(str(tmp_path)).rows(START, START + timedelta(days=1)) == history.rows(START, START + timedelta(days=1))
+
+
+def test_rollups_are_restored_from_the_checkpoint(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, SpeedHistory.CHECKPOINT_ROWS + 30)
+    assert history.checkpointed == SpeedHistory.CHECKPOINT_ROWS
+    end = START + timedelta(days=30)
+    expected = {resolution: history.rollup(resolution, START, end) for resolution in SpeedHistory.RESOLUTIONS.keys()}
+    reloaded = SpeedHistory(str(tmp_path))
+    assert reloaded.checkpointed == SpeedHistory.CHECKPOINT_ROWS
+    assert {resolution: reloaded.rollup(resolution, START, end) for resolution in SpeedHistory.RESOLUTIONS.keys()} == expected
+
+
+def test_outdated_checkpoint_is_ignored(tmp_path):
+    history = SpeedHistory(str(tmp_path))
+    fill(history, SpeedHistory.CHECKPOINT_ROWS)
+    # the history is recreated. The checkpoint remains
+    for name in SpeedHistory.COLUMNS:
+        os.remove(os.path.join(str(tmp_path), name + ".bin"))
+    recreated = SpeedHistory(str(tmp_path))
+    assert recreated.checkpointed == 0
+    assert recreated.rollup('day', START, START + timedelta(days=30)) == []
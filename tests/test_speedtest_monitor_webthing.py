@@ -0,0 +1,97 @@
+from internet_monitor_webthing.speedtest_monitor_webthing import InternetSpeedMonitorWebthing, TriggerSpeedTest
+from internet_monitor_webthing.speedtest_monitor import SpeedtestRun, SpeedtestRunner, Speed
+from tornado.ioloop import IOLoop
+import asyncio
+import threading
+
+
+class Loop:
+
+    def add_callback(self, callback, *args):
+        callback(*args)
+
+
+class Runner:
+
+    def __init__(self):
+        self.run = SpeedtestRun()
+
+    def trigger(self) -> SpeedtestRun:
+        return self.run
+
+
+class Thing:
+
+    def __init__(self):
+        self.ioloop = Loop()
+        self.speedtest_runner = Runner()
+        self.notified = []
+
+    def action_notify(self, action):
+        self.notified.append(action.as_action_description()['trigger'])
+
+
+def test_trigger_is_completed_by_a_successful_run():
+    thing = Thing()
+    TriggerSpeedTest(thing, None).start()
+    assert [description['status'] for description in thing.notified] == ['pending']
+    thing.speedtest_runner.run.complete(speed=Speed("server", 100000000, 20000000, 10.0, ""))
+    assert thing.notified[-1]['status'] == 'completed'
+    assert 'error' not in thing.notified[-1]
+
+
+def test_trigger_is_failed_by_a_failed_run():
+    thing = Thing()
+    TriggerSpeedTest(thing, None).start()
+    thing.speedtest_runner.run.complete(error=Exception("speedtest server unreachable"))
+    assert thing.notified[-1]['status'] == 'failed'
+    assert thing.notified[-1]['error'] == "speedtest server unreachable"
+    assert 'timeCompleted' in thing.notified[-1]
+
+
+def test_trigger_is_not_deferred_while_the_interface_is_busy():
+    runner = SpeedtestRunner(lambda speed: None, busy_threshold_bps=1000)
+    runner.traffic.measure = lambda duration_sec: 1000 * 1000
+    runner.measure = lambda progress_listener=None: Speed("server", 100000000, 20000000, 10.0, "")
+
+    class RacyWakeup(threading.Event):
+
+        # the trigger arrives after the wait has timed out, but before the event is cleared
+        def wait(self, timeout=None):
+            woken = threading.Event.wait(self, timeout)
+            if not woken and len(triggered) == 0:
+                triggered.append(runner.trigger())
+            return woken
+
+    triggered = []
+    runner.wakeup = RacyWakeup()
+    runner.run_periodically(24 * 60 * 60)
+    done = threading.Event()
+    while len(triggered) == 0:
+        done.wait(0.01)
+    triggered[0].add_done_callback(lambda run: done.set())
+    assert done.wait(5)
+    assert triggered[0].status == 'completed'
+
+
+def test_stored_events_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(SpeedtestRunner, 'run_periodically', lambda runner, measure_period_sec: None)
+    monkeypatch.setattr(InternetSpeedMonitorWebthing, 'MAX_STORED_EVENTS', 5)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    thing = InternetSpeedMonitorWebthing("test", 60 * 60)
+    progressed = thing._InternetSpeedMonitorWebthing__on_progress
+    updated = thing._InternetSpeedMonitorWebthing__update_speed_props
+
+    async def speedtests():
+        for run in range(8):
+            for percent in range(0, 100, 10):
+                progressed('download', percent, 100000000)
+            await asyncio.sleep(0)
+            updated(Speed("server", 100000000 + run, 20000000, 10.0, ""))
+
+    IOLoop.current().run_sync(speedtests)
+    assert len(thing.events) == 5
+    assert all(event.get_name() == 'result' for event in thing.events)
+    assert thing.events[-1].get_data()['download_speed'] == 100.0
+    asyncio.get_event_loop().close()
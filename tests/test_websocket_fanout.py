@@ -0,0 +1,127 @@
+from internet_monitor_webthing.websocket_fanout import CoalescingThing
+from webthing import Property, Value
+from types import SimpleNamespace
+import asyncio
+import json
+
+
+class Subscriber:
+
+    # a websocket handler whose writes are flushed only if the test says so
+    def __init__(self, flushed: bool = True):
+        self.request = SimpleNamespace(remote_ip="127.0.0.1")
+        self.flushed = flushed
+        self.messages = []
+        self.closed = False
+
+    def write_message(self, message: bytes):
+        self.messages.append(json.loads(message))
+        future = asyncio.get_event_loop().create_future()
+        if self.flushed:
+            future.set_result(None)
+        return future
+
+    def close(self):
+        self.closed = True
+
+
+def new_thing() -> CoalescingThing:
+    thing = CoalescingThing("urn:test", "test", [], "test")
+    for name in ['connected', 'ip_address', 'latency']:
+        thing.add_property(Property(thing, name, Value(None)))
+    return thing
+
+
+def test_changes_of_an_iteration_are_coalesced():
+    async def run():
+        thing = new_thing()
+        first, second = Subscriber(), Subscriber()
+        thing.add_subscriber(first)
+        thing.add_subscriber(second)
+        thing.set_property('connected', True)
+        thing.set_property('ip_address', "1.2.3.4")
+        thing.set_property('connected', False)
+        await asyncio.sleep(0.01)
+        return first.messages, second.messages, thing.version
+
+    first, second, version = asyncio.run(run())
+    assert first == [{'messageType': 'propertyStatus', 'data': {'connected': False, 'ip_address': "1.2.3.4"}}]
+    assert second == first
+    assert version == 3
+
+
+def test_changes_within_the_interval_are_held_back_and_merged(monkeypatch):
+    monkeypatch.setattr(CoalescingThing, 'MIN_INTERVAL_SEC', 0.2)
+
+    async def run():
+        thing = new_thing()
+        subscriber = Subscriber()
+        thing.add_subscriber(subscriber)
+        thing.set_property('connected', True)
+        await asyncio.sleep(0.01)
+        thing.set_property('ip_address', "1.2.3.4")
+        await asyncio.sleep(0.01)
+        thing.set_property('latency', "12")
+        await asyncio.sleep(0.01)
+        held_back = list(subscriber.messages)
+        await asyncio.sleep(0.3)
+        return held_back, subscriber.messages
+
+    held_back, messages = asyncio.run(run())
+    assert held_back == [{'messageType': 'propertyStatus', 'data': {'connected': True}}]
+    assert messages == [{'messageType': 'propertyStatus', 'data': {'connected': True}},
+                        {'messageType': 'propertyStatus', 'data': {'ip_address': "1.2.3.4", 'latency': "12"}}]
+
+
+def test_slow_subscriber_is_closed(monkeypatch):
+    monkeypatch.setattr(CoalescingThing, 'MIN_INTERVAL_SEC', 0)
+    monkeypatch.setattr(CoalescingThing, 'MAX_BUFFERED_BYTES', 1024)
+
+    async def run():
+        thing = new_thing()
+        slow, fast = Subscriber(flushed=False), Subscriber()
+        thing.add_subscriber(slow)
+        thing.add_subscriber(fast)
+        for i in range(20):
+            thing.set_property('ip_address', "x" * 100 + str(i))
+            await asyncio.sleep(0.001)
+        return thing, slow, fast
+
+    thing, slow, fast = asyncio.run(run())
+    assert slow.closed
+    assert slow not in thing.subscribers
+    # the unflushed messages exceeded the limit, further ones have not been written
+    assert 1024 < sum(len(json.dumps(message)) for message in slow.messages) < 2 * 1024
+    assert not fast.closed
+    assert len(fast.messages) == 20
+
+
+def test_telemetry_changes_are_rate_limited(monkeypatch):
+    monkeypatch.setattr(CoalescingThing, 'MIN_INTERVAL_SEC', 0)
+    monkeypatch.setattr(CoalescingThing, 'TELEMETRY_INTERVAL_SEC', 0.2)
+
+    async def run():
+        thing = new_thing()
+        thing.add_telemetry_property(Property(thing, 'traffic', Value(None)))
+        subscriber = Subscriber()
+        thing.add_subscriber(subscriber)
+        thing.set_property('traffic', 1000)
+        await asyncio.sleep(0.01)
+        etag = thing.properties_etag()
+        thing.properties_json()
+        thing.set_property('traffic', 1100)
+        thing.set_property('traffic', 1200)
+        await asyncio.sleep(0.01)
+        held_back = (list(subscriber.messages), thing.properties_etag(), json.loads(thing.properties_json()))
+        await asyncio.sleep(0.3)
+        return thing, subscriber, etag, held_back
+
+    thing, subscriber, etag, held_back = asyncio.run(run())
+    held_back_messages, held_back_etag, held_back_properties = held_back
+    assert held_back_messages == [{'messageType': 'propertyStatus', 'data': {'traffic': 1000}}]
+    assert held_back_etag == etag
+    assert held_back_properties['traffic'] == 1000
+    assert subscriber.messages[-1] == {'messageType': 'propertyStatus', 'data': {'traffic': 1200}}
+    assert len(subscriber.messages) == 2
+    assert thing.properties_etag() != etag
+    assert json.loads(thing.properties_json())['traffic'] == 1200